@@ -0,0 +1,540 @@
+import argparse
+import contextlib
+import gc
+import importlib.util
+import io
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+
+
+ETL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+BASELINE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "baseline.json")
+FIXTURES_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "fixtures.json")
+
+# Fixtures of a size are made of the earliest share of the raw files of
+# every point or source. Raw data grows every day, so the last file of
+# every point or source is pinned in FIXTURES_FILENAME when a baseline
+# is saved, and the same files are used later
+SIZES = {
+    "small": 0.05,
+    "medium": 0.25,
+    "full": 1.0
+}
+
+# A stage is slower than its baseline if it takes this share more time
+# and at least MIN_SECONDS more, so that noise of short stages is not
+# reported. The same goes for peak memory and MIN_MEMORY. Timings depend
+# on the machine, so they fail the run only with --check-time
+TOLERANCE = 0.25
+MIN_SECONDS = 0.05
+MIN_MEMORY = 1.0
+
+# Pages of Moscow points keep timestamps as milliseconds of Moscow time
+# counted as if it were UTC
+MSK_OFFSET = 3 * 3600
+DTYPE_UNITS = {"hourly": "h", "daily": "m", "monthly": "y"}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time parsers and transforms on recorded data")
+    parser.add_argument("--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to run, all by default"
+        )
+    parser.add_argument("--sizes",
+        nargs="+",
+        choices=list(SIZES),
+        default=list(SIZES),
+        help="Sizes of fixtures, all by default"
+        )
+    parser.add_argument("--repeat",
+        type=int,
+        default=3,
+        help="Number of runs of a stage, the fastest one is reported"
+        )
+    parser.add_argument("--baseline",
+        default=BASELINE_FILENAME,
+        help="File with results to compare with"
+        )
+    parser.add_argument("--save",
+        action="store_true",
+        help="Save results as the baseline instead of comparing with it"
+        )
+    parser.add_argument("--tolerance",
+        type=float,
+        default=TOLERANCE,
+        help="Allowed slowdown (and growth of peak memory) as a share "
+            + "of the baseline"
+        )
+    parser.add_argument("--check-time",
+        action="store_true",
+        help="Fail if a stage is slower or bigger in memory than the "
+            + "baseline, not only if it makes another number of rows"
+        )
+    parser.add_argument("--fixtures",
+        default=FIXTURES_FILENAME,
+        help="File with the last raw files of fixtures"
+        )
+    args = parser.parse_args()
+
+    current_dir = os.getcwd()
+    data_dir = os.path.abspath("data")
+    baseline = load_baseline(args.baseline)
+    fixtures = load_baseline(args.fixtures)
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory(prefix="bench_") as work_dir:
+        # Logs of the stages are not kept, and modules which configure
+        # logging on import do not change it
+        logging.basicConfig(
+            filename=os.path.join(work_dir, "bench.txt"),
+            format="[%(asctime)s] %(levelname)s: %(message)s",
+            level=logging.DEBUG
+        )
+        os.chdir(work_dir)
+        for size in args.sizes:
+            fixture_dir = os.path.join(work_dir, size)
+            make_fixtures(data_dir, fixture_dir, SIZES[size],
+                          fixtures.setdefault(size, {}))
+            for stage in args.stages:
+                result = run_stage(stage, fixture_dir, work_dir, args.repeat)
+                results.setdefault(stage, {})[size] = result
+                expected = baseline.get(stage, {}).get(size)
+                problems = compare(result, expected, args.tolerance)
+                if not args.check_time:
+                    problems = [problem for problem in problems
+                                if problem.endswith(" rows")]
+                print(format_result(stage, size, result, expected, problems))
+                if problems:
+                    regressions.append(f"{stage} ({size}): "
+                                       + ", ".join(problems))
+        os.chdir(current_dir)
+
+    if args.save:
+        for stage, by_size in results.items():
+            baseline.setdefault(stage, {}).update(by_size)
+        save_baseline(args.baseline, baseline)
+        save_baseline(args.fixtures, fixtures)
+        print(f"Baseline saved to {args.baseline}")
+    elif regressions:
+        print("Regressions:\n" + "\n".join(regressions))
+        sys.exit(1)
+
+
+def run_stage(stage: str, fixture_dir: str, work_dir: str,
+              repeat: int) -> dict:
+    """Run a stage repeat times and once more to measure peak memory
+
+    Every run has a new directory with links to the raw data of the
+    fixtures, so transforms start with no products and states.
+    """
+    prepare, run = STAGES[stage]
+    payload, size = prepare(fixture_dir)
+    timings = []
+    for i in range(repeat + 1):
+        scratch_dir = make_scratch_dir(fixture_dir, work_dir)
+        os.chdir(scratch_dir)
+        gc.collect()
+        if i == repeat:
+            tracemalloc.start()
+        started = perf_counter()
+        # Some stages print progress
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = run(payload)
+        elapsed = perf_counter() - started
+        if i == repeat:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            timings.append(elapsed)
+        os.chdir(work_dir)
+        shutil.rmtree(scratch_dir)
+
+    seconds = min(timings)
+    return {
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "bytes": size,
+        "rows_per_s": round(rows / seconds, 1) if seconds else None,
+        "mb_per_s": round(size / 2 ** 20 / seconds, 2) if seconds else None,
+        "peak_mb": round(peak / 2 ** 20, 2)
+    }
+
+
+def make_scratch_dir(fixture_dir: str, work_dir: str) -> str:
+    scratch_dir = tempfile.mkdtemp(prefix="run_", dir=work_dir)
+    for source in os.listdir(os.path.join(fixture_dir, "data")):
+        os.makedirs(os.path.join(scratch_dir, "data", source))
+        os.symlink(os.path.join(fixture_dir, "data", source, "raw"),
+                   os.path.join(scratch_dir, "data", source, "raw"))
+    return scratch_dir
+
+
+def compare(result: dict, expected: dict, tolerance: float) -> list:
+    if expected is None:
+        return []
+    problems = []
+    if result["rows"] != expected["rows"]:
+        problems.append(f"{expected['rows']} rows expected, got "
+                        + f"{result['rows']} rows")
+    if result["seconds"] > expected["seconds"] * (1 + tolerance) \
+            and result["seconds"] - expected["seconds"] > MIN_SECONDS:
+        problems.append(f"{result['seconds']:.3f} s instead of "
+                        + f"{expected['seconds']:.3f} s")
+    if result["peak_mb"] > expected["peak_mb"] * (1 + tolerance) \
+            and result["peak_mb"] - expected["peak_mb"] > MIN_MEMORY:
+        problems.append(f"{result['peak_mb']:.1f} MB instead of "
+                        + f"{expected['peak_mb']:.1f} MB")
+    return problems
+
+
+def format_result(stage: str, size: str, result: dict, expected: dict,
+                  problems: list) -> str:
+    line = (f"{stage:<22} {size:<7} {result['seconds']:>9.3f} s "
+            + f"{result['rows']:>9} rows {result['rows_per_s'] or 0:>11.0f}"
+            + f" rows/s {result['mb_per_s'] or 0:>8.2f} MB/s "
+            + f"{result['peak_mb']:>8.1f} MB peak")
+    if expected is not None and expected["seconds"]:
+        change = result["seconds"] / expected["seconds"] - 1
+        line += f" {change:>+7.1%} time"
+    if problems:
+        line += "  REGRESSION"
+    return line
+
+
+def load_baseline(filename: str) -> dict:
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_baseline(filename: str, baseline: dict):
+    with open(filename, "w") as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+
+
+def make_fixtures(data_dir: str, fixture_dir: str, share: float,
+                  last_files: dict):
+    """Copy the earliest raw files of every point or source
+
+    Moscow and Saint Petersburg snapshots are taken by point, the other
+    sources by file. last_files has the last file of every point or
+    source in the fixtures. Points and sources without one get the
+    earliest share of their files, and their last file is added to
+    last_files. Pages of Moscow points, which are not stored, are made
+    from the last snapshot of every point in the fixtures.
+    """
+    # Points and sources added after the fixtures were pinned are not
+    # used, so that the fixtures do not change
+    pinned = bool(last_files)
+    for ptype in ("stations", "special_stations", "profilers"):
+        ptype_dir = os.path.join(data_dir, "msk", "raw", ptype)
+        if not os.path.isdir(ptype_dir):
+            continue
+        for pname in sorted(os.listdir(ptype_dir)):
+            filenames = list_msk_snapshots(os.path.join(ptype_dir, pname))
+            for filename in earliest(f"msk/{ptype}/{pname}", filenames,
+                                     share, last_files, pinned):
+                copy_file(os.path.join(ptype_dir, pname, filename), data_dir,
+                          fixture_dir)
+
+    for source in ("feerc", "tat", "volga"):
+        filenames = []
+        for dirname, _, names in os.walk(os.path.join(data_dir, source, "raw")):
+            filenames.extend(os.path.join(dirname, name)
+                             for name in names if name.endswith(".json"))
+        filenames.sort(key=os.path.basename)
+        for filename in earliest(source, filenames, share, last_files,
+                                 pinned):
+            copy_file(filename, data_dir, fixture_dir)
+
+    spb_blobs = load_module("spb_blobs", os.path.join(ETL_DIR, "spb",
+                                                      "blobs.py"))
+    spb_blobs.blobs_dir = os.path.join(data_dir, "spb", "blobs")
+    for stype in ("asmav", "gmsav"):
+        stype_dir = os.path.join(data_dir, "spb", "raw", stype)
+        if not os.path.isdir(stype_dir):
+            continue
+        for sid in sorted(os.listdir(stype_dir)):
+            snapshots = sorted(
+                name for name in os.listdir(os.path.join(stype_dir, sid))
+                if os.path.isdir(os.path.join(stype_dir, sid, name)))
+            for snapshot in earliest(f"spb/{stype}/{sid}", snapshots, share,
+                                     last_files, pinned):
+                files = spb_blobs.list_files(
+                    os.path.join(stype_dir, sid, snapshot))
+                if "index.html" not in files:
+                    continue
+                target = os.path.join(fixture_dir, "data", "spb", "raw",
+                                      stype, sid, snapshot, "index.html")
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(files["index.html"], target)
+
+    make_msk_pages(fixture_dir)
+
+
+def earliest(group: str, names: list, share: float, last_files: dict,
+             pinned: bool) -> list:
+    # Names are paths or names of files sorted in time, the last file is
+    # kept by its name
+    basenames = [os.path.basename(name) for name in names]
+    if pinned and group not in last_files:
+        return []
+    if group not in last_files:
+        if not names:
+            return []
+        last_files[group] = basenames[
+            max(1, math.ceil(len(names) * share)) - 1]
+    if last_files[group] not in basenames:
+        raise FileNotFoundError(f"No {last_files[group]} of fixtures "
+                                + f"in {group}")
+    return names[:basenames.index(last_files[group]) + 1]
+
+
+def list_msk_snapshots(dirname: str) -> list:
+    msk_delta = load_module("msk_delta", os.path.join(ETL_DIR, "msk",
+                                                      "delta.py"))
+    return msk_delta.list_snapshots(dirname)
+
+
+def copy_file(filename: str, data_dir: str, fixture_dir: str):
+    target = os.path.join(fixture_dir, "data",
+                          os.path.relpath(filename, data_dir))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copyfile(filename, target)
+
+
+def make_msk_pages(fixture_dir: str):
+    # Pages have only the parts the parsers read: the script with data
+    # of a station, or the rects of a profiler plot
+    msk_delta = load_module("msk_delta", os.path.join(ETL_DIR, "msk",
+                                                      "delta.py"))
+    raw_dir = os.path.join(fixture_dir, "data", "msk", "raw")
+    pages_dir = os.path.join(fixture_dir, "pages")
+    os.makedirs(pages_dir)
+    for ptype in sorted(os.listdir(raw_dir)) if os.path.isdir(raw_dir) else []:
+        for pname in sorted(os.listdir(os.path.join(raw_dir, ptype))):
+            dirname = os.path.join(raw_dir, ptype, pname)
+            snapshot = msk_delta.load(
+                dirname, msk_delta.list_snapshots(dirname)[-1])
+            if ptype == "profilers":
+                html = profiler_page(snapshot["data"])
+            else:
+                html = station_page(snapshot["data"])
+            with open(os.path.join(pages_dir, f"{ptype}_{pname}.html"),
+                      "w") as f:
+                f.write(html)
+
+
+def station_page(data: dict) -> str:
+    units = {}
+    for dtype, rows in data.items():
+        by_pollutant = units.setdefault(DTYPE_UNITS[dtype], {})
+        for dt, pollutant, value in rows:
+            ts = (int(datetime.fromisoformat(dt).timestamp()) + MSK_OFFSET) \
+                * 1000
+            by_pollutant.setdefault(pollutant, {"data": []})["data"]\
+                .append([ts, value])
+    return ("<html><body><script>\nAirCharts.init("
+            + json.dumps({"units": units})
+            + ', {"months": []});\n</script></body></html>')
+
+
+def profiler_page(rows: list) -> str:
+    rects = []
+    for dt, height, temperature in rows:
+        date = datetime.fromisoformat(dt).strftime("%d.%m.%Y %H:%M")
+        rects.append(f'<rect data-val="{temperature}" '
+                     + f'data-height="{height}" data-date="{date}"></rect>')
+    return "<html><body><svg>" + "\n".join(rects) + "</svg></body></html>"
+
+
+def load_module(name: str, filename: str):
+    """Import a script by its path
+
+    Scripts of different sources have the same names, so they are
+    imported under other names. Their own folder is added to the path
+    for the modules they import.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    dirname = os.path.dirname(os.path.abspath(filename))
+    if dirname not in sys.path:
+        sys.path.insert(0, dirname)
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def raw_size(dirname: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name))
+               for path, _, names in os.walk(dirname) for name in names)
+
+
+def count_lines(filename: str) -> int:
+    # Header lines are not counted
+    with open(filename, "rb") as f:
+        return sum(1 for _ in f) - 1
+
+
+def read_pages(fixture_dir: str, profilers: bool) -> tuple:
+    pages = []
+    pages_dir = os.path.join(fixture_dir, "pages")
+    for name in sorted(os.listdir(pages_dir)):
+        if name.startswith("profilers_") == profilers:
+            with open(os.path.join(pages_dir, name)) as f:
+                pages.append(f.read())
+    return pages, sum(len(page.encode("utf8")) for page in pages)
+
+
+def prepare_msk_transform(fixture_dir: str) -> tuple:
+    load_module("msk_transform", os.path.join(ETL_DIR, "msk", "transform.py"))
+    return None, raw_size(os.path.join(fixture_dir, "data", "msk", "raw"))
+
+
+def run_msk_transform(payload) -> int:
+    transform = sys.modules["msk_transform"]
+    rows_count = 0
+    for dirname, _, filenames in os.walk(transform.params.raw_data_dir,
+                                         followlinks=True):
+        parts = dirname.split("/")
+        if len(parts) != 5:
+            continue
+        summary = transform.process_point(parts[-2], parts[-1], dirname,
+                                          filenames)
+        rows_count += sum(summary["rows"].values())
+    return rows_count
+
+
+def prepare_msk_pollution_parser(fixture_dir: str) -> tuple:
+    load_module("msk_air", os.path.join(ETL_DIR, "msk", "ycloud", "scrape",
+                                        "air.py"))
+    return read_pages(fixture_dir, profilers=False)
+
+
+def run_msk_pollution_parser(pages: list) -> int:
+    air = sys.modules["msk_air"]
+    return sum(len(rows) for page in pages
+               for rows in air.PollutionParser().parse_html(page).values())
+
+
+def prepare_msk_meteo_parser(fixture_dir: str) -> tuple:
+    load_module("msk_meteo", os.path.join(ETL_DIR, "msk", "ycloud", "scrape",
+                                          "meteo.py"))
+    return read_pages(fixture_dir, profilers=True)
+
+
+def run_msk_meteo_parser(pages: list) -> int:
+    meteo = sys.modules["msk_meteo"]
+    return sum(len(meteo.MeteoprofileParser().parse_html(page))
+               for page in pages)
+
+
+def prepare_spb_scrape(fixture_dir: str) -> tuple:
+    load_module("spb_extract", os.path.join(ETL_DIR, "spb", "extract.py"))
+    pages = []
+    for path, _, names in sorted(os.walk(os.path.join(fixture_dir, "data",
+                                                      "spb", "raw"))):
+        if "index.html" in names:
+            with open(os.path.join(path, "index.html"), encoding="utf8") as f:
+                pages.append(f.read())
+    return pages, sum(len(page.encode("utf8")) for page in pages)
+
+
+def run_spb_scrape(pages: list) -> int:
+    extract = sys.modules["spb_extract"]
+    return sum(len(extract.find_images(page)) for page in pages)
+
+
+def prepare_feerc_decode(fixture_dir: str) -> tuple:
+    # Files are read to memory, so only decoding of JSON and of values
+    # of stations is timed
+    transform = load_module("feerc_transform",
+                            os.path.join(ETL_DIR, "feerc", "transform.py"))
+    texts = []
+    for path, _, names in os.walk(os.path.join(fixture_dir, "data", "feerc",
+                                               "raw")):
+        for name in sorted(names):
+            with open(os.path.join(path, name), "rb") as f:
+                texts.append(f.read())
+    return texts, sum(len(text) for text in texts)
+
+
+def run_feerc_decode(texts: list) -> int:
+    transform = sys.modules["feerc_transform"]
+    pollution, meteo = transform.Table(), transform.Table()
+    for text in texts:
+        transform.read_stations(json.loads(text), pollution, meteo, {})
+    return len(pollution.rows) + len(meteo.rows)
+
+
+def prepare_feerc_transform(fixture_dir: str) -> tuple:
+    load_module("feerc_transform",
+                os.path.join(ETL_DIR, "feerc", "transform.py"))
+    return None, raw_size(os.path.join(fixture_dir, "data", "feerc", "raw"))
+
+
+def run_feerc_transform(payload) -> int:
+    transform = sys.modules["feerc_transform"]
+    transform.main()
+    return sum(count_lines(os.path.join(transform.out_dir, f"{name}.csv"))
+               for name in ("daily", "meteo"))
+
+
+def prepare_tat_transform(fixture_dir: str) -> tuple:
+    load_module("tat_transform", os.path.join(ETL_DIR, "tat", "transform.py"))
+    return None, raw_size(os.path.join(fixture_dir, "data", "tat", "raw"))
+
+
+def run_tat_transform(payload) -> int:
+    transform = sys.modules["tat_transform"]
+    transform.main()
+    return count_lines(os.path.join(transform.out_dir, "concentrations.csv"))
+
+
+def prepare_volga_transform(fixture_dir: str) -> tuple:
+    load_module("volga_transform",
+                os.path.join(ETL_DIR, "volga", "transform.py"))
+    return None, raw_size(os.path.join(fixture_dir, "data", "volga", "raw"))
+
+
+def run_volga_transform(payload) -> int:
+    transform = sys.modules["volga_transform"]
+    transform.main()
+    return count_lines(os.path.join(transform.out_dir, "measurements.csv"))
+
+
+# Every stage is a function preparing its input from the fixtures,
+# which is not timed, and a function running it and returning the
+# number of rows it made. Transforms read and write files themselves
+STAGES = {
+    "msk_transform": (prepare_msk_transform, run_msk_transform),
+    "msk_pollution_parser": (prepare_msk_pollution_parser,
+                             run_msk_pollution_parser),
+    "msk_meteo_parser": (prepare_msk_meteo_parser, run_msk_meteo_parser),
+    "spb_scrape": (prepare_spb_scrape, run_spb_scrape),
+    "feerc_decode": (prepare_feerc_decode, run_feerc_decode),
+    "feerc_transform": (prepare_feerc_transform, run_feerc_transform),
+    "tat_transform": (prepare_tat_transform, run_tat_transform),
+    "volga_transform": (prepare_volga_transform, run_volga_transform)
+}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+import gzip
+import http.client
+import io
+import logging
+import random
+import ssl
+import sys
+import threading
+import zlib
+from statistics import median, quantiles
+from time import perf_counter, sleep
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+
+
+# Responses with these codes are worth another attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+
+# An idle connection may be closed by the server at any moment, and
+# the error is only seen when it is used again. Such a request is
+# repeated at once on a new connection, not counted as a retry
+STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError,
+                BrokenPipeError, ConnectionAbortedError)
+
+
+class Response:
+    """Decoded body, status and headers of a response
+
+    info() returns headers like a response of urlopen does, so callers
+    can use both in the same way.
+    """
+    def __init__(self, url: str, status: int, reason: str,
+                 headers: http.client.HTTPMessage, content: bytes):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def info(self) -> http.client.HTTPMessage:
+        return self.headers
+
+    def read(self) -> bytes:
+        return self.content
+
+
+class Stats:
+    """Number of requests, bytes and latencies by host"""
+    def __init__(self):
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def add(self, host: str, latency: float, received: int = 0,
+            decoded: int = 0, error: bool = False, retry: bool = False):
+        with self._lock:
+            stats = self._hosts.setdefault(host, {
+                "requests": 0, "errors": 0, "retries": 0,
+                "received": 0, "decoded": 0, "latencies": []
+            })
+            stats["requests"] += 1
+            stats["errors"] += error
+            stats["retries"] += retry
+            stats["received"] += received
+            stats["decoded"] += decoded
+            stats["latencies"].append(latency)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                host: {
+                    "requests": stats["requests"],
+                    "errors": stats["errors"],
+                    "retries": stats["retries"],
+                    "received": stats["received"],
+                    "decoded": stats["decoded"],
+                    "latency_median": median(stats["latencies"]),
+                    "latency_p95": p95(stats["latencies"]),
+                    "latency_max": max(stats["latencies"]),
+                    "latency_total": sum(stats["latencies"])
+                }
+                for host, stats in self._hosts.items()
+            }
+
+    def totals(self) -> dict:
+        """Return the same numbers as summary() for all hosts together"""
+        with self._lock:
+            hosts = list(self._hosts.values())
+            totals = {
+                key: sum(stats[key] for stats in hosts)
+                for key in ("requests", "errors", "retries", "received",
+                            "decoded")
+            }
+            latencies = [latency for stats in hosts
+                         for latency in stats["latencies"]]
+        if latencies:
+            totals.update({
+                "latency_median": median(latencies),
+                "latency_p95": p95(latencies),
+                "latency_max": max(latencies),
+                "latency_total": sum(latencies)
+            })
+        return totals
+
+
+class Client:
+    """HTTP client keeping connections to hosts open between requests
+
+    Requests ask for gzip and the body is decoded transparently.
+    Connection errors, timeouts and responses with RETRY_STATUSES are
+    retried up to retries times after a random delay of up to backoff
+    seconds, doubled on every retry. Errors are raised as HTTPError and
+    URLError, like the ones of urlopen. The client may be shared by
+    threads: a connection is used by one request at a time, and at most
+    pool_size idle connections are kept for a host.
+    """
+    def __init__(self, timeout: float = 60, retries: int = 2,
+                 backoff: float = 1, max_backoff: float = 60,
+                 pool_size: int = 4, headers: dict = None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        # The same User-Agent as the one of urlopen, so sites see no
+        # difference
+        self.headers = {
+            "Accept-Encoding": "gzip, deflate",
+            "User-Agent": f"Python-urllib/{sys.version_info[0]}."
+                          + f"{sys.version_info[1]}"
+        }
+        self.headers.update(headers or {})
+        self.stats = Stats()
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+
+    def get(self, url: str, headers: dict = None,
+            timeout: float = None) -> Response:
+        return self.request("GET", url, headers=headers, timeout=timeout)
+
+    def request(self, method: str, url: str, headers: dict = None,
+                body: bytes = None, timeout: float = None) -> Response:
+        """Send a request following redirects, with retries
+
+        Raises HTTPError for codes from 300 (not redirects) and URLError
+        if the host cannot be reached after all attempts.
+        """
+        headers = {**self.headers, **(headers or {})}
+        for _ in range(MAX_REDIRECTS + 1):
+            if urlsplit(url).scheme not in ("http", "https"):
+                raise URLError(f"Unsupported URL scheme: {url}")
+            response = self._request_with_retries(method, url, headers, body,
+                                                  timeout or self.timeout)
+            location = response.headers.get("Location")
+            if response.status not in REDIRECT_STATUSES or not location:
+                break
+            url = urljoin(url, location)
+            if response.status == 303 or (response.status in (301, 302)
+                                          and method == "POST"):
+                method, body = "GET", None
+        else:
+            raise URLError(f"Too many redirects from {url}")
+
+        if response.status >= 300:
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, io.BytesIO(response.content))
+        return response
+
+    def _request_with_retries(self, method, url, headers, body, timeout):
+        host = urlsplit(url).netloc
+        retry_after, error = None, None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._wait(attempt, retry_after)
+            retry_after, error = None, None
+            started = perf_counter()
+            try:
+                response, received = self._send(method, url, headers, body,
+                                                timeout)
+            except (OSError, http.client.HTTPException) as e:
+                self.stats.add(host, perf_counter() - started, error=True,
+                               retry=attempt > 0)
+                logging.warning(f"Request to {url} failed: {e!r}")
+                error = e
+                continue
+            self.stats.add(host, perf_counter() - started, received,
+                           len(response.content),
+                           error=response.status >= 400, retry=attempt > 0)
+            if response.status not in RETRY_STATUSES \
+                    or attempt == self.retries:
+                return response
+            logging.warning(f"Request to {url} returned {response.status}")
+            retry_after = response.headers.get("Retry-After")
+
+        raise URLError(error)
+
+    def _wait(self, attempt, retry_after):
+        # Full jitter spreads retries of concurrent requests to the same
+        # host, so they do not come back all at once
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, int(retry_after)))
+        sleep(delay)
+
+    def _send(self, method, url, headers, body, timeout):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        conn, reused = self._acquire(key, timeout)
+        try:
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                res = conn.getresponse()
+            except STALE_ERRORS:
+                if not reused:
+                    raise
+                conn.close()
+                conn.connect()
+                conn.request(method, path, body=body, headers=headers)
+                res = conn.getresponse()
+            content = res.read()
+        except BaseException:
+            conn.close()
+            raise
+
+        if res.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        return Response(url, res.status, res.reason, res.headers,
+                        decode(content, res.headers)), len(content)
+
+    def _acquire(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        scheme, netloc = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(
+                netloc, timeout=timeout, context=self._ssl_context), False
+        return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def log_stats(self, log=logging.info):
+        for host, stats in sorted(self.stats.summary().items()):
+            log(
+                f"HTTP {host}: {stats['requests']} requests, "
+                + f"{stats['errors']} errors, {stats['retries']} retries, "
+                + f"{stats['received']} bytes received "
+                + f"({stats['decoded']} decoded), latency median "
+                + f"{stats['latency_median']:.2f} s, p95 "
+                + f"{stats['latency_p95']:.2f} s, max "
+                + f"{stats['latency_max']:.2f} s, total "
+                + f"{stats['latency_total']:.2f} s")
+
+
+def decode(content: bytes, headers: http.client.HTTPMessage) -> bytes:
+    encoding = (headers.get("Content-Encoding") or "").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        return gzip.decompress(content)
+    if encoding == "deflate":
+        # Some servers send raw deflate without the zlib header
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    return content
+
+
+def p95(values: list) -> float:
+    if len(values) < 2:
+        return values[0]
+    return quantiles(values, n=20, method="inclusive")[-1]
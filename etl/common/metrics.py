@@ -0,0 +1,180 @@
+import argparse
+import csv
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from statistics import median
+from time import perf_counter
+
+
+LOGS_DIR = "logs"
+TRENDS_DIR = os.path.join("logs", "metrics")
+
+# Columns of trend tables after the run, script and stage. Stages have
+# only the numbers they count
+COLUMNS = ("duration", "requests", "errors", "bytes_fetched",
+           "latency_p50", "latency_p95", "files_read", "files_skipped",
+           "files_written", "rows_parsed", "rows_written")
+
+# The duration of a stage is compared with the median of this number of
+# its previous runs
+TREND_RUNS = 7
+
+
+class Metrics:
+    """Numbers of one run of a script, by stage
+
+    The record is saved as JSON next to the text log of the run, with
+    the same name, so the history of runs can be read without parsing
+    the logs (see main). Counters may be added by several threads.
+    """
+    def __init__(self, source: str, script: str, filename: str):
+        self.filename = filename
+        self.record = {
+            "source": source,
+            "script": script,
+            "started": datetime.now(tz=timezone(timedelta(hours=3)))
+                .isoformat(timespec="seconds"),
+            "duration": None,
+            "stages": {}
+        }
+        self._started = perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a block of code as a stage, adding up repeated blocks"""
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, duration=perf_counter() - started)
+
+    def add(self, stage: str, **counters):
+        with self._lock:
+            numbers = self.record["stages"].setdefault(stage, {})
+            for key, value in counters.items():
+                numbers[key] = numbers.get(key, 0) + value
+
+    def add_http(self, stage: str, client):
+        """Add numbers of requests of an http_client.Client to a stage"""
+        totals = client.stats.totals()
+        if not totals["requests"]:
+            return
+        self.add(stage, requests=totals["requests"],
+                 errors=totals["errors"], bytes_fetched=totals["received"])
+        with self._lock:
+            self.record["stages"][stage].update(
+                latency_p50=round(totals["latency_median"], 3),
+                latency_p95=round(totals["latency_p95"], 3))
+
+    def save(self):
+        self.record["duration"] = round(perf_counter() - self._started, 3)
+        for numbers in self.record["stages"].values():
+            if "duration" in numbers:
+                numbers["duration"] = round(numbers["duration"], 3)
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename, "w") as f:
+            json.dump(self.record, f, indent=1)
+
+
+def read_records(logs_dir: str = LOGS_DIR) -> list:
+    """Return all saved records ordered by the start of their runs"""
+    records = []
+    for path, _, names in os.walk(logs_dir):
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(path, name)) as f:
+                    record = json.load(f)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and "stages" in record:
+                records.append(record)
+    return sorted(records, key=lambda record: record["started"])
+
+
+def make_trends(records: list) -> dict:
+    """Return rows of trend tables by source
+
+    Every row is a stage of a run (the whole run is the "total" stage)
+    with its numbers and the change of its duration from the median of
+    the previous TREND_RUNS runs of the stage.
+    """
+    tables = {}
+    durations = {}
+    for record in records:
+        stages = dict(record["stages"])
+        stages["total"] = {"duration": record["duration"]}
+        for stage, numbers in stages.items():
+            key = (record["source"], record["script"], stage)
+            previous = durations.setdefault(key, [])
+            duration = numbers.get("duration")
+            change = None
+            if duration is not None and previous:
+                baseline = median(previous[-TREND_RUNS:])
+                if baseline:
+                    change = round(duration / baseline - 1, 3)
+            if duration is not None:
+                previous.append(duration)
+            tables.setdefault(record["source"], []).append(
+                [record["started"], record["script"], stage]
+                + [numbers.get(column) for column in COLUMNS] + [change])
+    return tables
+
+
+def write_trends(tables: dict, trends_dir: str = TRENDS_DIR):
+    os.makedirs(trends_dir, exist_ok=True)
+    for source, rows in tables.items():
+        with open(os.path.join(trends_dir, f"{source}.csv"), "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(("started", "script", "stage") + COLUMNS
+                            + ("duration_change",))
+            writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Make trend tables of runs of scripts by source")
+    parser.add_argument("sources",
+        nargs="*",
+        help="Sources to make tables for, all of them by default"
+        )
+    parser.add_argument("--logs-dir",
+        default=LOGS_DIR,
+        help="Folder with logs and metrics of runs"
+        )
+    parser.add_argument("--out-dir",
+        default=TRENDS_DIR,
+        help="Folder for trend tables, one per source"
+        )
+    parser.add_argument("--threshold",
+        type=float,
+        default=0.5,
+        help="Report the last runs of stages slower than the median of "
+            + "the previous ones by this share"
+        )
+    args = parser.parse_args()
+
+    tables = make_trends(read_records(args.logs_dir))
+    if args.sources:
+        tables = {source: rows for source, rows in tables.items()
+                  if source in args.sources}
+    write_trends(tables, args.out_dir)
+    for source, rows in sorted(tables.items()):
+        print(f"{source}: {len(rows)} rows")
+        last = {}
+        for row in rows:
+            last[(row[1], row[2])] = row
+        for (script, stage), row in sorted(last.items()):
+            change = row[-1]
+            if change is not None and change > args.threshold:
+                print(f"  {script} {stage}: {row[3]} s on {row[0]}, "
+                      + f"{change:+.0%} from the median")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+import ast
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import registry
+
+
+Params = namedtuple("Params", [
+    "db_filename",
+    "msk_product_dir",
+    "feerc_raw_dir",
+    "volga_raw_dir",
+    "tat_product_dir",
+    "logs_dir",
+    "current_dt"
+])
+
+params = Params(
+    db_filename=os.path.join("data", "db", "air.sqlite"),
+    msk_product_dir=os.path.join("data", "msk", "product"),
+    feerc_raw_dir=os.path.join("data", "feerc", "raw"),
+    volga_raw_dir=os.path.join("data", "volga", "raw"),
+    tat_product_dir=os.path.join("data", "tat", "product"),
+    logs_dir=os.path.join("logs", "db", "build"),
+    current_dt=datetime.now(tz=timezone(timedelta(hours=3)))\
+            .isoformat(timespec="seconds"),
+)
+
+MSK_TZ = timezone(timedelta(hours=3))
+
+# Tables are made again when the schema changes. Version 1: ids of
+# stations are the ones of the registry
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stations (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    code TEXT NOT NULL,
+    ptype TEXT,
+    name TEXT,
+    lat REAL,
+    lon REAL,
+    UNIQUE (source, code)
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    station_id INTEGER NOT NULL REFERENCES stations (id),
+    dtype TEXT NOT NULL,
+    pollutant TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (station_id, dtype, pollutant, ts)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS measurements_pollutant_ts
+    ON measurements (pollutant, dtype, ts);
+CREATE TABLE IF NOT EXISTS loaded_files (
+    path TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    tail BLOB
+);
+"""
+
+# Stations of the registry by (source, code), new ones are added to it
+stations = {}
+
+# Number of last loaded bytes of a rolling table kept to detect rebuilds
+TAIL_SIZE = 256
+
+# FEERC uses this value for missing measurements
+FEERC_MISSING = -32768
+
+
+def main():
+    if not os.path.isdir(params.logs_dir):
+        os.makedirs(params.logs_dir)
+
+    logging.basicConfig(
+        filename=os.path.join(params.logs_dir,
+                              f"build_{params.current_dt}.txt"),
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        level=logging.DEBUG
+    )
+
+    db_dir = os.path.dirname(params.db_filename)
+    if not os.path.isdir(db_dir):
+        os.makedirs(db_dir)
+
+    con = sqlite3.connect(params.db_filename)
+    if con.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        logging.info("Schema has changed, the database is built again")
+        con.executescript("DROP TABLE IF EXISTS measurements; "
+                          + "DROP TABLE IF EXISTS stations; "
+                          + "DROP TABLE IF EXISTS loaded_files;")
+        con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    con.executescript(SCHEMA)
+    stations.update({(station.source, station.code): station
+                     for station in registry.load()})
+    registered_count = len(stations)
+
+    counts = {
+        "msk": load_msk(con),
+        "feerc": load_snapshots(con, params.feerc_raw_dir, read_feerc),
+        "volga": load_snapshots(con, params.volga_raw_dir, read_volga),
+        "tat": load_tat(con),
+    }
+    con.execute("ANALYZE")
+    con.commit()
+    con.close()
+    registry.save(sorted(stations.values()))
+    if len(stations) > registered_count:
+        logging.info(f"Registered {len(stations) - registered_count} "
+            + "new stations")
+
+    logging.info(f"Loaded measurements: {counts}")
+
+
+def load_msk(con: sqlite3.Connection) -> int:
+    # Rolling tables are append-only, so only the lines after the
+    # position loaded last time are read
+    rows_count = 0
+    for ptype in ("stations", "special_stations"):
+        ptype_dir = os.path.join(params.msk_product_dir, ptype)
+        if not os.path.isdir(ptype_dir):
+            continue
+        for pname in sorted(os.listdir(ptype_dir)):
+            station_id = get_station_id(con, "msk", pname, ptype=ptype)
+            for dtype in ("hourly", "daily", "monthly"):
+                filename = os.path.join(ptype_dir, pname,
+                                        f"rolling_{dtype}.csv")
+                if not os.path.isfile(filename):
+                    continue
+                position, tail = get_position(con, filename)
+                with open(filename, "rb") as f:
+                    # The table was rebuilt if bytes before the position
+                    # are not the ones seen last time
+                    f.seek(max(position - len(tail), 0))
+                    if f.read(len(tail)) != tail:
+                        logging.info(f"{filename} was rebuilt, "
+                            + "loading it again")
+                        con.execute("DELETE FROM measurements "
+                            + "WHERE station_id = ? AND dtype = ?",
+                            (station_id, dtype))
+                        position = 0
+                    f.seek(position)
+                    content = f.read()
+                if not content:
+                    continue
+
+                reader = csv.reader(io.StringIO(content.decode("utf8")))
+                if position == 0:
+                    next(reader, None)
+                rows = [
+                    (station_id, dtype, pollutant, to_ts(dt), to_float(value))
+                    for dt, pollutant, value in reader
+                ]
+                insert_measurements(con, rows)
+                set_position(con, filename, position + len(content),
+                             content[-TAIL_SIZE:])
+                con.commit()
+                rows_count += len(rows)
+
+    logging.info(f"Loaded {rows_count} rows from Moscow rolling tables")
+    return rows_count
+
+
+def load_snapshots(con: sqlite3.Connection, raw_dir: str, read_func) -> int:
+    # Raw snapshots never change, so each of them is loaded only once
+    rows_count = 0
+    files_count = 0
+    for dirname, _, filenames in os.walk(raw_dir):
+        for filename in sorted(filenames):
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(dirname, filename)
+            if get_position(con, path)[0]:
+                continue
+            with open(path) as f:
+                try:
+                    data = json.load(f)
+                except ValueError:
+                    logging.error(f"Cannot read {path}")
+                    continue
+            rows = read_func(con, data)
+            insert_measurements(con, rows)
+            set_position(con, path, os.path.getsize(path))
+            con.commit()
+            rows_count += len(rows)
+            files_count += 1
+
+    logging.info(f"Loaded {rows_count} rows from {files_count} new files "
+        + f"in {raw_dir}")
+    return rows_count
+
+
+def read_feerc(con: sqlite3.Connection, data: dict) -> list:
+    rows = []
+    for group in data.get("data", []):
+        for station in group.get("stations", []):
+            si = decode_feerc_value(station.get("si"))
+            history = decode_feerc_value(station.get("primsSS"))
+            if not si or not history:
+                continue
+            station_id = get_station_id(con, "feerc", station.get("ind"),
+                                        name=station.get("label"),
+                                        lat=to_float(station.get("lat")),
+                                        lon=to_float(station.get("lng")))
+            pollutants = [item.get("name") for item in si]
+            # Dates are local for each city, so they are stored as
+            # midnight UTC to keep the calendar day
+            for item in history:
+                ts = to_ts(item["dt"].replace("_", "T"), tz=timezone.utc)
+                for pollutant, value in zip(pollutants, item["vals"]):
+                    if value is None or value == FEERC_MISSING:
+                        continue
+                    rows.append((station_id, "daily", pollutant, ts, value))
+    return rows
+
+
+def decode_feerc_value(value):
+    # Snapshots of history keep nested values as Python literals
+    if isinstance(value, str):
+        return ast.literal_eval(value)
+    return value
+
+
+def read_volga(con: sqlite3.Connection, data: dict) -> list:
+    rows = []
+    for station in data.values():
+        station_id = get_station_id(con, "volga", str(station["id"]),
+                                    name=station.get("address"),
+                                    lat=station.get("latitude"),
+                                    lon=station.get("longitude"))
+        meas_list = station.get("meas_list") or {}
+        for meas_id, meas in (station.get("meas_last_list") or {}).items():
+            info = meas_list.get(meas_id, {})
+            pollutant = info.get("shortname") or info.get("fullname")
+            if not pollutant or meas.get("value") is None:
+                continue
+            ts = to_ts(meas["begin_at"].replace("Z", "+00:00"))
+            rows.append((station_id, "last", pollutant, ts, meas["value"]))
+    return rows
+
+
+def load_tat(con: sqlite3.Connection) -> int:
+    # Placemarks are parsed by etl/tat/transform.py, which rebuilds its
+    # table from all snapshots on every run, so the table is loaded
+    # again in full when its digest changes
+    filename = os.path.join(params.tat_product_dir, "concentrations.csv")
+    if not os.path.isfile(filename):
+        logging.warning(f"No {filename}, run etl/tat/transform.py first")
+        return 0
+    with open(filename, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).digest()
+    if get_position(con, filename) == (len(content), digest):
+        return 0
+
+    coords = {}
+    stations_filename = os.path.join(params.tat_product_dir, "stations.csv")
+    if os.path.isfile(stations_filename):
+        with open(stations_filename) as f:
+            for row in csv.DictReader(f):
+                coords[row["station"]] = (to_float(row["lat"]),
+                                          to_float(row["lon"]))
+
+    con.execute("DELETE FROM measurements WHERE station_id IN "
+                + "(SELECT id FROM stations WHERE source = 'tat')")
+    rows = []
+    station_ids = {}
+    for row in csv.DictReader(io.StringIO(content.decode("utf8"))):
+        station = row["station"]
+        if station not in station_ids:
+            lat, lon = coords.get(station, (None, None))
+            station_ids[station] = get_station_id(con, "tat", station,
+                                                  name=station, lat=lat,
+                                                  lon=lon)
+        rows.append((station_ids[station], row["kind"], row["pollutant"],
+                     to_ts(row["datetime"]), to_float(row["value"])))
+    insert_measurements(con, rows)
+    set_position(con, filename, len(content), digest)
+    con.commit()
+
+    logging.info(f"Loaded {len(rows)} rows from {filename}")
+    return len(rows)
+
+
+def get_station_id(con: sqlite3.Connection, source: str, code: str,
+                   ptype: str = None, name: str = None,
+                   lat: float = None, lon: float = None) -> int:
+    # Ids are the ones of the registry, so they are the same in every
+    # build and can be joined with other data by the registry
+    registry.register(stations, source, code, ptype, name, lat, lon)
+    station = stations[(source, code)]
+    con.execute(
+        "INSERT OR REPLACE INTO stations "
+        + "(id, source, code, ptype, name, lat, lon) "
+        + "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        station
+    )
+    return station.id
+
+
+def insert_measurements(con: sqlite3.Connection, rows: list):
+    con.executemany(
+        "INSERT OR REPLACE INTO measurements "
+        + "(station_id, dtype, pollutant, ts, value) VALUES (?, ?, ?, ?, ?)",
+        rows
+    )
+
+
+def get_position(con: sqlite3.Connection, path: str) -> tuple:
+    row = con.execute("SELECT position, tail FROM loaded_files "
+                      + "WHERE path = ?", (path,)).fetchone()
+    return (row[0], row[1] or b"") if row else (0, b"")
+
+
+def set_position(con: sqlite3.Connection, path: str, position: int,
+                 tail: bytes = None):
+    con.execute("INSERT OR REPLACE INTO loaded_files (path, position, tail) "
+                + "VALUES (?, ?, ?)", (path, position, tail))
+
+
+def to_ts(dt: str, tz: timezone = MSK_TZ) -> int:
+    dt = datetime.fromisoformat(dt)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=tz)
+    return int(dt.timestamp())
+
+
+def to_float(value) -> float:
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+if __name__ == "__main__":
+    main()
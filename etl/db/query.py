@@ -0,0 +1,74 @@
+import os
+import sqlite3
+from collections import namedtuple
+from datetime import datetime, timezone
+
+
+DB_FILENAME = os.path.join("data", "db", "air.sqlite")
+
+Measurement = namedtuple("Measurement",
+    ["source", "station", "dtype", "datetime", "pollutant", "value"])
+
+Station = namedtuple("Station",
+    ["id", "source", "code", "ptype", "name", "lat", "lon"])
+
+
+def connect(filename: str = DB_FILENAME) -> sqlite3.Connection:
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"No database at {filename}, "
+            + "run etl/db/build.py first")
+    return sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+
+
+def stations(con: sqlite3.Connection, source: str = None) -> list:
+    query = "SELECT id, source, code, ptype, name, lat, lon FROM stations"
+    args = ()
+    if source is not None:
+        query += " WHERE source = ?"
+        args = (source,)
+    return [Station(*row) for row in con.execute(query + " ORDER BY id", args)]
+
+
+def measurements(con: sqlite3.Connection, pollutant: str = None,
+                 start: datetime = None, end: datetime = None,
+                 source: str = None, stations: list = None,
+                 dtype: str = None) -> list:
+    """Select measurements by pollutant, time range and stations
+
+    start is inclusive and end is exclusive, both must be tz-aware.
+    stations are codes as used by the source, e.g. "mgu" for Moscow.
+    """
+    conditions, args = [], []
+    if pollutant is not None:
+        conditions.append("m.pollutant = ?")
+        args.append(pollutant)
+    if dtype is not None:
+        conditions.append("m.dtype = ?")
+        args.append(dtype)
+    if start is not None:
+        conditions.append("m.ts >= ?")
+        args.append(int(start.timestamp()))
+    if end is not None:
+        conditions.append("m.ts < ?")
+        args.append(int(end.timestamp()))
+    if source is not None:
+        conditions.append("s.source = ?")
+        args.append(source)
+    if stations is not None:
+        conditions.append(
+            f"s.code IN ({', '.join('?' * len(stations))})")
+        args.extend(stations)
+
+    query = ("SELECT s.source, s.code, m.dtype, m.ts, m.pollutant, m.value "
+             + "FROM measurements m JOIN stations s ON s.id = m.station_id")
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY m.ts, s.source, s.code"
+
+    return [
+        Measurement(source, code, dtype,
+                    datetime.fromtimestamp(ts, tz=timezone.utc),
+                    pollutant, value)
+        for source, code, dtype, ts, pollutant, value
+        in con.execute(query, args)
+    ]
@@ -0,0 +1,317 @@
+import csv
+import json
+import logging
+import math
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+
+REGISTRY_FILENAME = os.path.join("data", "registry", "stations.csv")
+STATE_FILENAME = os.path.join("data", "registry", "state.json")
+
+Station = namedtuple("Station",
+    ["id", "source", "code", "ptype", "name", "lat", "lon"])
+
+Params = namedtuple("Params", [
+    "msk_raw_dir",
+    "spb_raw_dir",
+    "feerc_raw_dir",
+    "volga_raw_dir",
+    "tat_raw_dir",
+    "logs_dir",
+    "current_dt"
+])
+
+params = Params(
+    msk_raw_dir=os.path.join("data", "msk", "raw"),
+    spb_raw_dir=os.path.join("data", "spb", "raw"),
+    feerc_raw_dir=os.path.join("data", "feerc", "raw"),
+    volga_raw_dir=os.path.join("data", "volga", "raw"),
+    tat_raw_dir=os.path.join("data", "tat", "raw"),
+    logs_dir=os.path.join("logs", "db", "registry"),
+    current_dt=datetime.now(tz=timezone(timedelta(hours=3)))\
+            .isoformat(timespec="seconds"),
+)
+
+EARTH_RADIUS = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# Size of cells of the spatial index, degrees. Stations of one city
+# mostly share a cell, and cities rarely do
+CELL_SIZE = 0.5
+
+
+def main():
+    if not os.path.isdir(params.logs_dir):
+        os.makedirs(params.logs_dir)
+
+    logging.basicConfig(
+        filename=os.path.join(params.logs_dir,
+                              f"registry_{params.current_dt}.txt"),
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        level=logging.DEBUG
+    )
+
+    stations = {(station.source, station.code): station
+                for station in load()}
+    state = load_state()
+    found = {}
+    for source, read in (("msk", read_msk), ("spb", read_spb),
+                         ("feerc", read_feerc), ("volga", read_volga),
+                         ("tat", read_tat)):
+        found[source] = 0
+        for code, ptype, name, lat, lon in read(state):
+            register(stations, source, code, ptype, name, lat, lon)
+            found[source] += 1
+
+    save(sorted(stations.values()))
+    save_state(state)
+    logging.info(f"Read stations: {found}, {len(stations)} in registry")
+
+
+def load(filename: str = REGISTRY_FILENAME) -> list:
+    """Return all registered stations ordered by id"""
+    if not os.path.isfile(filename):
+        return []
+    with open(filename) as f:
+        return [
+            Station(int(row["id"]), row["source"], row["code"],
+                    row["ptype"] or None, row["name"] or None,
+                    to_float(row["lat"]), to_float(row["lon"]))
+            for row in csv.DictReader(f)
+        ]
+
+
+def save(stations: list, filename: str = REGISTRY_FILENAME):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + ".tmp", "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(Station._fields)
+        writer.writerows(stations)
+    os.replace(filename + ".tmp", filename)
+
+
+def register(stations: dict, source: str, code: str, ptype: str = None,
+             name: str = None, lat: float = None, lon: float = None):
+    # Ids are never reused or changed, so they stay the same across
+    # rebuilds. Metadata of later snapshots replaces the earlier one,
+    # missing values do not
+    key = (source, code)
+    station = stations.get(key)
+    if station is None:
+        new_id = max((station.id for station in stations.values()),
+                     default=0) + 1
+        stations[key] = Station(new_id, source, code, ptype, name, lat, lon)
+        return
+    stations[key] = station._replace(
+        ptype=ptype if ptype is not None else station.ptype,
+        name=name if name is not None else station.name,
+        lat=lat if lat is not None else station.lat,
+        lon=lon if lon is not None else station.lon
+    )
+
+
+def read_msk(state: dict):
+    # Points are only codes of their pages, without coordinates
+    filename = os.path.join(params.msk_raw_dir, "points.json")
+    if not os.path.isfile(filename):
+        return
+    with open(filename) as f:
+        points = json.load(f)
+    for ptype, pnames in points.items():
+        for pname in pnames:
+            yield pname, ptype, None, None, None
+
+
+def read_spb(state: dict):
+    # Stations are known by directories of their snapshots. The same
+    # ids are used by both types of stations
+    if not os.path.isdir(params.spb_raw_dir):
+        return
+    for stype in sorted(os.listdir(params.spb_raw_dir)):
+        stype_dir = os.path.join(params.spb_raw_dir, stype)
+        if not os.path.isdir(stype_dir):
+            continue
+        for sid in sorted(os.listdir(stype_dir), key=lambda sid: sid.zfill(4)):
+            if sid.isdigit():
+                yield f"{stype}/{sid}", stype, None, None, None
+
+
+def read_feerc(state: dict):
+    for data in read_new_snapshots("feerc", params.feerc_raw_dir, state):
+        for group in data.get("data", []):
+            for station in group.get("stations", []):
+                if station.get("ind"):
+                    yield (station["ind"], None, station.get("label"),
+                           to_float(station.get("lat")),
+                           to_float(station.get("lng")))
+
+
+def read_volga(state: dict):
+    for data in read_new_snapshots("volga", params.volga_raw_dir, state):
+        for station in data.values():
+            yield (str(station["id"]), None, station.get("address"),
+                   to_float(station.get("latitude")),
+                   to_float(station.get("longitude")))
+
+
+def read_tat(state: dict):
+    # Stations have no codes, so their names are used as ones, like
+    # in the database
+    for data in read_new_snapshots("tat", params.tat_raw_dir, state):
+        for placemark in data:
+            content = placemark.get("content") or ""
+            start, end = content.find("<b>"), content.find("</b>")
+            if start < 0 or end < start:
+                continue
+            name = " ".join(content[start + 3:end].split())
+            coords = placemark.get("coords") or {}
+            yield (name, None, name, to_float(coords.get("lat")),
+                   to_float(coords.get("lon")))
+
+
+def read_new_snapshots(source: str, dirname: str, state: dict):
+    # Names of snapshots are dates or timestamps, so the ones after the
+    # last read snapshot are new
+    filenames = []
+    for path, _, names in os.walk(dirname):
+        filenames.extend(os.path.join(path, name)
+                         for name in names if name.endswith(".json"))
+    last = state.get(source)
+    for filename in sorted(filenames, key=os.path.basename):
+        if last is not None and os.path.basename(filename) <= last:
+            continue
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except ValueError:
+            logging.error(f"Cannot read {filename}")
+            continue
+        yield data
+        state[source] = os.path.basename(filename)
+
+
+def load_state() -> dict:
+    if not os.path.isfile(STATE_FILENAME):
+        return {}
+    try:
+        with open(STATE_FILENAME) as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning(f"Cannot read state from {STATE_FILENAME}")
+        return {}
+
+
+def save_state(state: dict):
+    with open(STATE_FILENAME + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(STATE_FILENAME + ".tmp", STATE_FILENAME)
+
+
+class SpatialIndex:
+    """Grid of stations with coordinates for nearest and radius queries
+
+    Stations are put to cells of CELL_SIZE degrees, so a query checks
+    only the cells around a point instead of all stations.
+    """
+    def __init__(self, stations: list, cell_size: float = CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        for station in stations:
+            if station.lat is None or station.lon is None:
+                continue
+            self.cells.setdefault(self.cell(station.lat, station.lon), [])\
+                .append(station)
+
+    def cell(self, lat: float, lon: float) -> tuple:
+        return (math.floor(lat / self.cell_size),
+                math.floor(lon / self.cell_size))
+
+    def nearest(self, lat: float, lon: float, k: int = 1,
+                source: str = None) -> list:
+        """Return up to k (distance in km, station) pairs, nearest first"""
+        if not self.cells:
+            return []
+        row, col = self.cell(lat, lon)
+        max_ring = max(max(abs(i - row), abs(j - col))
+                       for i, j in self.cells)
+        found = []
+        for ring in range(max_ring + 1):
+            for cell in ring_cells(row, col, ring):
+                for station in self.cells.get(cell, ()):
+                    if source is None or station.source == source:
+                        found.append((distance_km(lat, lon, station.lat,
+                                                  station.lon), station))
+            # Stations outside the rings are at least ring cells away
+            # from the cell of the point in latitude or in longitude
+            if len(found) >= k:
+                found.sort(key=lambda item: item[0])
+                if found[k - 1][0] <= self.ring_bound(lat, ring):
+                    break
+        found.sort(key=lambda item: item[0])
+        return found[:k]
+
+    def within(self, lat: float, lon: float, radius: float,
+               source: str = None) -> list:
+        """Return (distance in km, station) pairs within radius km,
+        nearest first"""
+        lat_cells = math.ceil(radius / KM_PER_DEGREE / self.cell_size)
+        lon_cells = math.ceil(radius / (KM_PER_DEGREE * max_cos(lat, radius))
+                              / self.cell_size)
+        row, col = self.cell(lat, lon)
+        found = []
+        for i in range(row - lat_cells, row + lat_cells + 1):
+            for j in range(col - lon_cells, col + lon_cells + 1):
+                for station in self.cells.get((i, j), ()):
+                    if source is not None and station.source != source:
+                        continue
+                    distance = distance_km(lat, lon, station.lat, station.lon)
+                    if distance <= radius:
+                        found.append((distance, station))
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def ring_bound(self, lat: float, ring: int) -> float:
+        degrees = ring * self.cell_size
+        return degrees * KM_PER_DEGREE \
+            * max_cos(lat, (ring + 1) * self.cell_size * KM_PER_DEGREE)
+
+
+def ring_cells(row: int, col: int, ring: int):
+    if ring == 0:
+        yield row, col
+        return
+    for j in range(col - ring, col + ring + 1):
+        yield row - ring, j
+        yield row + ring, j
+    for i in range(row - ring + 1, row + ring):
+        yield i, col - ring
+        yield i, col + ring
+
+
+def max_cos(lat: float, distance: float) -> float:
+    # The smallest cosine of latitudes within distance km of lat, so
+    # that a degree of longitude is not taken longer than it is
+    farthest = min(abs(lat) + distance / KM_PER_DEGREE, 89.0)
+    return math.cos(math.radians(farthest))
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 \
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def to_float(value) -> float:
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
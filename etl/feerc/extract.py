@@ -1,17 +1,23 @@
 import json
 import logging
 import os
+import sys
 from collections import Counter
 from datetime import datetime, timedelta, timezone
 from urllib.error import HTTPError, URLError
 from urllib.parse import urlencode
-from urllib.request import urlopen
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+import http_client
+from metrics import Metrics
 
 
 base_url = "http://www.feerc.ru/uisem/portal/ad/services/getData.php"
 out_dir = os.path.join("data", "feerc", "raw")
 timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
             .isoformat(timespec="seconds")
+client = http_client.Client(timeout=120)
 
 logs_dir = os.path.join("logs", "feerc", "extract")
 if not os.path.isdir(logs_dir):
@@ -21,16 +27,27 @@ logging.basicConfig(
     format="[%(asctime)s] %(levelname)s: %(message)s",
     level=logging.DEBUG
 )
+metrics = Metrics("feerc", "extract",
+                  os.path.join(logs_dir, f"extract_{timestamp}.json"))
 
 def main():
-    data = get_raw_data()
+    with metrics.stage("fetch"):
+        data = get_raw_data()
+    client.log_stats()
+    metrics.add_http("http", client)
     if not data:
+        metrics.add("fetch", errors=1)
+        metrics.save()
         return
     try:
-        save_raw_data(data)
+        with metrics.stage("save"):
+            save_raw_data(data)
+        metrics.add("save", files_written=1)
     except BaseException as e:
         logging.critical("Cannot save data")
         logging.critical(str(e))
+        metrics.add("save", errors=1)
+    metrics.save()
 
 def get_raw_data():
     params = {
@@ -40,8 +57,7 @@ def get_raw_data():
     params_str = urlencode(params)
     url = f"{base_url}?{params_str}"
     try:
-        with urlopen(url) as con:
-            content = con.read().decode()
+        content = client.get(url).content.decode()
     except HTTPError as e:
         logging.critical(f"Cannot get data from {url}")
         logging.critical(f"Error code {e.code}: {e.reason}")
@@ -68,6 +84,7 @@ def get_raw_data():
                 st_name = station.get("name", "").split("(")[0]
                 stations.append(st_name)
         counts = Counter(stations)
+        metrics.add("fetch", rows_parsed=len(stations))
         counts_str = "; ".join([f"{city} — {n}"
                                 for city, n in sorted(counts.items())])
         logging.info(f"Extracted data for stations in cities: {counts_str}")
@@ -1,18 +1,30 @@
+import argparse
 import json
 import logging
 import os
+import random
+import sys
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, datetime, timedelta, timezone
-from time import sleep
+from threading import Lock
+from time import monotonic, sleep
 from urllib.error import HTTPError, URLError
 from urllib.parse import urlencode
-from urllib.request import urlopen
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+import http_client
+from metrics import Metrics
 
 
 base_url = "http://www.feerc.ru/uisem/portal/ad/services/getData.php"
 out_dir = os.path.join("data", "feerc", "raw", "history_before_2022-07-15")
 timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
             .isoformat(timespec="seconds")
+# Failed dates are retried by backfill_date, after the rate limiter,
+# so the client itself does not retry
+client = http_client.Client(timeout=120, retries=0, pool_size=16)
 
 logs_dir = os.path.join("logs", "feerc", "extract")
 if not os.path.isdir(logs_dir):
@@ -23,22 +35,157 @@ logging.basicConfig(
     level=logging.DEBUG
 )
 
+metrics = Metrics("feerc", "extract_history", os.path.join(
+    logs_dir, f"extract_history_before_2022-07-15_{timestamp}.json"))
+
+# Dates for which the portal returned no data, so they are not
+# requested again when the backfill is restarted (unless --retry-empty)
+checkpoint_filename = os.path.join(logs_dir,
+                                   "history_before_2022-07-15_checkpoint.json")
+
+parser = argparse.ArgumentParser(
+    description="Backfill weekly history of FEERC data")
+parser.add_argument("--workers",
+    type=int,
+    default=4,
+    help="Number of dates requested concurrently"
+    )
+parser.add_argument("--rate",
+    type=float,
+    default=1,
+    help="Max number of requests per second (0 for no limit)"
+    )
+parser.add_argument("--retries",
+    type=int,
+    default=4,
+    help="Number of retries of a failed date"
+    )
+parser.add_argument("--backoff",
+    type=float,
+    default=5,
+    help="Delay before the first retry in seconds, doubled on every retry "
+        + "and randomly shortened by up to a half"
+    )
+parser.add_argument("--retry-empty",
+    action="store_true",
+    help="Request again dates for which the portal returned no data"
+    )
+
+class RateLimiter:
+    """Spread requests at least 1 / rate seconds apart"""
+    def __init__(self, rate):
+        self._interval = 1 / rate if rate > 0 else 0
+        self._next_slot = monotonic()
+        self._lock = Lock()
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            sleep(slot - now)
+
 def main():
+    args = parser.parse_args()
     start_date = date(2012, 1, 7)
     step = timedelta(days=7)
     end_date = date(2022, 7, 15)
+
+    no_data = load_checkpoint()
+    dates = []
     request_date = start_date
     while request_date < end_date:
+        if not os.path.isfile(raw_filename(request_date)) \
+                and (args.retry_empty
+                     or request_date.isoformat() not in no_data):
+            dates.append(request_date)
+        request_date += step
+    logging.info(f"Backfilling {len(dates)} dates with {args.workers} "
+        + f"workers and rate limit {args.rate or 'none'}")
+    if args.retry_empty:
+        logging.info(f"Retrying {len(no_data)} dates without data")
+
+    rate_limiter = RateLimiter(args.rate)
+    failed = []
+    with metrics.stage("backfill"), \
+            ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        futures = {
+            executor.submit(backfill_date, request_date, rate_limiter,
+                            args.retries, args.backoff): request_date
+            for request_date in dates
+        }
+        # The checkpoint is saved by this thread only, after each date
+        for future in as_completed(futures):
+            request_date = futures[future]
+            res = future.result()
+            if res is None:
+                failed.append(request_date)
+                metrics.add("backfill", errors=1)
+            elif not res:
+                print(f"No data for {request_date.strftime('%d.%m.%Y')}")
+                no_data.add(request_date.isoformat())
+                save_checkpoint(no_data)
+                metrics.add("backfill", files_skipped=1)
+            else:
+                metrics.add("backfill", files_written=1)
+                if request_date.isoformat() in no_data:
+                    logging.info(f"Got data for {request_date} which "
+                        + "had no data before")
+                    no_data.discard(request_date.isoformat())
+                    save_checkpoint(no_data)
+
+    if failed:
+        logging.error(f"Failed to get data for {len(failed)} dates: "
+            + ", ".join(d.isoformat() for d in sorted(failed)))
+    logging.info(f"Backfill finished: {len(dates) - len(failed)} dates "
+        + f"done, {len(failed)} failed")
+    client.log_stats()
+    metrics.add_http("http", client)
+    metrics.save()
+
+def backfill_date(request_date, rate_limiter, retries, backoff):
+    """Get and save data on a date, retrying failed requests
+
+    Returns True if data was saved, False if there is no data on the
+    date, and None if all attempts failed.
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            # Jitter keeps failed dates of concurrent workers from
+            # being retried all at once
+            delay = random.uniform(0.5, 1) * backoff * 2 ** (attempt - 1)
+            logging.info(f"Retrying {request_date} in {delay:.0f} s")
+            sleep(delay)
+        rate_limiter.wait()
         data = get_raw_data(request_date)
-        if not data:
-            print(f"No data for {request_date.strftime('%d.%m.%Y')}")
+        if data is None:
             continue
+        if not data["data"]:
+            return False
         try:
             save_raw_data(data, request_date)
+            return True
         except BaseException as e:
             logging.critical("Cannot save data")
             logging.critical(str(e))
-        request_date += step
+            return None
+    return None
+
+def load_checkpoint():
+    try:
+        with open(checkpoint_filename) as f:
+            return set(json.load(f)["no_data"])
+    except (OSError, ValueError, KeyError):
+        return set()
+
+def save_checkpoint(no_data):
+    tmp_filename = checkpoint_filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump({"no_data": sorted(no_data)}, f, indent=2)
+    os.replace(tmp_filename, checkpoint_filename)
 
 def get_raw_data(request_date):
     request_date = request_date.strftime("%d.%m.%Y")
@@ -50,8 +197,7 @@ def get_raw_data(request_date):
     params_str = urlencode(params)
     url = f"{base_url}?{params_str}"
     try:
-        with urlopen(url) as con:
-            response = con.read().decode()
+        response = client.get(url).content.decode()
     except HTTPError as e:
         logging.error(f"Cannot get data from {url}")
         logging.error(f"Error code {e.code}: {e.reason}")
@@ -69,7 +215,7 @@ def get_raw_data(request_date):
 
     if not response:
         logging.error("No data")
-        return None
+        return {"data": []}
 
     data = {}
     status = response.get("status", 0)
@@ -99,7 +245,6 @@ def get_raw_data(request_date):
                             for city, n in sorted(count.items())])
     logging.info(f"Extracted data for stations in cities: {counts_str}")
 
-    sleep(5)
     return data
 
 def save_raw_data(data, request_date):
@@ -108,11 +253,17 @@ def save_raw_data(data, request_date):
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
-    file_date = request_date.isoformat()
-    filename = os.path.join(out_dir, f"{file_date}.json")
-    with open(filename, "w") as f:
+    # Written under a temporary name, so a crash never leaves a partial
+    # file which would be skipped as done
+    filename = raw_filename(request_date)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
         json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_filename, filename)
     logging.info(f"Data saved to {filename}")
 
+def raw_filename(request_date):
+    return os.path.join(out_dir, f"{request_date.isoformat()}.json")
+
 if __name__ == "__main__":
     main()
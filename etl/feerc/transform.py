@@ -0,0 +1,244 @@
+import ast
+import csv
+import gc
+import json
+import logging
+import os
+import re
+import sys
+from datetime import date, datetime, timedelta, timezone
+from operator import itemgetter
+from time import perf_counter
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+from metrics import Metrics
+
+
+raw_dir = os.path.join("data", "feerc", "raw")
+out_dir = os.path.join("data", "feerc", "product")
+timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
+            .isoformat(timespec="seconds")
+
+# FEERC uses this value for missing measurements
+MISSING = -32768
+
+# Strings and Python constants of a repr. Strings are matched first,
+# so "None" inside a name is not replaced
+REPR_TOKEN_REGEX = re.compile(
+    r""""(?:[^"\\]|\\.)*"|'((?:[^'\\]|\\.)*)'|\b(None|True|False)\b""")
+REPR_CONSTANTS = {"None": "null", "True": "true", "False": "false"}
+
+logs_dir = os.path.join("logs", "feerc", "transform")
+if not os.path.isdir(logs_dir):
+    os.makedirs(logs_dir)
+logging.basicConfig(
+    filename=os.path.join(logs_dir, f"transform_{timestamp}.txt"),
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    level=logging.DEBUG
+)
+
+def main():
+    started = perf_counter()
+    metrics = Metrics("feerc", "transform",
+                      os.path.join(logs_dir, f"transform_{timestamp}.json"))
+    filenames = list_raw_files()
+    pollution, meteo, stations = Table(), Table(), {}
+    # Decoded files make millions of small objects without reference
+    # cycles, and collecting them takes as long as reading itself
+    gc.disable()
+    try:
+        with metrics.stage("read"):
+            for filename in filenames:
+                try:
+                    with open(filename) as f:
+                        data = json.load(f)
+                except ValueError:
+                    logging.error(f"Cannot read {filename}")
+                    metrics.add("read", errors=1)
+                    continue
+                metrics.add("read", files_read=1)
+                read_stations(data, pollution, meteo, stations)
+    finally:
+        gc.enable()
+    metrics.add("read", rows_parsed=len(pollution.rows) + len(meteo.rows))
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    with metrics.stage("write"):
+        counts = {
+            "daily": write_table("daily", pollution),
+            "meteo": write_table("meteo", meteo),
+            "stations": write_stations(stations)
+        }
+    metrics.add("write", rows_written=sum(counts.values()))
+    if pa is None:
+        logging.warning("pyarrow is not installed, Parquet tables "
+                        + "are not written")
+    logging.info(f"Transformed {len(filenames)} files in "
+                 + f"{perf_counter() - started:.2f} s: {counts} rows")
+    metrics.save()
+
+def list_raw_files():
+    # Names are dates or timestamps, so later snapshots go last and
+    # their values replace the ones stored earlier
+    filenames = []
+    for dirname, _, names in os.walk(raw_dir):
+        filenames.extend(os.path.join(dirname, name)
+                         for name in names if name.endswith(".json"))
+    return sorted(filenames, key=os.path.basename)
+
+def read_stations(data, pollution, meteo, stations):
+    for group in data.get("data", []):
+        for station in group.get("stations", []):
+            ind = station.get("ind")
+            if not ind:
+                continue
+            stations[ind] = [
+                station.get("name"),
+                station.get("label"),
+                to_float(station.get("lat")),
+                to_float(station.get("lng"))
+            ]
+
+            names = [item.get("name") for item in decode(station.get("si"))]
+            pollution.read_history(ind, names,
+                                   decode(station.get("primsSS")),
+                                   date_only=True)
+            names = [name.strip('"') for name
+                     in decode(station.get("meteoParamsNames"))]
+            meteo.read_history(ind, names,
+                               decode(station.get("meteoParamsValues")))
+
+class Table:
+    """Values by station and datetime, one column per pollutant or meteo
+    parameter
+
+    vals are kept as they are together with the names of their
+    positions, and are mapped to columns only once, when the table is
+    written. Values of later snapshots replace the ones of earlier
+    snapshots for the same station and datetime, unless they are missing.
+    """
+    def __init__(self):
+        self.rows = {}
+        self.layouts = set()
+
+    def read_history(self, ind, names, history, date_only=False):
+        names = tuple(names)
+        self.layouts.add(names)
+        for item in history:
+            dt, vals = item.get("dt"), item.get("vals")
+            if not dt or not vals:
+                continue
+            dt = dt[:10] if date_only else dt.replace("_", "T")
+            self.rows.setdefault((ind, dt), []).append((names, vals))
+
+    def to_columns(self):
+        """Return the names of non-empty columns and the columns"""
+        names = sorted(set().union(*self.layouts))
+        getters = {}
+        rows = []
+        for (ind, dt), items in sorted(self.rows.items()):
+            line = None
+            for layout, vals in items:
+                getter = getters.get(layout)
+                if getter is None:
+                    getter = getters[layout] = make_getter(layout, names)
+                if len(vals) < len(layout):
+                    vals = vals + [None] * (len(layout) - len(vals))
+                if MISSING in vals:
+                    vals = [None if value == MISSING else value
+                            for value in vals]
+                values = getter(vals + [None])[:-1]
+                if line is not None:
+                    values = tuple(new if new is not None else old
+                                   for old, new in zip(line, values))
+                line = values
+            rows.append((ind, dt) + line)
+
+        columns = list(zip(*rows)) or [()] * (len(names) + 2)
+        keep = [i for i, column in enumerate(columns[2:], 2)
+                if column.count(None) < len(column)]
+        return ([names[i - 2] for i in keep],
+                columns[:2] + [columns[i] for i in keep])
+
+def make_getter(layout, names):
+    # vals are not named, their positions coincide with the names of
+    # the layout. Columns missing in the layout get the None appended
+    # to vals, and extra vals without a name are dropped. The last item
+    # makes the getter return a tuple even for one column
+    positions = {}
+    for i, name in enumerate(layout):
+        positions.setdefault(name, i)
+    return itemgetter(*(positions.get(name, -1) for name in names), -1)
+
+def decode(value):
+    """Decode a nested value which may be stored as a Python repr
+
+    The repr is translated to JSON with one regex pass, which is much
+    faster than ast.literal_eval. Strings with escapes are left to
+    ast.literal_eval.
+    """
+    if not isinstance(value, str):
+        return value or []
+    if "\\" in value:
+        return ast.literal_eval(value)
+    return json.loads(REPR_TOKEN_REGEX.sub(repr_token_to_json, value))
+
+def repr_token_to_json(match):
+    quoted, constant = match.groups()
+    if constant is not None:
+        return REPR_CONSTANTS[constant]
+    if quoted is not None:
+        return json.dumps(quoted, ensure_ascii=False)
+    return match.group(0)
+
+def write_table(name, table):
+    # One row per station and datetime, one column per pollutant or
+    # meteo parameter, like wide tables for Moscow
+    names, columns = table.to_columns()
+    header = ["station", "date" if name == "daily" else "datetime"] + names
+
+    with open(os.path.join(out_dir, f"{name}.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(zip(*columns))
+
+    if pa is not None:
+        arrays = [pa.array(columns[0], type=pa.string()).dictionary_encode()]
+        if name == "daily":
+            arrays.append(pa.array(map(date.fromisoformat, columns[1]),
+                                   type=pa.date32()))
+        else:
+            arrays.append(pa.array(columns[1], type=pa.string()))
+        arrays += [pa.array(column, type=pa.float64())
+                   for column in columns[2:]]
+        pq.write_table(pa.table(arrays, names=header),
+                       os.path.join(out_dir, f"{name}.parquet"),
+                       compression="zstd")
+
+    logging.info(f"Saved {len(columns[0])} rows to {name} table")
+    return len(columns[0])
+
+def write_stations(stations):
+    with open(os.path.join(out_dir, "stations.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["station", "name", "label", "lat", "lon"])
+        for ind, info in sorted(stations.items()):
+            writer.writerow([ind] + info)
+    return len(stations)
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+if __name__ == "__main__":
+    main()
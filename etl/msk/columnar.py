@@ -0,0 +1,141 @@
+import os
+import shutil
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+COLUMNAR_DIR = os.path.join("data", "msk", "columnar")
+MSK = timezone(timedelta(hours=3))
+
+# Partitions are <dtype>/ptype=<ptype>/station=<pname>/month=<YYYY-MM>
+PARTITION_FILENAME = "data.parquet"
+
+
+def is_available() -> bool:
+    return pa is not None
+
+
+def schema(ptype: str) -> "pa.Schema":
+    if ptype == "profilers":
+        return pa.schema([
+            ("timestamp", pa.int64()),
+            ("height", pa.int16()),
+            ("temperature", pa.float32())
+        ])
+    return pa.schema([
+        ("timestamp", pa.int64()),
+        ("pollutant", pa.dictionary(pa.int8(), pa.string())),
+        ("concentration", pa.float32())
+    ])
+
+
+def point_dir(ptype: str, pname: str, dtype: str,
+              base_dir: str = COLUMNAR_DIR) -> str:
+    return os.path.join(base_dir, dtype, f"ptype={ptype}", f"station={pname}")
+
+
+def has_point(ptype: str, pname: str, dtype: str,
+              base_dir: str = COLUMNAR_DIR) -> bool:
+    return os.path.isdir(point_dir(ptype, pname, dtype, base_dir))
+
+
+def remove_point(ptype: str, pname: str, dtype: str,
+                 base_dir: str = COLUMNAR_DIR):
+    path = point_dir(ptype, pname, dtype, base_dir)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def append_rows(ptype: str, pname: str, dtype: str, rows,
+                base_dir: str = COLUMNAR_DIR) -> int:
+    """Append time-sorted rows to the monthly partitions of a point
+
+    Rows may come either parsed from JSON or read back from CSV. They
+    are consumed month by month, so only one month is kept in memory.
+    Returns the number of rows written.
+    """
+    rows_count = 0
+    for month, month_rows in groupby(rows, key=lambda row: row[0][:7]):
+        table = make_table(ptype, list(month_rows))
+        path = os.path.join(point_dir(ptype, pname, dtype, base_dir),
+                            f"month={month}")
+        filename = os.path.join(path, PARTITION_FILENAME)
+        if os.path.isfile(filename):
+            table = pa.concat_tables([pq.read_table(filename), table])
+        else:
+            os.makedirs(path, exist_ok=True)
+        pq.write_table(table, filename, compression="zstd")
+        rows_count += table.num_rows
+    return rows_count
+
+
+def make_table(ptype: str, rows: list) -> "pa.Table":
+    fields = schema(ptype)
+    timestamps = pa.array(
+        [int(datetime.fromisoformat(row[0]).timestamp()) for row in rows],
+        type=fields.field("timestamp").type
+    )
+    if ptype == "profilers":
+        arrays = [
+            timestamps,
+            pa.array([to_number(row[1], int) for row in rows],
+                     type=fields.field("height").type),
+            pa.array([to_number(row[2], float) for row in rows],
+                     type=fields.field("temperature").type)
+        ]
+    else:
+        arrays = [
+            timestamps,
+            pa.array([row[1] for row in rows],
+                     type=fields.field("pollutant").type),
+            pa.array([to_number(row[2], float) for row in rows],
+                     type=fields.field("concentration").type)
+        ]
+    return pa.Table.from_arrays(arrays, schema=fields)
+
+
+def to_number(value, type_):
+    if value is None or value == "":
+        return None
+    return type_(value)
+
+
+def load(dtype: str, start: datetime = None, end: datetime = None,
+         ptype: str = None, stations: list = None, pollutants: list = None,
+         base_dir: str = COLUMNAR_DIR) -> "pa.Table":
+    """Load measurements from the columnar store
+
+    Time bounds are tz-aware datetimes, start inclusive and end
+    exclusive. Only partitions of matching months, point types and
+    stations are read.
+    """
+    dataset = ds.dataset(os.path.join(base_dir, dtype),
+                         format="parquet", partitioning="hive")
+    conditions = []
+    # Months of partitions are in Moscow time, as datetimes in raw data
+    if start is not None:
+        month = start.astimezone(MSK).strftime("%Y-%m")
+        conditions.append(ds.field("month") >= month)
+        conditions.append(ds.field("timestamp") >= int(start.timestamp()))
+    if end is not None:
+        month = end.astimezone(MSK).strftime("%Y-%m")
+        conditions.append(ds.field("month") <= month)
+        conditions.append(ds.field("timestamp") < int(end.timestamp()))
+    if ptype is not None:
+        conditions.append(ds.field("ptype") == ptype)
+    if stations is not None:
+        conditions.append(ds.field("station").isin(stations))
+    if pollutants is not None:
+        conditions.append(ds.field("pollutant").isin(pollutants))
+
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+    return dataset.to_table(filter=condition)
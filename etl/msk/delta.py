@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+
+DELTA_SUFFIX = ".delta.json"
+
+# A full snapshot is saved after this number of deltas in a row, so
+# that rebuilding a snapshot never replays too many files
+KEYFRAME_INTERVAL = 30
+
+
+def is_delta(filename: str) -> bool:
+    return filename.endswith(DELTA_SUFFIX)
+
+
+def snapshot_dt(filename: str) -> datetime:
+    if is_delta(filename):
+        stem = filename[:-len(DELTA_SUFFIX)]
+    else:
+        stem, _ = os.path.splitext(filename)
+    return datetime.fromisoformat(stem.rsplit("_", maxsplit=1)[1])
+
+
+def list_snapshots(dirname: str) -> list:
+    filenames = [filename for filename in os.listdir(dirname)
+                 if filename.endswith(".json")]
+    return sorted(filenames, key=snapshot_dt)
+
+
+def save(dirname: str, pname: str, timestamp: str, snapshot: dict) -> str:
+    """Save a snapshot as a delta to the previous one, or in full
+
+    A full snapshot is written if there are no previous snapshots or
+    if the chain of deltas is already KEYFRAME_INTERVAL long.
+    Returns the name of the saved file.
+    """
+    snapshots = list_snapshots(dirname) if os.path.isdir(dirname) else []
+    base = snapshots[-1] if snapshots else None
+    if base is not None:
+        with open(os.path.join(dirname, base)) as f:
+            depth = json.load(f).get("depth", 0)
+    if base is None or depth + 1 >= KEYFRAME_INTERVAL:
+        filename = os.path.join(dirname, f"{pname}_{timestamp}.json")
+        content = snapshot
+    else:
+        filename = os.path.join(dirname, f"{pname}_{timestamp}{DELTA_SUFFIX}")
+        content = make_delta(load(dirname, base), snapshot)
+        content["base"] = base
+        content["depth"] = depth + 1
+
+    with open(filename, "w") as f:
+        json.dump(content, f)
+    return filename
+
+
+def load(dirname: str, filename: str) -> dict:
+    """Rebuild a snapshot, full or delta, exactly as it was extracted"""
+    chain = []
+    while True:
+        with open(os.path.join(dirname, filename)) as f:
+            content = json.load(f)
+        if not is_delta(filename):
+            break
+        chain.append(content)
+        filename = content["base"]
+
+    snapshot = content
+    for delta in reversed(chain):
+        snapshot = apply_delta(snapshot, delta)
+    return snapshot
+
+
+def make_delta(previous: dict, current: dict) -> dict:
+    delta = {key: value for key, value in current.items() if key != "data"}
+    previous_data, current_data = previous.get("data"), current.get("data")
+    if isinstance(current_data, dict):
+        previous_data = previous_data if isinstance(previous_data, dict) \
+            else {}
+        delta["data"] = {
+            dtype: make_series_delta(previous_data.get(dtype), rows)
+            for dtype, rows in current_data.items()
+        }
+    else:
+        delta["data"] = make_series_delta(
+            previous_data if isinstance(previous_data, list) else None,
+            current_data)
+    return delta
+
+
+def make_series_delta(previous: list, current: list) -> dict:
+    # Rows are keyed by datetime and pollutant (or height), and the
+    # last field is the value
+    if current is None:
+        return None
+    previous_values = {tuple(row[:-1]): row[-1] for row in previous or []}
+    current_keys = set()
+    added, revised = [], []
+    for row in current:
+        key = tuple(row[:-1])
+        current_keys.add(key)
+        if key not in previous_values:
+            added.append(row)
+        elif previous_values[key] != row[-1]:
+            revised.append(row)
+
+    # The site shows a sliding window, so rows older than the window
+    # are removed by one cut-off datetime instead of listing them all.
+    # Rows without a datetime are always listed
+    removed_before = min((row[0] for row in current if row[0] is not None),
+                         default=None)
+    return {
+        "added": added,
+        "revised": revised,
+        "removed_before": removed_before,
+        "removed": [list(key) for key in previous_values
+                    if key not in current_keys
+                    and not is_before(key[0], removed_before)],
+        "order": series_order(current)
+    }
+
+
+def series_order(rows: list) -> list:
+    # Pollution rows are grouped by pollutant in the order of the site,
+    # so this order is kept to restore the snapshot as it was. Profiler
+    # rows are just sorted by datetime and height
+    if not rows or not isinstance(rows[0][1], str):
+        return []
+    return list(dict.fromkeys(row[1] for row in rows))
+
+
+def apply_delta(previous: dict, delta: dict) -> dict:
+    snapshot = {key: value for key, value in delta.items()
+                if key not in ("data", "base", "depth")}
+    previous_data, delta_data = previous.get("data"), delta.get("data")
+    if delta_data is None or "added" in delta_data:
+        snapshot["data"] = apply_series_delta(
+            previous_data if isinstance(previous_data, list) else None,
+            delta_data)
+    else:
+        previous_data = previous_data if isinstance(previous_data, dict) \
+            else {}
+        snapshot["data"] = {
+            dtype: apply_series_delta(previous_data.get(dtype), series)
+            for dtype, series in delta_data.items()
+        }
+    return snapshot
+
+
+def apply_series_delta(previous: list, delta: dict) -> list:
+    if delta is None:
+        return None
+    removed_before = delta["removed_before"]
+    rows = {
+        tuple(row[:-1]): row for row in previous or []
+        if not is_before(row[0], removed_before)
+    }
+    for key in delta["removed"]:
+        rows.pop(tuple(key), None)
+    for row in delta["added"] + delta["revised"]:
+        rows[tuple(row[:-1])] = row
+
+    order = {pollutant: i for i, pollutant in enumerate(delta["order"])}
+    if order:
+        key = lambda row: (order[row[1]],) + none_first(row[:1])
+    else:
+        key = lambda row: none_first(row[:-1])
+    return sorted(rows.values(), key=key)
+
+
+def is_before(dt: str, removed_before: str) -> bool:
+    return dt is not None and removed_before is not None \
+        and dt < removed_before
+
+
+def none_first(values: list) -> tuple:
+    # Missing datetimes or heights cannot be compared with other values,
+    # so they are sorted before them
+    return tuple((value is not None, value) for value in values)
+
+
+def compact(dirname: str) -> int:
+    """Replace full snapshots of a point with deltas, keeping keyframes
+
+    Returns the number of converted snapshots.
+    """
+    converted = 0
+    previous, base, depth = None, None, 0
+    for filename in list_snapshots(dirname):
+        snapshot = load(dirname, filename)
+        if is_delta(filename):
+            depth += 1
+        elif previous is None or depth + 1 >= KEYFRAME_INTERVAL:
+            depth = 0
+        else:
+            content = make_delta(previous, snapshot)
+            content["base"] = base
+            content["depth"] = depth + 1
+            stem, _ = os.path.splitext(filename)
+            delta_filename = stem + DELTA_SUFFIX
+            with open(os.path.join(dirname, delta_filename), "w") as f:
+                json.dump(content, f)
+            os.remove(os.path.join(dirname, filename))
+            filename = delta_filename
+            depth += 1
+            converted += 1
+        previous, base = snapshot, filename
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert stored Moscow snapshots to deltas")
+    parser.add_argument("dirs",
+        nargs="+",
+        help="Directories of points, e.g. data/msk/raw/stations/mgu"
+        )
+    args = parser.parse_args()
+
+    for dirname in args.dirs:
+        converted = compact(dirname)
+        print(f"{dirname}: {converted} snapshots converted to deltas")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,22 @@
 import argparse
 import logging
+import sys
 from collections import namedtuple
-from json import load, loads, dump
+from concurrent.futures import ThreadPoolExecutor
+from json import load, loads, dump, dumps
 from datetime import datetime, timedelta, timezone
-from os import makedirs
-from os.path import isdir, join
-from time import sleep
-from urllib.request import Request, urlopen
+from os import makedirs, pardir
+from os.path import abspath, dirname, isdir, join
+from threading import Event, Lock
+from time import monotonic, perf_counter, sleep
+from urllib.parse import quote, urlparse
+from zlib import crc32
+
+import delta
+
+sys.path.append(join(dirname(abspath(__file__)), pardir, "common"))
+import http_client
+from metrics import Metrics
 
 
 Params = namedtuple("Params", [
@@ -42,43 +52,126 @@ parser.add_argument("--apikey",
     help="API key to call cloud function on Yandex Cloud",
     required=True
     )
+parser.add_argument("--workers",
+    type=int,
+    default=1,
+    help="Number of points to extract concurrently"
+    )
+parser.add_argument("--rate",
+    type=float,
+    default=0,
+    help="Max number of requests per second to one host (0 for no limit)"
+    )
+parser.add_argument("--timeout",
+    type=float,
+    default=120,
+    help="Timeout of a single request in seconds"
+    )
+parser.add_argument("--batch",
+    type=int,
+    default=1,
+    help="Number of points requested in one call of the cloud function "
+        + "(1 for one call per point)"
+    )
+parser.add_argument("--compact",
+    action="store_true",
+    help="Request pollution data as compact series (see expand_compact)"
+    )
+parser.add_argument("--delta",
+    action="store_true",
+    help="Save snapshots as deltas to the previous ones (see delta.py)"
+    )
+parser.add_argument("--since",
+    action="store_true",
+    help="Request only pollution data newer than the previous snapshot "
+        + "of a point (see merge_since)"
+    )
 args = parser.parse_args()
 
 
+class RateLimiter:
+    """Spread requests to the same host at least 1 / rate seconds apart"""
+    def __init__(self, rate: float):
+        self._interval = 1 / rate if rate > 0 else 0
+        self._next_slot = {}
+        self._lock = Lock()
+
+    def wait(self, url: str):
+        if not self._interval:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self._interval
+        if slot > now:
+            sleep(slot - now)
+
+
+MSK_TZ = timezone(timedelta(hours=3))
+
+rate_limiter = RateLimiter(args.rate)
+# Shared by the workers, so requests to the same function reuse open
+# connections
+client = http_client.Client(
+    timeout=args.timeout,
+    pool_size=max(args.workers, 1),
+    headers={"Authorization": f"Api-Key {args.apikey}"}
+    )
+metrics = Metrics("msk", "extract",
+                  join(params.logs_dir, f"extract_{params.current_dt}.json"))
+# Set when the deployed scrape function turns out to know only single
+# points, so the rest of the batches are extracted point by point
+no_batch = Event()
+
+
 def main():
-    points = get_points()
-    if not points:
-        points = load_previous_points()
-    else:
-        save_points(points)
+    with metrics.stage("points"):
+        points = get_points()
+        if not points:
+            points = load_previous_points()
+        else:
+            save_points(points)
 
     if not points:
         logging.critical("Cannot extract points "
             + "or load them from a file. Execution stopped")
+        metrics.add_http("http", client)
+        metrics.save()
         return
 
+    tasks = [(ptype, pname)
+             for ptype, pnames in points.items()
+             for pname in pnames]
+    logging.info(f"Extracting {len(tasks)} points with {args.workers} "
+        + f"workers, {args.batch} points per call and rate limit "
+        + f"{args.rate or 'none'}")
+
+    size = max(args.batch, 1)
+    batches = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+    extract = extract_batch if size > 1 \
+        else lambda batch: [extract_data(*batch[0])]
     counts = {}
-    for ptype, pnames in points.items():
-        for pname in pnames:
-            res = extract_data(ptype, pname)
-            if res == 0:
-                counts.setdefault(ptype, 0)
-                counts[ptype] += 1
+    with metrics.stage("data"), \
+            ThreadPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        for batch, results in zip(batches, executor.map(extract, batches)):
+            for (ptype, _), res in zip(batch, results):
+                if res == 0:
+                    counts.setdefault(ptype, 0)
+                    counts[ptype] += 1
+                else:
+                    metrics.add("data", errors=1)
 
     logging.info(f"Extracted data: {counts}")
+    client.log_stats()
+    metrics.add_http("http", client)
+    metrics.save()
 
 
 def get_points() -> dict:
-    req = Request(
-        url=params.points_url,
-        headers={
-            "Authorization": f"Api-Key {args.apikey}"
-            }
-        )
     try:
-        with urlopen(req) as con:
-            response = con.read().decode("utf8")
-            response = loads(response)
+        response = client.get(params.points_url).content.decode("utf8")
+        response = loads(response)
     except:
         logging.error(f"Cannot extract points")
         return None
@@ -122,47 +215,234 @@ def load_previous_points() -> dict:
         return None
 
 
-def extract_data(ptype: str, pname: str) -> int:
+def extract_data(ptype: str, pname: str, full: bool = False) -> int:
     ptype_url_arg = ptype.rstrip("s")
     ptype_print = ptype.replace("_", " ")
+    previous = load_previous(ptype, pname) if args.since and not full \
+        else None
     url = params.scrape_url + f"?point={pname}&type={ptype_url_arg}"
-    req = Request(
-        url=url,
-        headers={
-            "Authorization": f"Api-Key {args.apikey}"
-        }
-    )
+    if args.compact:
+        url += "&format=compact"
+    since = make_since(previous)
+    if since:
+        url += "&since=" + quote("|".join(since))
 
+    rate_limiter.wait(url)
+    started = perf_counter()
     try:
-        with urlopen(req) as con:
-            response = con.read().decode()
-            data = loads(response)
-            logging.info(f"Extracted data for {pname} {ptype_print}")
+        response = client.get(url).content.decode()
+        data = loads(response)
     except:
-        logging.error(f"Cannot extract data for {pname} {ptype_print}")
+        latency = perf_counter() - started
+        logging.error(f"Cannot extract data for {pname} {ptype_print} "
+            + f"(failed after {latency:.2f} s)")
         return 1
+    latency = perf_counter() - started
+    logging.info(f"Extracted data for {pname} {ptype_print} in {latency:.2f} s")
+
+    if not merge_since(data, previous):
+        logging.warning(f"Previous data for {pname} {ptype_print} was "
+            + "revised on the site, extracting it in full")
+        return extract_data(ptype, pname, full=True)
+    return save_data(ptype, pname, data)
+
+
+def extract_batch(tasks: list) -> list:
+    """Extract several points with one call of the cloud function
+
+    The function scrapes the points concurrently and returns their
+    results in one gzipped response. A function deployed before batches
+    were added answers with an error without "points", then every point
+    is extracted with its own call. Returns the result of every point.
+    """
+    if no_batch.is_set():
+        return [extract_data(ptype, pname) for ptype, pname in tasks]
+    previous = [load_previous(ptype, pname) if args.since else None
+                for ptype, pname in tasks]
+    points = ",".join(
+        "|".join([f"{ptype.rstrip('s')}:{pname}"] + make_since(snapshot))
+        for (ptype, pname), snapshot in zip(tasks, previous))
+    url = params.scrape_url + f"?points={quote(points, safe=':,')}"
+    if args.compact:
+        url += "&format=compact"
+
+    rate_limiter.wait(url)
+    started = perf_counter()
+    try:
+        response = loads(client.get(url).content.decode())
+        items = response.get("points")
+        if items is not None and len(items) != len(tasks):
+            raise ValueError("Unexpected number of points")
+    except:
+        latency = perf_counter() - started
+        logging.error(f"Cannot extract data for {len(tasks)} points "
+            + f"(failed after {latency:.2f} s)")
+        return [1] * len(tasks)
+    if items is None:
+        if not no_batch.is_set():
+            no_batch.set()
+            logging.warning("The scrape function does not support "
+                + "batches, extracting points one by one")
+        return [extract_data(ptype, pname) for ptype, pname in tasks]
+    latency = perf_counter() - started
+    logging.info(f"Extracted data for {len(tasks)} points in {latency:.2f} s")
+
+    results = []
+    for (ptype, pname), data, snapshot in zip(tasks, items, previous):
+        if merge_since(data, snapshot):
+            results.append(save_data(ptype, pname, data))
+            continue
+        logging.warning(f"Previous data for {pname} "
+            + f"{ptype.replace('_', ' ')} was revised on the site, "
+            + "extracting it in full")
+        results.append(extract_data(ptype, pname, full=True))
+    return results
+
 
+def save_data(ptype: str, pname: str, data: dict) -> int:
+    ptype_print = ptype.replace("_", " ")
     if data["status"] == "OK":
         path = join(params.base_dir, ptype, pname)
         if not isdir(path):
             makedirs(path)
         filename = join(path, f"{pname}_{params.current_dt}.json")
         del data["status"]
+        if data.pop("format", None) == "compact":
+            data["data"] = expand_compact(data["data"])
 
         try:
-            with open(filename, "w") as f:
-                dump(data, f)
-                logging.info(f"Data for {pname} {ptype_print} saved to {filename}")
+            if args.delta:
+                filename = delta.save(path, pname, params.current_dt, data)
+            else:
+                with open(filename, "w") as f:
+                    dump(data, f)
+            logging.info(f"Data for {pname} {ptype_print} saved to {filename}")
+            metrics.add("data", files_written=1,
+                        rows_written=count_rows(data.get("data")))
         except:
             logging.error(f"Cannot save data for {pname} {ptype_print} saved to "
                 + f"{filename}")
             return 1
     else:
-        logging.error(f"Incorrect data for {pname} {ptype_print}"
-            + f"data['message']")
+        logging.error(f"Incorrect data for {pname} {ptype_print}: "
+            + f"{data.get('message')}")
 
     return 0
 
 
+def count_rows(data) -> int:
+    # Rows of pollution data are by subtype, of profilers are a list
+    if isinstance(data, dict):
+        return sum(len(rows) for rows in data.values())
+    return len(data or [])
+
+
+def expand_compact(data: dict) -> dict:
+    """Convert compact series of pollutants to rows, as in snapshots
+
+    Every series has Unix time of its first value in seconds ("base"),
+    differences of every timestamp from the previous one ("deltas") and
+    values ("values"). Rows are datetime in Moscow time, pollutant and
+    value, in the order of pollutants of the series.
+    """
+    rows = {}
+    isoformats = {}
+    for dtype, series_by_pollutant in data.items():
+        rows[dtype] = []
+        for pollutant, series in series_by_pollutant.items():
+            ts = series["base"]
+            for step, value in zip(series["deltas"], series["values"]):
+                ts += step
+                dt = isoformats.get(ts)
+                if dt is None:
+                    dt = isoformats[ts] = datetime.fromtimestamp(
+                        ts, tz=MSK_TZ).isoformat()
+                rows[dtype].append([dt, pollutant, value])
+    return rows
+
+
+def load_previous(ptype: str, pname: str) -> dict:
+    path = join(params.base_dir, ptype, pname)
+    try:
+        snapshots = delta.list_snapshots(path)
+        return delta.load(path, snapshots[-1]) if snapshots else None
+    except:
+        logging.warning(f"Cannot load previous data for {pname} "
+            + f"{ptype.replace('_', ' ')}")
+        return None
+
+
+def make_since(previous: dict) -> list:
+    # The earliest of the last datetimes of pollutants of every subtype
+    # of pollution data, as some pollutants lag behind the others.
+    # Values at it are requested again, since the last hour or day may
+    # be updated
+    if previous is None or not isinstance(previous.get("data"), dict):
+        return []
+    since = []
+    for dtype, rows in previous["data"].items():
+        last = {}
+        for dt, pollutant, _ in rows or []:
+            if dt > last.get(pollutant, ""):
+                last[pollutant] = dt
+        if last:
+            since.append(f"{dtype}:{int(to_epoch(min(last.values())))}")
+    return since
+
+
+def merge_since(data: dict, previous: dict) -> bool:
+    """Complete data requested with since by rows of the previous snapshot
+
+    For subtypes in data["since"], the scrape function returns only the
+    rows from since, and the number and checksum of the older rows
+    still on the site. The older rows of the previous snapshot are added
+    if they are the same, so the snapshot is complete as without since.
+    Returns False if they are not, then the point is extracted in full.
+    """
+    checks = data.pop("since", None) if data.get("status") == "OK" else None
+    if not checks:
+        return True
+    if data.pop("format", None) == "compact":
+        data["data"] = expand_compact(data["data"])
+
+    for dtype, check in checks.items():
+        since = datetime.fromtimestamp(check["since"], tz=MSK_TZ).isoformat()
+        first = {
+            pollutant: datetime.fromtimestamp(ts, tz=MSK_TZ).isoformat()
+            for pollutant, ts in check["first"].items()
+        }
+        older = [
+            row for row in previous["data"].get(dtype) or []
+            if row[1] in first and first[row[1]] <= row[0] < since
+        ]
+        if len(older) != check["count"] \
+                or checksum(older) != check["checksum"]:
+            return False
+        # Rows are grouped by pollutant in the order of the site and
+        # sorted by datetime, as in delta.py
+        order = {pollutant: i for i, pollutant in enumerate(first)}
+        rows = older + data["data"].get(dtype, [])
+        rows.sort(key=lambda row: (order.get(row[1], len(order)), row[0]))
+        data["data"][dtype] = rows
+    return True
+
+
+def checksum(rows: list) -> int:
+    # The same checksum as the one of the scrape function (see
+    # ycloud/scrape/air.py), so both must be changed together
+    total = 0
+    epochs = {}
+    for dt, pollutant, value in rows:
+        epoch = epochs.get(dt)
+        if epoch is None:
+            epoch = epochs[dt] = int(to_epoch(dt))
+        total += crc32(f"{epoch} {pollutant} {dumps(value)}".encode("utf8"))
+    return total & 0xffffffff
+
+
+def to_epoch(dt: str) -> float:
+    return datetime.fromisoformat(dt).timestamp()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,288 @@
+import argparse
+import csv
+import os
+import shutil
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# A point has a file per month (<YYYY-MM> in Moscow time, as datetimes
+# in raw data) with a float32 array of times x heights. Row i is the
+# time STEP * i seconds after the start of the month, and missing
+# values are NaN. Rows are added only up to the last time with values
+GRID_DIR = os.path.join("data", "msk", "grid")
+MSK = timezone(timedelta(hours=3))
+
+# Profilers measure temperature every 5 minutes at fixed heights, m
+STEP = 300
+HEIGHTS = tuple(range(0, 1001, 50))
+
+# Temperature of a rising dry parcel of air drops by 9.8 °C per km
+DRY_LAPSE_RATE = 0.0098
+
+# Rows are written in chunks, so that a whole rolling table is never
+# kept in memory
+CHUNK_ROWS = 100_000
+
+ANALYSIS_HEADER = ("datetime", "inversion", "inversion_base",
+                   "inversion_top", "inversion_intensity", "mixing_height")
+
+
+def is_available() -> bool:
+    return np is not None
+
+
+def point_dir(pname: str, base_dir: str = GRID_DIR) -> str:
+    return os.path.join(base_dir, pname)
+
+
+def month_filename(pname: str, month: str, base_dir: str = GRID_DIR) -> str:
+    return os.path.join(point_dir(pname, base_dir), f"{month}.f32")
+
+
+def has_point(pname: str, base_dir: str = GRID_DIR) -> bool:
+    return os.path.isdir(point_dir(pname, base_dir))
+
+
+def remove_point(pname: str, base_dir: str = GRID_DIR):
+    path = point_dir(pname, base_dir)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def list_months(pname: str, base_dir: str = GRID_DIR) -> list:
+    path = point_dir(pname, base_dir)
+    if not os.path.isdir(path):
+        return []
+    return sorted(filename[:-len(".f32")] for filename in os.listdir(path)
+                  if filename.endswith(".f32"))
+
+
+def month_start(month: str) -> int:
+    year, month = map(int, month.split("-"))
+    return int(datetime(year, month, 1, tzinfo=MSK).timestamp())
+
+
+def append_rows(pname: str, rows, base_dir: str = GRID_DIR) -> int:
+    """Write (datetime, height, temperature) rows to the grid of a point
+
+    Rows may come either parsed from JSON or read back from CSV, in any
+    order. They are consumed in chunks of CHUNK_ROWS, and only the
+    cells of their months are changed, so a table of any size can be
+    written. Rows at other heights or off the 5-minute grid are skipped.
+    Returns the number of cells written.
+    """
+    levels = {height: i for i, height in enumerate(HEIGHTS)}
+    epochs = {}
+    cells_count = 0
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, CHUNK_ROWS))
+        if not chunk:
+            return cells_count
+        by_month = {}
+        for dt, height, temperature in chunk:
+            if temperature is None or temperature == "":
+                continue
+            level = levels.get(int(height))
+            if level is None:
+                continue
+            epoch = epochs.get(dt)
+            if epoch is None:
+                epoch = epochs[dt] = int(datetime.fromisoformat(dt)
+                                         .timestamp())
+            by_month.setdefault(dt[:7], []).append(
+                (epoch, level, float(temperature)))
+        for month, cells in by_month.items():
+            cells_count += write_cells(pname, month, cells, base_dir)
+        epochs.clear()
+
+
+def write_cells(pname: str, month: str, cells: list,
+                base_dir: str = GRID_DIR) -> int:
+    epochs, levels, values = (np.array(column) for column in zip(*cells))
+    offsets = epochs - month_start(month)
+    on_grid = (offsets >= 0) & (offsets % STEP == 0)
+    rows = offsets[on_grid] // STEP
+    if not rows.size:
+        return 0
+
+    filename = month_filename(pname, month, base_dir)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    rows_count = os.path.getsize(filename) // (4 * len(HEIGHTS)) \
+        if os.path.isfile(filename) else 0
+    if rows.max() >= rows_count:
+        # The file grows by NaN rows up to the last new time, and the
+        # values are then written in place
+        with open(filename, "ab") as f:
+            np.full((rows.max() + 1 - rows_count, len(HEIGHTS)), np.nan,
+                    dtype=np.float32).tofile(f)
+        rows_count = rows.max() + 1
+
+    grid = np.memmap(filename, dtype=np.float32, mode="r+",
+                     shape=(rows_count, len(HEIGHTS)))
+    grid[rows, levels[on_grid]] = values[on_grid]
+    grid.flush()
+    del grid
+    return int(rows.size)
+
+
+def read_month(pname: str, month: str, base_dir: str = GRID_DIR) -> tuple:
+    """Return Unix times and a read-only memory map of temperature
+
+    Temperature is an array of times x HEIGHTS, NaN where missing.
+    """
+    filename = month_filename(pname, month, base_dir)
+    rows_count = os.path.getsize(filename) // (4 * len(HEIGHTS))
+    times = month_start(month) + STEP * np.arange(rows_count, dtype=np.int64)
+    if not rows_count:
+        return times, np.empty((0, len(HEIGHTS)), dtype=np.float32)
+    return times, np.memmap(filename, dtype=np.float32, mode="r",
+                            shape=(rows_count, len(HEIGHTS)))
+
+
+def load(pname: str, start: datetime = None, end: datetime = None,
+         base_dir: str = GRID_DIR) -> tuple:
+    """Load Unix times and temperature (times x HEIGHTS) of a point
+
+    Time bounds are tz-aware datetimes, start inclusive and end
+    exclusive. Only the files of matching months are read.
+    """
+    times, temperature = [], []
+    for month in list_months(pname, base_dir):
+        if start is not None \
+                and month < start.astimezone(MSK).strftime("%Y-%m"):
+            continue
+        if end is not None and month > end.astimezone(MSK).strftime("%Y-%m"):
+            continue
+        month_times, month_temperature = read_month(pname, month, base_dir)
+        selected = np.ones(month_times.shape, dtype=bool)
+        if start is not None:
+            selected &= month_times >= int(start.timestamp())
+        if end is not None:
+            selected &= month_times < int(end.timestamp())
+        times.append(month_times[selected])
+        temperature.append(month_temperature[selected])
+    if not times:
+        return (np.empty(0, dtype=np.int64),
+                np.empty((0, len(HEIGHTS)), dtype=np.float32))
+    return np.concatenate(times), np.concatenate(temperature)
+
+
+def analyze(temperature, heights=HEIGHTS) -> dict:
+    """Find inversions and mixing height in profiles of temperature
+
+    temperature is an array of times x heights. All profiles are
+    processed at once, and the arrays of the result are by time:
+    - "inversion": temperature rises with height somewhere;
+    - "inversion_base", "inversion_top": heights of the bottom and the
+      top of the lowest inversion, i.e. of the lowest layer where it
+      rises and the layers right above it where it still rises;
+    - "inversion_intensity": how much it rises in the inversion, °C;
+    - "mixing_height": the lowest height at which a parcel of air
+      rising from the ground without mixing is colder than the air
+      around it, i.e. its potential temperature is higher than at the
+      ground. It is the highest measured height if there is no such
+      height.
+    Values are NaN where they do not exist or cannot be found. Heights
+    without values are skipped: layers are between the nearest heights
+    with values.
+    """
+    temperature = np.asarray(temperature, dtype=np.float32)
+    heights = np.asarray(heights, dtype=np.float32)
+    times_count, levels_count = temperature.shape
+    levels = np.arange(levels_count)
+    rows = np.arange(times_count)
+
+    # Every measured height is the top of a layer from the nearest
+    # measured height below it, where temperature rises or not
+    measured = ~np.isnan(temperature)
+    last = np.maximum.accumulate(np.where(measured, levels, -1), axis=1)
+    below = np.concatenate(
+        [np.full((times_count, 1), -1), last[:, :-1]], axis=1)
+    has_layer = measured & (below >= 0)
+    rises = temperature > np.take_along_axis(
+        temperature, np.maximum(below, 0), axis=1)
+    rising = has_layer & rises
+    not_rising = has_layer & ~rises
+
+    # The lowest rising layer and the layers rising right above it
+    inversion = rising.any(axis=1)
+    first = rising.argmax(axis=1)
+    base = below[rows, first]
+    stops = not_rising & (levels > first[:, None])
+    highest = last[:, -1]
+    top = np.where(stops.any(axis=1), below[rows, stops.argmax(axis=1)],
+                   highest)
+    intensity = temperature[rows, top] - temperature[rows, base]
+
+    # Potential temperature without the constant offset, which is
+    # enough to compare it at different heights
+    potential = temperature + DRY_LAPSE_RATE * heights
+    warmer = potential > potential[:, :1]
+    mixing_height = np.where(warmer.any(axis=1),
+                             heights[warmer.argmax(axis=1)], heights[highest])
+
+    return {
+        "inversion": inversion,
+        "inversion_base": np.where(inversion, heights[base], np.nan),
+        "inversion_top": np.where(inversion, heights[top], np.nan),
+        "inversion_intensity": np.where(inversion, intensity, np.nan),
+        "mixing_height": np.where(measured[:, 0], mixing_height, np.nan)
+    }
+
+
+def write_analysis(pname: str, base_dir: str = GRID_DIR) -> int:
+    """Analyze all profiles of a point and write them to inversions.csv
+
+    Profiles are analyzed month by month, times without values are
+    skipped. Returns the number of rows written.
+    """
+    filename = os.path.join(point_dir(pname, base_dir), "inversions.csv")
+    rows_count = 0
+    with open(filename + ".tmp", "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(ANALYSIS_HEADER)
+        for month in list_months(pname, base_dir):
+            times, temperature = read_month(pname, month, base_dir)
+            measured = ~np.isnan(temperature).all(axis=1)
+            times, temperature = times[measured], temperature[measured]
+            result = analyze(temperature)
+            columns = [result[name].tolist() for name in ANALYSIS_HEADER[1:]]
+            for ts, inversion, *values in zip(times.tolist(), *columns):
+                writer.writerow(
+                    [datetime.fromtimestamp(ts, tz=MSK).isoformat(),
+                     int(inversion)]
+                    + ["" if value != value else round(value, 2)
+                       for value in values])
+            rows_count += len(times)
+    os.replace(filename + ".tmp", filename)
+    return rows_count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find inversions and mixing height for Moscow profilers")
+    parser.add_argument("pnames",
+        nargs="*",
+        help="Names of profilers, all of them by default"
+        )
+    args = parser.parse_args()
+
+    if not is_available():
+        print("numpy is not installed")
+        return
+    pnames = args.pnames or (sorted(os.listdir(GRID_DIR))
+                             if os.path.isdir(GRID_DIR) else [])
+    for pname in pnames:
+        rows_count = write_analysis(pname)
+        print(f"{pname}: {rows_count} profiles analyzed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import csv
+import json
+import os
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+
+
+MSK = timezone(timedelta(hours=3))
+
+# Length of the datetime prefix used as a key: days for frequent data
+# and months for daily and monthly averages
+KEY_LENGTHS = {
+    "hourly": 10,
+    "every_5_minutes": 10,
+    "daily": 7,
+    "monthly": 7
+}
+
+
+def index_filename(filename: str) -> str:
+    return filename + ".idx"
+
+
+def update(filename: str, key_length: int, rebuild: bool = False) -> dict:
+    """Add offsets of lines appended to a rolling table to its index
+
+    The index maps the first line of each day or month to its byte
+    offset, and remembers the size of the table already indexed, so
+    only the new part of the table is read.
+    """
+    index = None if rebuild else load(filename)
+    size = os.path.getsize(filename)
+    if index is None or index["key_length"] != key_length \
+            or index["size"] > size:
+        index = {"key_length": key_length, "size": 0, "offsets": []}
+
+    with open(filename, "rb") as f:
+        f.seek(index["size"])
+        if index["size"] == 0:
+            f.readline()
+        offset = f.tell()
+        last_key = index["offsets"][-1][0] if index["offsets"] else None
+        for line in f:
+            key = line[:key_length].decode("utf8")
+            if key != last_key:
+                index["offsets"].append([key, offset])
+                last_key = key
+            offset += len(line)
+        index["size"] = offset
+
+    with open(index_filename(filename), "w") as f:
+        json.dump(index, f)
+    return index
+
+
+def load(filename: str) -> dict:
+    try:
+        with open(index_filename(filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_range(filename: str, start: datetime = None,
+               end: datetime = None):
+    """Yield rows of a rolling table with start <= datetime < end
+
+    Bounds are tz-aware datetimes. Reading starts at the offset of the
+    day or month of start, so only rows close to the range are parsed.
+    """
+    index = load(filename)
+    if index is None:
+        raise FileNotFoundError(f"No index for {filename}")
+
+    offset = None
+    if start is not None:
+        key = start.astimezone(MSK).isoformat()[:index["key_length"]]
+        keys = [k for k, _ in index["offsets"]]
+        i = bisect_right(keys, key) - 1
+        if i >= 0:
+            offset = index["offsets"][i][1]
+
+    with open(filename, newline="") as f:
+        if offset is None:
+            f.readline()
+        else:
+            f.seek(offset)
+        for row in csv.reader(f):
+            dt = datetime.fromisoformat(row[0])
+            if start is not None and dt < start:
+                continue
+            if end is not None and dt >= end:
+                break
+            yield row
+
+
+def read_latest(filename: str, delta: timedelta):
+    """Yield rows of the last period of the given length, e.g. 24 hours"""
+    last_row = read_last_row(filename)
+    if last_row is None:
+        return
+    start = datetime.fromisoformat(last_row[0]) - delta
+    yield from read_range(filename, start=start)
+
+
+def read_last_row(filename: str) -> list:
+    # Reads the file backwards by blocks until a full line is found
+    with open(filename, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position, block = f.tell(), b""
+        while position > 0:
+            step = min(4096, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step) + block
+            lines = block.rstrip(b"\r\n").splitlines()
+            if len(lines) > 1 or position == 0:
+                break
+    lines = block.rstrip(b"\r\n").splitlines()
+    if len(lines) < 2 and position == 0:
+        return None
+    return next(csv.reader([lines[-1].decode("utf8")]))
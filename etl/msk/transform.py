@@ -1,14 +1,34 @@
+import argparse
 import csv
+import heapq
 import logging
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 import json
 import os
 from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+
+import columnar
+import delta
+import grid
+import index
+import wide
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+from metrics import Metrics
 
 
 Params = namedtuple("Params", [
     "raw_data_dir",
     "product_dir",
+    "columnar_dir",
+    "grid_dir",
+    "state_dir",
     "logs_dir",
     "current_dt"
 ])
@@ -16,6 +36,9 @@ Params = namedtuple("Params", [
 params = Params(
     raw_data_dir="data/msk/raw",
     product_dir="data/msk/product",
+    columnar_dir="data/msk/columnar",
+    grid_dir="data/msk/grid",
+    state_dir="data/msk/state",
     logs_dir=os.path.join("logs", "msk", "transform"),
     current_dt=datetime.now(tz=timezone(timedelta(hours=3)))\
             .isoformat(timespec="seconds"),
@@ -27,24 +50,115 @@ HEADERS = {
     "profilers": ("datetime", "height", "temperature")
 }
 
-if not os.path.isdir(params.logs_dir):
-    os.makedirs(params.logs_dir)
+# Keys work both for parsed rows and for rows read back from CSV
+SORT_KEYS = {
+    "stations": itemgetter(0),
+    "special_stations": itemgetter(0),
+    "profilers": lambda x: (x[0], int(x[1] or 0))
+}
 
-logging.basicConfig(
-    filename=os.path.join(params.logs_dir, f"transform_{params.current_dt}.txt"),
-    format="[%(asctime)s] %(levelname)s: %(message)s",
-    level=logging.DEBUG
-)
+# Tables built from scratch are sorted externally: rows are buffered
+# in memory up to RUN_SIZE, spilled to disk as sorted runs, and then
+# the runs are merged, at most MAX_OPEN_RUNS of them at once
+RUN_SIZE = 100_000
+MAX_OPEN_RUNS = 64
 
-for dirname, _, filenames in os.walk(params.raw_data_dir):
-    print(dirname)
-    parts = dirname.split("/")
-    if len(parts) != 5:
-        continue
+parser = argparse.ArgumentParser(
+    description="Make or update rolling tables for Moscow")
+parser.add_argument("--workers",
+    type=int,
+    default=1,
+    help="Number of processes to transform points in parallel"
+    )
+
+
+class RecordCollector(logging.Handler):
+    """Keep log records of a worker process to pass them to the parent"""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def main():
+    args = parser.parse_args()
+
+    # Logging is configured here and not on import, so that worker
+    # processes do not open log files of their own
+    if not os.path.isdir(params.logs_dir):
+        os.makedirs(params.logs_dir)
+
+    logging.basicConfig(
+        filename=os.path.join(params.logs_dir,
+                              f"transform_{params.current_dt}.txt"),
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        level=logging.DEBUG
+    )
+
+    if not columnar.is_available():
+        logging.warning("pyarrow is not installed, "
+            + "so the columnar store is not updated")
+    if not grid.is_available():
+        logging.warning("numpy is not installed, "
+            + "so grids of profilers are not updated")
+    metrics = Metrics("msk", "transform",
+                      os.path.join(params.logs_dir,
+                                   f"transform_{params.current_dt}.json"))
+
+    tasks = []
+    for dirname, _, filenames in os.walk(params.raw_data_dir):
+        parts = dirname.split("/")
+        if len(parts) != 5:
+            continue
+
+        ptype = parts[-2]
+        pname = parts[-1]
+        tasks.append((ptype, pname, dirname, filenames))
+
+    with metrics.stage("points"):
+        if args.workers > 1:
+            logging.info(f"Transforming {len(tasks)} points "
+                + f"with {args.workers} workers")
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                results = []
+                for summary in executor.map(process_point_in_worker, tasks):
+                    for record in summary.pop("log_records"):
+                        logging.getLogger().handle(record)
+                    results.append(summary)
+        else:
+            results = [process_point(*task) for task in tasks]
+
+    counts = {}
+    rows_count = 0
+    for summary in results:
+        counts.setdefault(summary["ptype"], 0)
+        counts[summary["ptype"]] += 1
+        rows_count += sum(summary["rows"].values())
+        metrics.add("points", files_read=summary["files_read"],
+                    files_skipped=summary["files_skipped"],
+                    rows_written=sum(summary["rows"].values()))
+    logging.info(f"Transformed data: {counts}, {rows_count} new rows")
+    metrics.save()
 
-    ptype = parts[-2]
-    pname = parts[-1]
 
+def process_point_in_worker(task: tuple) -> dict:
+    collector = RecordCollector()
+    root_logger = logging.getLogger()
+    root_logger.handlers = [collector]
+    root_logger.setLevel(logging.DEBUG)
+    try:
+        summary = process_point(*task)
+    finally:
+        root_logger.handlers = []
+    summary["log_records"] = collector.records
+    return summary
+
+
+def process_point(ptype: str, pname: str, dirname: str,
+                  filenames: list) -> dict:
+    print(dirname)
     out_dir = os.path.join(params.product_dir, ptype, pname)
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
@@ -54,81 +168,271 @@ for dirname, _, filenames in os.walk(params.raw_data_dir):
     else:
         dtypes = ("every_5_minutes",)
 
+    snapshots = sorted((delta.snapshot_dt(filename), filename)
+                       for filename in filenames
+                       if filename.endswith(".json"))
+
+    plans = {}
     for dtype in dtypes:
         out_file = os.path.join(out_dir, f"rolling_{dtype}.csv")
         if os.path.isfile(out_file):
-            with open(out_file) as f:
-                reader = csv.reader(f)
-                max_dt = datetime(1970, 1, 1, 0, 0, 1,
-                                  tzinfo=timezone(timedelta(hours=3)))
-                for i, line in enumerate(reader):
-                    if i == 0:
-                        continue
-                    dt = datetime.fromisoformat(line[0])
-                    if dt > max_dt:
-                        max_dt = dt
-
-            rows = set()
-            for filename in sorted(filenames):
-                file_dt = datetime.fromisoformat(filename\
-                                                .rstrip(".json")\
-                                                .split("_", maxsplit=1)[1])
-                if file_dt < max_dt:
-                    continue
+            state = load_state(ptype, pname, dtype)
+            if state is None:
+                state = make_state_from_product(out_file)
+                logging.info(f"No state for {pname} {dtype}, "
+                    + f"recovered it from {out_file}")
+                new_snapshots = [
+                    (file_dt, filename)
+                    for file_dt, filename in snapshots
+                    if state["last_dt"] is None
+                    or file_dt >= datetime.fromisoformat(state["last_dt"])
+                ]
+            else:
+                new_snapshots = [
+                    (file_dt, filename)
+                    for file_dt, filename in snapshots
+                    if state["last_snapshot"] is None
+                    or file_dt > delta.snapshot_dt(state["last_snapshot"])
+                ]
+            if state["last_dt"] is not None:
+                max_dt = datetime.fromisoformat(state["last_dt"])
+            else:
+                max_dt = None
+        else:
+            state = {"last_snapshot": None, "last_dt": None}
+            new_snapshots = snapshots
+            max_dt = None
 
-                with open(os.path.join(dirname, filename)) as f:
-                    json_data = json.load(f)
-                data = json_data.get("data")
-                if ptype != "profilers":
-                    data = data.get(dtype)
-                if not data:
-                    continue
-                for row in data:
-                    row = tuple(row)
-                    if row[0] is not None:
-                        row_dt = datetime.fromisoformat(row[0])
-                    else:
-                        continue
-                    if row_dt > max_dt:
-                        rows.add(row)
-
-            with open(out_file, "a") as f:
-                writer = csv.writer(f)
-                rows = list(rows)
-                if ptype == "profilers":
-                    rows.sort(key=lambda x: (x[0], x[1] or 0))
-                else:
-                    rows.sort(key=lambda x: x[0])
-                writer.writerows(rows)
+        plans[dtype] = {
+            "out_file": out_file,
+            "wide_file": os.path.join(out_dir, f"wide_{dtype}.csv"),
+            "build": not os.path.isfile(out_file),
+            "state": state,
+            "snapshots": new_snapshots,
+            "max_dt": max_dt
+        }
 
-        else:
-            rows = set()
-            for filename in filenames:
-                with open(os.path.join(dirname, filename)) as f:
-                    json_data = json.load(f)
-                data = json_data.get("data")
-                if ptype != "profilers":
-                    data = data.get(dtype)
-                if not data:
-                    continue
-                for row in data:
-                    row = tuple(row)
-                    if row[0] is not None:
-                        row_dt = datetime.fromisoformat(row[0])
-                    else:
-                        continue
-                    rows.add(row)
-
-            with open(out_file, "w", encoding="utf8") as f:
-                writer = csv.writer(f)
-                header = HEADERS[ptype]
-                writer.writerow(header)
-                rows = list(rows)
-                if ptype == "profilers":
-                    rows.sort(key=lambda x: (x[0], x[1] or 0))
-                else:
-                    rows.sort(key=lambda x: x[0])
-                writer.writerows(rows)
+    summary = {"ptype": ptype, "pname": pname, "rows": {}}
+    with tempfile.TemporaryDirectory(prefix=f"{pname}_") as run_dir:
+        summary["files_read"] = read_snapshots(ptype, dirname, plans, run_dir)
+        summary["files_skipped"] = len(snapshots) - summary["files_read"]
+
+        for dtype, plan in plans.items():
+            if plan["build"]:
+                rows_count, last_row = build_table(plan, ptype, run_dir)
+            else:
+                rows_count, last_row = append_table(plan, ptype)
+            index.update(plan["out_file"], index.KEY_LENGTHS[dtype],
+                         rebuild=plan["build"])
+            if ptype != "profilers":
+                update_wide(plan)
+            if columnar.is_available():
+                update_columnar(ptype, pname, dtype, plan)
+            if ptype == "profilers" and grid.is_available():
+                update_grid(pname, plan)
+
+            state = plan["state"]
+            if plan["snapshots"]:
+                state["last_snapshot"] = plan["snapshots"][-1][1]
+            if last_row:
+                state["last_dt"] = last_row[0]
+            save_state(ptype, pname, dtype, state)
+            summary["rows"][dtype] = rows_count
+            logging.debug(f"{pname} {dtype}: {len(plan['snapshots'])} new "
+                + f"snapshots, {rows_count} new rows")
 
     logging.info(f"Processed {ptype[:-1]} {pname}")
+    return summary
+
+
+def read_snapshots(ptype: str, dirname: str, plans: dict,
+                   run_dir: str) -> int:
+    # Every snapshot is decoded once, and its rows are routed to all
+    # dtypes which have not processed this snapshot yet. New rows for
+    # existing tables are collected in plan["rows"]. For tables built
+    # from scratch, rows are spilled to run_dir as sorted runs, which
+    # are listed in plan["runs"]. Delta snapshots (see delta.py) are
+    # read without rebuilding them. Returns the number of read files
+    wanted = {
+        dtype: {filename for _, filename in plan["snapshots"]}
+        for dtype, plan in plans.items()
+    }
+    filenames = sorted(set().union(*wanted.values()))
+
+    for plan in plans.values():
+        plan["rows"] = set()
+        if plan["build"]:
+            plan["runs"] = []
+
+    for filename in filenames:
+        with open(os.path.join(dirname, filename)) as f:
+            json_data = json.load(f)
+        for dtype, plan in plans.items():
+            if filename not in wanted[dtype]:
+                continue
+            data = json_data.get("data")
+            if ptype != "profilers":
+                data = data.get(dtype)
+            if not data:
+                continue
+            if delta.is_delta(filename):
+                # Rows of a delta snapshot which are not in the added or
+                # revised ones were already read from earlier snapshots
+                data = data["added"] + data["revised"]
+
+            max_dt = plan["max_dt"]
+            for row in data:
+                row = tuple(row)
+                if row[0] is None:
+                    continue
+                if max_dt is None or datetime.fromisoformat(row[0]) > max_dt:
+                    plan["rows"].add(row)
+
+            if plan["build"] and len(plan["rows"]) >= RUN_SIZE:
+                spill_rows(plan, ptype, run_dir)
+
+    for plan in plans.values():
+        if plan["build"]:
+            spill_rows(plan, ptype, run_dir)
+    return len(filenames)
+
+
+def spill_rows(plan: dict, ptype: str, run_dir: str):
+    if plan["rows"]:
+        rows = sorted(plan["rows"], key=SORT_KEYS[ptype])
+        plan["runs"].append(write_run(rows, run_dir))
+    plan["rows"] = set()
+
+
+def append_table(plan: dict, ptype: str) -> tuple:
+    rows = sorted(plan["rows"], key=SORT_KEYS[ptype])
+    plan["rows"] = rows
+    with open(plan["out_file"], "a") as f:
+        writer = csv.writer(f)
+        writer.writerows(rows)
+
+    return len(rows), rows[-1] if rows else None
+
+
+def build_table(plan: dict, ptype: str, run_dir: str) -> tuple:
+    rows_count, last_row = 0, None
+    with open(plan["out_file"], "w", encoding="utf8") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADERS[ptype])
+        for row in merge_runs(plan["runs"], SORT_KEYS[ptype], run_dir):
+            writer.writerow(row)
+            rows_count += 1
+            last_row = row
+
+    return rows_count, last_row
+
+
+def update_wide(plan: dict):
+    # Wide tables are built from the rolling CSV only once, and then
+    # only new datetimes are appended
+    if plan["build"] or not os.path.isfile(plan["wide_file"]):
+        wide.build(plan["wide_file"], plan["out_file"])
+    elif plan["rows"]:
+        wide.append_rows(plan["wide_file"], plan["rows"])
+
+
+def update_columnar(ptype: str, pname: str, dtype: str, plan: dict):
+    # New tables, and tables which are not in the columnar store yet,
+    # are copied there from the rolling CSV as a whole
+    if plan["build"] or not columnar.has_point(ptype, pname, dtype,
+                                               params.columnar_dir):
+        columnar.remove_point(ptype, pname, dtype, params.columnar_dir)
+        with open(plan["out_file"], newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            columnar.append_rows(ptype, pname, dtype, reader,
+                                 params.columnar_dir)
+    elif plan["rows"]:
+        columnar.append_rows(ptype, pname, dtype, plan["rows"],
+                             params.columnar_dir)
+
+
+def update_grid(pname: str, plan: dict):
+    # Like the columnar store, new grids are filled from the rolling CSV
+    # as a whole, and then only new rows are written
+    if plan["build"] or not grid.has_point(pname, params.grid_dir):
+        grid.remove_point(pname, params.grid_dir)
+        with open(plan["out_file"], newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            grid.append_rows(pname, reader, params.grid_dir)
+    elif plan["rows"]:
+        grid.append_rows(pname, plan["rows"], params.grid_dir)
+
+
+def write_run(rows, run_dir: str) -> str:
+    fd, filename = tempfile.mkstemp(suffix=".csv", dir=run_dir)
+    with os.fdopen(fd, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerows(rows)
+    return filename
+
+
+def read_run(filename: str):
+    with open(filename, newline="") as f:
+        yield from csv.reader(f)
+
+
+def merge_runs(runs: list, key, run_dir: str):
+    # Runs are merged in several passes if there are too many of them
+    # to keep all the files open at once
+    while len(runs) > MAX_OPEN_RUNS:
+        merged = []
+        for i in range(0, len(runs), MAX_OPEN_RUNS):
+            group = runs[i:i + MAX_OPEN_RUNS]
+            rows = heapq.merge(*map(read_run, group), key=key)
+            merged.append(write_run(unique(rows, key), run_dir))
+            for run in group:
+                os.remove(run)
+        runs = merged
+
+    yield from unique(heapq.merge(*map(read_run, runs), key=key), key)
+
+
+def unique(rows, key):
+    # Duplicates have equal keys, so only rows of one group are kept
+    # in memory at a time
+    for _, group in groupby(rows, key=key):
+        yield from dict.fromkeys(map(tuple, group))
+
+
+def state_filename(ptype: str, pname: str, dtype: str) -> str:
+    return os.path.join(params.state_dir, ptype, pname, f"{dtype}.json")
+
+
+def load_state(ptype: str, pname: str, dtype: str) -> dict:
+    filename = state_filename(ptype, pname, dtype)
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning(f"Cannot read state from {filename}")
+        return None
+
+
+def save_state(ptype: str, pname: str, dtype: str, state: dict):
+    filename = state_filename(ptype, pname, dtype)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(state, f)
+
+
+def make_state_from_product(out_file: str) -> dict:
+    # Used only once for tables built before states were introduced.
+    # Rows are sorted, so the last one has the latest datetime
+    last_row = index.read_last_row(out_file)
+    return {
+        "last_snapshot": None,
+        "last_dt": last_row[0] if last_row else None
+    }
+
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import csv
+import os
+from itertools import groupby
+from operator import itemgetter
+
+
+def build(filename: str, long_filename: str) -> int:
+    """Make a wide table (datetime x pollutant) from a rolling long table
+
+    The long table is read twice: first to get the list of pollutants,
+    and then to write wide rows one datetime at a time. Returns the
+    number of rows written.
+    """
+    with open(long_filename) as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        pollutants = sorted({row[1] for row in reader})
+
+    header = ["datetime"] + pollutants
+    with open(long_filename) as f_in, open(filename, "w") as f_out:
+        reader = csv.reader(f_in)
+        next(reader, None)
+        writer = csv.writer(f_out)
+        writer.writerow(header)
+        return write_wide_rows(writer, reader, header)
+
+
+def append_rows(filename: str, rows: list) -> int:
+    """Append long rows sorted by datetime to a wide table
+
+    Datetimes of the rows must be later than those already in the table.
+    If there are new pollutants, the columns for them are added first.
+    Returns the number of rows written.
+    """
+    header = read_header(filename)
+    if header is None:
+        header = ["datetime"]
+        with open(filename, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+
+    new_pollutants = sorted({row[1] for row in rows} - set(header[1:]))
+    if new_pollutants:
+        add_columns(filename, new_pollutants)
+        header += new_pollutants
+
+    with open(filename, "a") as f:
+        writer = csv.writer(f)
+        return write_wide_rows(writer, rows, header)
+
+
+def write_wide_rows(writer, rows, header: list) -> int:
+    index = {pollutant: i for i, pollutant in enumerate(header)}
+    rows_count = 0
+    for dt, group in groupby(rows, key=itemgetter(0)):
+        line = [dt] + [None] * (len(header) - 1)
+        for _, pollutant, value in group:
+            line[index[pollutant]] = value
+        writer.writerow(line)
+        rows_count += 1
+    return rows_count
+
+
+def read_header(filename: str) -> list:
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        return next(csv.reader(f), None)
+
+
+def add_columns(filename: str, pollutants: list):
+    # The only case when the existing table is rewritten. Values are
+    # copied as they are, so nothing is pivoted again
+    tmp_filename = filename + ".tmp"
+    with open(filename) as f_in, open(tmp_filename, "w") as f_out:
+        reader = csv.reader(f_in)
+        writer = csv.writer(f_out)
+        writer.writerow(next(reader) + pollutants)
+        padding = [None] * len(pollutants)
+        for line in reader:
+            writer.writerow(line + padding)
+    os.replace(tmp_filename, filename)
@@ -0,0 +1 @@
+../../../common/http_client.py
\ No newline at end of file
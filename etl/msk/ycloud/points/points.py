@@ -1,8 +1,18 @@
 from json import dumps
-from urllib.request import urlopen
+from time import monotonic
 
 from bs4 import BeautifulSoup
 
+from http_client import Client
+
+
+client = Client(timeout=30, retries=1)
+
+# Lists of stations change rarely, so a warm function instance returns
+# the lists parsed less than CACHE_TTL seconds ago
+CACHE_TTL = 3600
+cache = {"data": None, "expires": 0}
+
 
 def parse():
     INFO_URLS = {
@@ -21,8 +31,7 @@ def parse():
 
     for point_type, url in INFO_URLS.items():
         try:
-            with urlopen(url) as con:
-                html = con.read().decode("utf8")
+            html = client.get(url).content.decode("utf8")
         except:
             continue
 
@@ -41,13 +50,20 @@ def parse():
 
 
 def main(event, context):
-    data = parse()
+    if cache["data"] is not None and monotonic() < cache["expires"]:
+        data = cache["data"]
+    else:
+        data = parse()
     if len(data["stations"]) == 0 or len(data["special_stations"]) == 0:
         code = 500
         status = "Error"
     else:
         code = 200
         status = "OK"
+        # Only complete lists are cached
+        if data is not cache["data"]:
+            cache["data"] = data
+            cache["expires"] = monotonic() + CACHE_TTL
     result = {
         "status": status,
         "data": data
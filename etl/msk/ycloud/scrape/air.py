@@ -1,13 +1,23 @@
 import re
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
-from json import loads
-from urllib.request import urlopen
+from json import dumps, loads
+from zlib import crc32
 
+from http_client import Client
+
+
+# Kept between calls of a warm function instance, so its connections
+# to the site are reused. Points of a batch are scraped concurrently
+client = Client(timeout=30, retries=1, pool_size=8)
 
 PollutionData = namedtuple("PollutionData",
     ["datetime", "pollutant", "value"])
 
+# Timestamps of the site are milliseconds of Moscow time counted as if
+# it were UTC
+MSK_OFFSET = 3 * 3600
+
 class PollutionParser:
     def __init__(self):
         self._BASE_URL = "https://mosecom.mos.ru/"
@@ -18,15 +28,34 @@ class PollutionParser:
             "y": "monthly"
         }
         self._data = {}
+        self.checks = {}
+
+    def parse(self, point_name, compact=False, since=None):
+        """Return rows of data by subtype
+
+        If compact, every pollutant of a subtype is a series instead of
+        rows: "base" is Unix time of its first value in seconds,
+        "deltas" are differences of every timestamp from the previous
+        one (the first is 0), and "values" are the values.
 
-    def parse(self, point_name):
+        since is Unix time in seconds by subtype. Only values from that
+        time are returned for such subtypes, and the older ones are
+        described in checks (see _split_since).
+        """
         url = self._BASE_URL + point_name
         try:
-            with urlopen(url, timeout=30) as con:
-                html = con.read().decode("utf8")
+            html = client.get(url).content.decode("utf8")
         except:
             raise RuntimeError(f"Cannot open url {url}")
 
+        self.parse_html(html, compact=compact, since=since)
+        if len(self._data) == 0:
+            raise RuntimeError(f"No data for profiler {point_name}")
+
+        return self._data
+
+    def parse_html(self, html, compact=False, since=None):
+        """Return rows of data by subtype from the page of a point"""
         script = re.findall("AirCharts.init.*", html)[0]
         data_start = len("AirCharts.init(")
         data_end = script.find(', {"months"')
@@ -38,6 +67,13 @@ class PollutionParser:
             if mtype == "w" and "m" in data["units"]:
                 continue
                 # w and m are generally the same, so we need only one of them
+            if since and self._MTYPE_MAPPING[mtype] in since:
+                measurements = self._split_since(
+                    self._MTYPE_MAPPING[mtype], measurements,
+                    since[self._MTYPE_MAPPING[mtype]])
+            if compact:
+                self._add_series(self._MTYPE_MAPPING[mtype], measurements)
+                continue
             self._data.setdefault(self._MTYPE_MAPPING[mtype], [])
             for pollutant, pollutant_data in measurements.items():
                 for ts, value in pollutant_data["data"]:
@@ -47,7 +83,61 @@ class PollutionParser:
                     row = PollutionData(dt, pollutant, value)
                     self._data[self._MTYPE_MAPPING[mtype]].append(row)
 
-        if len(self._data) == 0:
-            raise RuntimeError(f"No data for profiler {point_name}")
-
         return self._data
+
+    def _add_series(self, dtype, measurements):
+        # No datetimes are made, timestamps stay integers
+        series_by_pollutant = self._data.setdefault(dtype, {})
+        for pollutant, pollutant_data in measurements.items():
+            series = series_by_pollutant.setdefault(
+                pollutant, {"base": None, "deltas": [], "values": []})
+            last = series["base"] + sum(series["deltas"]) \
+                if series["deltas"] else None
+            for ts, value in pollutant_data["data"]:
+                ts = ts // 1000 - MSK_OFFSET
+                if last is None:
+                    series["base"] = last = ts
+                series["deltas"].append(ts - last)
+                series["values"].append(value)
+                last = ts
+
+    def _split_since(self, dtype, measurements, since):
+        # The caller has the values before since, so only their number
+        # and checksum are returned to find out if any of them were
+        # revised or removed. "first" is Unix time of the first value
+        # of every pollutant, in the order of the site, so the caller
+        # knows which of its values are still on the site
+        newer = {}
+        older = []
+        first = {}
+        for pollutant, pollutant_data in measurements.items():
+            rows = []
+            for ts, value in pollutant_data["data"]:
+                epoch = ts // 1000 - MSK_OFFSET
+                first.setdefault(pollutant, epoch)
+                if epoch >= since:
+                    rows.append([ts, value])
+                else:
+                    older.append((epoch, pollutant, value))
+            if rows:
+                newer[pollutant] = {"data": rows}
+        self.checks[dtype] = {
+            "since": since,
+            "first": first,
+            "count": len(older),
+            "checksum": checksum(older)
+        }
+        return newer
+
+
+def checksum(rows):
+    """Return the checksum of (Unix time, pollutant, value) rows
+
+    It does not depend on the order of rows. The extractor computes
+    the same one from its rows (see etl/msk/extract.py), so both must
+    be changed together.
+    """
+    total = 0
+    for epoch, pollutant, value in rows:
+        total += crc32(f"{epoch} {pollutant} {dumps(value)}".encode("utf8"))
+    return total & 0xffffffff
@@ -1,7 +1,8 @@
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 from html.parser import HTMLParser
-from urllib.request import urlopen
+
+from air import client
 
 Meteodata = namedtuple("Meteodata",
     ["datetime", "height", "temperature"])
@@ -37,10 +38,13 @@ class MeteoprofileParser(HTMLParser):
     def parse(self, profiler_name):
         url = self._BASE_URL + profiler_name
         try:
-            with urlopen(url) as con:
-                html = con.read().decode("utf8")
-                self.feed(html)
+            html = client.get(url).content.decode("utf8")
+            self.parse_html(html)
         except:
             raise RuntimeError(f"Cannot open or parse url {url}")
 
         return self._data
+
+    def parse_html(self, html):
+        self.feed(html)
+        return self._data
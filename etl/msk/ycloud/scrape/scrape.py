@@ -1,17 +1,74 @@
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from gzip import compress
 from json import dumps
 
 from air import PollutionParser
 from meteo import MeteoprofileParser
 
 
+# Points of a batch are scraped concurrently, but not too many at once
+# to be polite to the site
+BATCH_WORKERS = 8
+MAX_BATCH_SIZE = 100
+
+
 def main(event, context):
-    point = event["queryStringParameters"].get("point")
-    point_type = event["queryStringParameters"].get("type", "station")
+    query = event.get("queryStringParameters") or {}
+    compact = query.get("format") == "compact"
+    if "points" in query:
+        return batch(event, query["points"], compact)
+
+    point = query.get("point")
+    point_type = query.get("type", "station")
+    since = parse_since(query.get("since", "").split("|"))
+    return response(scrape(point, point_type, compact, since),
+                    compressed=accepts_gzip(event))
+
+
+def batch(event, points, compact=False):
+    """Scrape several points in one call
+
+    points are "<type>:<point>" separated by commas, e.g.
+    "station:mgu,profiler:vostok", each may be followed by since of
+    the point like "station:mgu|hourly:1656633600|daily:1656547200".
+    The body has the results of all points in the same order, each like
+    the body of a one-point call.
+    """
+    tasks = []
+    for item in points.split(","):
+        point, *since = item.strip().split("|")
+        point_type, _, point = point.rpartition(":")
+        tasks.append((point or None, point_type or "station",
+                      parse_since(since)))
+    if not tasks or len(tasks) > MAX_BATCH_SIZE:
+        return response({
+            "status": "Error",
+            "message": f"Error info: from 1 to {MAX_BATCH_SIZE} points "
+                + "are expected"
+        })
+
+    with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(tasks))) \
+            as executor:
+        results = list(executor.map(
+            lambda task: scrape(task[0], task[1], compact, task[2]), tasks))
+    body = {
+        "status": "OK",
+        "points": results
+    }
+
+    return response(body, compressed=accepts_gzip(event))
 
+
+def scrape(point, point_type, compact=False, since=None):
+    # A failed point of a batch must not fail the others, so any error
+    # is returned as the message
+    message = "Error info: no data"
+    checks = None
     try:
-        data = process(point, point_type)
+        data, checks = process(point, point_type, compact, since)
         status = "OK"
-    except RuntimeError as e:
+    except Exception as e:
         data = None
         message = f"Error info: {e}"
         status = "Error"
@@ -24,26 +81,65 @@ def main(event, context):
 
     if data:
         body["data"] = data
+        # Profilers have no compact format
+        if compact and point_type != "profiler":
+            body["format"] = "compact"
+        if checks:
+            body["since"] = checks
     else:
         body["message"] = message
 
+    return body
+
+
+def parse_since(items):
+    # Items are "<subtype>:<Unix time in seconds>", wrong ones are
+    # ignored, so the data of their subtypes is returned in full
+    since = {}
+    for item in items:
+        dtype, _, ts = item.strip().partition(":")
+        if dtype and ts.isdigit():
+            since[dtype] = int(ts)
+    return since
+
+
+def accepts_gzip(event):
+    headers = {
+        key.lower(): value
+        for key, value in (event.get("headers") or {}).items()
+    }
+    return "gzip" in headers.get("accept-encoding", "")
+
+
+def response(body, compressed=False):
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    body = dumps(body)
+    if compressed:
+        # Binary bodies are passed base64 encoded
+        headers['Content-Encoding'] = 'gzip'
+        body = b64encode(compress(body.encode("utf8"))).decode("ascii")
+
     return {
         'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json'
-        },
-        'isBase64Encoded': False,
-        'body': dumps(body)
+        'headers': headers,
+        'isBase64Encoded': compressed,
+        'body': body
     }
 
 
-def process(point, point_type):
+def process(point, point_type, compact=False, since=None):
+    # Returns data and checks of the values before since. Profilers
+    # are always returned in full
     if point is None:
         raise RuntimeError("No point specified")
 
     if point_type == "profiler":
-        return MeteoprofileParser().parse(point)
+        return MeteoprofileParser().parse(point), None
     elif point_type in ("station", "special_station"):
-        return PollutionParser().parse(point)
+        parser = PollutionParser()
+        data = parser.parse(point, compact=compact, since=since)
+        return data, parser.checks
     else:
         raise RuntimeError("Incorrect point type")
@@ -0,0 +1,161 @@
+import argparse
+import hashlib
+import json
+import os
+from urllib.error import HTTPError
+
+
+blobs_dir = os.path.join("data", "spb", "blobs")
+validators_filename = os.path.join(blobs_dir, "validators.json")
+
+# Snapshot directories keep this file with digests of their files
+# instead of the files themselves
+MANIFEST = "manifest.json"
+
+
+def blob_path(digest):
+    return os.path.join(blobs_dir, digest[:2], digest)
+
+
+def put(content):
+    """Store content unless it is already stored, return its digest"""
+    digest = hashlib.sha256(content).hexdigest()
+    path = blob_path(digest)
+    if not os.path.isfile(path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+    return digest
+
+
+def read(digest):
+    with open(blob_path(digest), "rb") as f:
+        return f.read()
+
+
+def load_validators():
+    try:
+        with open(validators_filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_validators(validators):
+    if not os.path.isdir(blobs_dir):
+        os.makedirs(blobs_dir)
+    with open(validators_filename, "w") as f:
+        json.dump(validators, f, indent=1, sort_keys=True)
+
+
+def fetch(client, url, validators, headers=None, transform=None,
+          timeout=None):
+    """Download a URL to the store unless it was not modified
+
+    ETag and Last-Modified of the previous response are sent back as
+    If-None-Match and If-Modified-Since, so an unchanged resource costs
+    a response without a body. transform is applied to a downloaded
+    content before it is stored. Returns the digest of the stored
+    content and whether it was downloaded. The digest and the content
+    type are kept in validators[url]. client is an http_client.Client.
+    """
+    known = validators.get(url)
+    headers = dict(headers or {})
+    if known and os.path.isfile(blob_path(known["digest"])):
+        if known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
+
+    try:
+        response = client.get(url, headers=headers, timeout=timeout)
+        content, info = response.content, response.info()
+    except HTTPError as e:
+        if e.code == 304 and known:
+            return known["digest"], False
+        raise
+
+    if transform is not None:
+        content = transform(content)
+    digest = put(content)
+    validators[url] = {
+        "digest": digest,
+        "etag": info.get("ETag"),
+        "last_modified": info.get("Last-Modified"),
+        "content_type": info.get_content_type()
+    }
+    return digest, True
+
+
+def save_manifest(dirname, files):
+    """Save digests of files of a snapshot by their names"""
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(os.path.join(dirname, MANIFEST), "w") as f:
+        json.dump(files, f, indent=1, sort_keys=True)
+
+
+def load_manifest(dirname):
+    try:
+        with open(os.path.join(dirname, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def list_files(dirname):
+    """Return paths of files of a snapshot by their names
+
+    Files of snapshots saved before the store are read as they are.
+    """
+    files = {
+        name: os.path.join(dirname, name) for name in os.listdir(dirname)
+        if name != MANIFEST and os.path.isfile(os.path.join(dirname, name))
+    }
+    for name, digest in (load_manifest(dirname) or {}).items():
+        files[name] = blob_path(digest)
+    return files
+
+
+def compact(dirname):
+    """Move files of a snapshot to the store, leaving a manifest
+
+    Returns the number of moved files.
+    """
+    files = load_manifest(dirname) or {}
+    moved = 0
+    for name in sorted(os.listdir(dirname)):
+        path = os.path.join(dirname, name)
+        if name == MANIFEST or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            files[name] = put(f.read())
+        moved += 1
+    if moved:
+        save_manifest(dirname, files)
+        for name in files:
+            if os.path.isfile(os.path.join(dirname, name)):
+                os.remove(os.path.join(dirname, name))
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move files of stored SPb snapshots to the blob store")
+    parser.add_argument("dirs",
+        nargs="+",
+        help="Snapshot directories, e.g. data/spb/raw/asmav/1/*"
+        )
+    args = parser.parse_args()
+
+    for dirname in args.dirs:
+        if not os.path.isdir(dirname):
+            continue
+        moved = compact(dirname)
+        print(f"{dirname}: {moved} files moved to the store")
+
+
+if __name__ == "__main__":
+    main()
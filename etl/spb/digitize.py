@@ -0,0 +1,534 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import sys
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+from PIL import Image
+
+import blobs
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+from metrics import Metrics
+
+
+raw_dir = os.path.join("data", "spb", "raw")
+out_dir = os.path.join("data", "spb", "product")
+cache_filename = os.path.join("data", "spb", "cache", "images.json")
+timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
+            .isoformat(timespec="seconds")
+logs_dir = os.path.join("logs", "spb", "digitize")
+if not os.path.isdir(logs_dir):
+    os.makedirs(logs_dir)
+
+logging.basicConfig(
+    filename=os.path.join(logs_dir, f"digitize_{timestamp}.txt"),
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    level=logging.DEBUG
+)
+logging.getLogger("PIL").setLevel(logging.INFO)
+
+MSK_TZ = timezone(timedelta(hours=3))
+
+# Cached results are dropped when this version changes, e.g. after
+# a fix of the digitization
+VERSION = 1
+
+BLACK = 0x040204
+WHITE = 0xfcfefc
+
+# Axis labels use a bitmap font, so they are read by exact matching of
+# glyphs. Glyphs of FONT_CHARS are separated by spaces
+FONT_CHARS = "0123456789."
+FONT = [
+    "..#.. ..#.. .###. .###. ...#. ##### ..### ##### .###. .###. ..",
+    ".#.#. .##.. #...# #...# ..##. #.... .#... ....# #...# #...# ..",
+    "#...# #.#.. ....# ....# .#.#. ####. #.... ...#. #...# #...# ..",
+    "#...# ..#.. ...#. ..##. #..#. #...# ####. ...#. .###. #...# ..",
+    "#...# ..#.. ..#.. ....# #..#. ....# #...# ..#.. #...# .#### ..",
+    "#...# ..#.. .#... ....# ##### ....# #...# ..#.. #...# ....# ..",
+    ".#.#. ..#.. #.... #...# ...#. #...# #...# .#... #...# ...#. ##",
+    "..#.. ##### ##### .###. ...#. .###. .###. .#... .###. ###.. ##",
+]
+GLYPHS = {
+    tuple(row.split(" ")[i] for row in FONT
+          if "#" in row.split(" ")[i]): char
+    for i, char in enumerate(FONT_CHARS)
+}
+# Labels of the table are crossed by its lines, which hide the left
+# column of some glyphs
+GLYPHS.update({
+    tuple(row[1:] for row in glyph): char
+    for glyph, char in list(GLYPHS.items()) if len(glyph[0]) == 5
+})
+
+# Labels of a gridline are drawn this number of pixels above it
+LABEL_OFFSET = 3
+
+# The vertical title of a chart is to the left of this column. It is
+# anti-aliased, and its black pixels are not glyphs
+LABELS_X = 13
+
+# Series colors of each chart template. Legends only repeat them, so
+# they are not read
+ASMAV_COLORS = {
+    0xfc0204: "CO",
+    0xfca604: "SO2",
+    0x04fefc: "O3",
+    0x9cca94: "PM10",
+    0x9ccacc: "PM2.5",
+    0x447e7c: "пыль общая",
+    0x048204: "NO",
+    BLACK: "NO2",
+}
+GMSAV_COLORS = {
+    0x447e7c: "пыль общая",
+    0x04b2ec: "HCl",
+    0xfc0204: "бензол",
+    0xc45abc: "ксилол",
+    0x048204: "толуол",
+    0x9ccacc: "фенол",
+    BLACK: "формальдегид",
+    0xfca604: "этилбензол",
+}
+
+# Colors of cells in the table of gmsav stations: levels of one-time
+# maximum permissible concentrations
+LEVELS = {
+    0x54f2e4: "<0.5",
+    0x54ceac: "<1",
+    0xf4e644: "<2",
+    0xfc5254: "<5",
+    0x940234: ">5",
+}
+
+# Names of pollutants in the table of gmsav stations are anti-aliased
+# text, so each label is recognized as a whole by the hash of its
+# bitmap (see label_hash)
+LEVEL_LABELS = {
+    "51aa2a058d": "пыль общая",
+    "33eef9cd44": "хлорводород",
+    "6fe1274bf7": "диоксид азота",
+    "2ed2bae55b": "формальдегид",
+    "d5408f32d2": "аммиак",
+    "55e1dfeb01": "диоксид серы",
+    "0aa3d99d39": "оксид углерода",
+    "8442ebf59b": "фенол",
+    "e9e6188e71": "сероводород",
+}
+
+# Chart templates by station type and image: kind of the chart, colors
+# of series and the product table
+TEMPLATES = {
+    ("asmav", "image_0.gif"): ("lines", ASMAV_COLORS, "daily"),
+    ("asmav", "image_1.gif"): ("bars", ASMAV_COLORS, "annual"),
+    ("gmsav", "image_0.gif"): ("levels", None, "levels"),
+    ("gmsav", "image_1.gif"): ("bars", GMSAV_COLORS, "annual"),
+}
+
+# Charts show concentrations in shares of the MPC
+HEADERS = {
+    "daily": ["date", "pollutant", "mpc_share"],
+    "annual": ["year", "pollutant", "mpc_share"],
+    "levels": ["datetime", "pollutant", "level"],
+}
+
+
+class DigitizeError(Exception):
+    pass
+
+
+def main():
+    metrics = Metrics("spb", "digitize",
+                      os.path.join(logs_dir, f"digitize_{timestamp}.json"))
+    cache = load_cache()
+    calibrations = {}
+    stats = {"cached": 0, "digitized": 0, "error": 0}
+    rows_count = 0
+    for stype in ("asmav", "gmsav"):
+        stype_dir = os.path.join(raw_dir, stype)
+        if not os.path.isdir(stype_dir):
+            continue
+        for sid in sorted(os.listdir(stype_dir)):
+            if not sid.isdigit():
+                continue
+            tables = {table: {} for table in HEADERS}
+            for snapshot in sorted(os.listdir(os.path.join(stype_dir, sid))):
+                files = blobs.list_files(os.path.join(stype_dir, sid,
+                                                      snapshot))
+                for image_name in ("image_0.gif", "image_1.gif"):
+                    filename = files.get(image_name)
+                    if filename is None:
+                        continue
+                    kind, colors, table = TEMPLATES[(stype, image_name)]
+                    with metrics.stage("digitize"):
+                        rows = digitize_file(filename, kind, colors, cache,
+                                             calibrations, stats)
+                    # Later snapshots replace values of earlier ones
+                    for row in rows:
+                        tables[table][tuple(row[:2])] = row[2]
+            with metrics.stage("write"):
+                rows_count += save_tables(stype, sid, tables)
+
+    save_cache(cache)
+    logging.info(f"Images: {stats}, {len(calibrations)} axis calibrations")
+    metrics.add("digitize", files_read=stats["digitized"],
+                files_skipped=stats["cached"], errors=stats["error"])
+    metrics.add("write", rows_written=rows_count)
+    metrics.save()
+
+
+def digitize_file(filename, kind, colors, cache, calibrations, stats):
+    with open(filename, "rb") as f:
+        content = f.read()
+    key = hashlib.sha1(content).hexdigest()
+    if key in cache:
+        stats["cached"] += 1
+        return cache[key]
+
+    try:
+        rgb = load_image(filename)
+        if kind == "lines":
+            rows = digitize_lines(rgb, colors, calibrations)
+        elif kind == "bars":
+            rows = digitize_bars(rgb, colors, calibrations)
+        else:
+            rows = digitize_levels(rgb)
+    except DigitizeError as e:
+        logging.error(f"Cannot digitize {filename}: {e}")
+        stats["error"] += 1
+        return []
+    except Exception as e:
+        # An unexpected chart must not stop digitizing of the others
+        logging.error(f"Cannot digitize {filename}: {e!r}")
+        stats["error"] += 1
+        return []
+
+    stats["digitized"] += 1
+    cache[key] = rows
+    return rows
+
+
+def load_image(filename):
+    # Colors are packed to one integer per pixel, so a series is
+    # selected by a single comparison
+    a = np.asarray(Image.open(filename).convert("RGB"), dtype=np.uint32)
+    return (a[..., 0] << 16) | (a[..., 1] << 8) | a[..., 2]
+
+
+def digitize_lines(rgb, colors, calibrations):
+    axes = calibrate(rgb, calibrations)
+    dates = read_dates(rgb, axes)
+    top, bottom = axes["top"], axes["axis_row"]
+    plot = rgb[top:bottom].copy()
+    # Gridlines are drawn over the series, so series are unknown there
+    for row in axes["gridlines"]:
+        if top <= row < bottom:
+            plot[row - top] = WHITE
+    plot[:, :axes["axis_x"] + 1] = WHITE
+
+    rows = []
+    for color, pollutant in colors.items():
+        mask = plot == color
+        if not mask.any():
+            continue
+        for x, dt in zip(axes["ticks"], dates):
+            y = vertex_row(mask, max(x, axes["axis_x"] + 1))
+            if y is not None:
+                value = axes["value"](y + top)
+                rows.append([dt.isoformat(), pollutant, round(value, 3)])
+    return rows
+
+
+def vertex_row(mask, x):
+    """Find the row of a data point of a line at column x
+
+    Segments to the neighboring points both end at the data point. If
+    they go in different directions, the point is the middle of the
+    pixels of the column, otherwise it is the extremum. Ends of lines
+    may stop one column short of the data point.
+    """
+    for x in (x, x - 1, x + 1):
+        ys = np.nonzero(mask[:, x])[0] if 0 <= x < mask.shape[1] else []
+        if len(ys):
+            break
+    else:
+        return None
+    top, bottom = ys.min(), ys.max()
+    left, right = column_center(mask, x - 3), column_center(mask, x + 3)
+    if left is not None and right is not None:
+        if left > bottom and right > bottom:
+            return top + 0.5
+        if left < top and right < top:
+            return bottom - 0.5
+    return (top + bottom) / 2
+
+
+def column_center(mask, x):
+    if not 0 <= x < mask.shape[1]:
+        return None
+    ys = np.nonzero(mask[:, x])[0]
+    return ys.mean() if len(ys) else None
+
+
+def digitize_bars(rgb, colors, calibrations):
+    axes = calibrate(rgb, calibrations)
+    years = read_tick_labels(rgb, axes)[0]
+    top, bottom = axes["top"], axes["axis_row"]
+    plot = rgb[top:bottom, axes["axis_x"] + 1:]
+    gridlines = np.zeros((bottom - top, 1), dtype=bool)
+    for row in axes["gridlines"]:
+        if top <= row < bottom:
+            gridlines[row - top] = True
+
+    rows = []
+    ticks = np.array(axes["ticks"]) - axes["axis_x"] - 1
+    for color, pollutant in colors.items():
+        mask = plot == color
+        if not mask.any():
+            continue
+        # Height of the run of the color from the axis up, a bar may be
+        # crossed by gridlines
+        heights = np.cumprod((mask | gridlines)[::-1], axis=0).sum(axis=0)
+        heights[~mask[-1]] = 0
+        for x0, x1 in runs(heights > 0):
+            y = bottom - heights[x0:x1].max()
+            while gridlines[y - top, 0] and not mask[y - top, x0:x1].any():
+                y += 1
+            i = np.searchsorted(ticks, (x0 + x1) / 2 + 4, side="right") - 1
+            if 0 <= i < len(years) and years[i]:
+                value = axes["value"](y)
+                rows.append([years[i], pollutant, round(value, 3)])
+    return rows
+
+
+def digitize_levels(rgb):
+    v, chroma = gray_levels(rgb)
+    grid = (v > 130) & (v < 165) & (chroma < 10)
+    border = rgb == BLACK
+    x_left = int(np.argmax(border[:, :rgb.shape[1] // 4].sum(axis=0)))
+    body = grid[:, x_left + 1:]
+    hlines = [y for y in range(rgb.shape[0])
+              if body[y].mean() > 0.5 or border[y, x_left:].mean() > 0.9]
+    hlines = merge_lines(hlines)
+    if len(hlines) < 4:
+        raise DigitizeError("Table is not found")
+    vlines = [x for x in range(x_left, rgb.shape[1])
+              if (grid | border)[hlines[2]:hlines[-1], x].mean() > 0.5]
+    vlines = merge_lines(vlines)
+
+    ink = rgb == BLACK
+    date_words = read_words(ink[hlines[0] + 1:hlines[1],
+                                x_left + 1:vlines[-1]])
+    hour_words = read_words(ink[hlines[1] + 1:hlines[2],
+                                x_left + 1:vlines[-1]])
+    columns = []
+    for x0, x1 in zip(vlines, vlines[1:]):
+        center = (x0 + x1) / 2 - x_left - 1
+        day = nearest_word(date_words, center, max_distance=40)
+        hour = nearest_word(hour_words, center)
+        try:
+            dt = datetime.strptime(f"{day} {hour}", "%d.%m.%Y %H")
+        except (TypeError, ValueError):
+            raise DigitizeError(f"Cannot read date {day} {hour}")
+        columns.append(((x0 + x1) // 2,
+                        dt.replace(tzinfo=MSK_TZ).isoformat()))
+
+    rows = []
+    for y0, y1 in zip(hlines[2:], hlines[3:]):
+        pollutant = LEVEL_LABELS.get(label_hash(v[y0 + 1:y1, :x_left] < 160))
+        if pollutant is None:
+            logging.warning(f"Unknown label of a row at {y0}")
+            continue
+        for x, dt in columns:
+            level = LEVELS.get(int(rgb[(y0 + y1) // 2, x]))
+            if level is not None:
+                rows.append([dt, pollutant, level])
+    return rows
+
+
+def gray_levels(rgb):
+    channels = np.stack([(rgb >> 16) & 0xff, (rgb >> 8) & 0xff, rgb & 0xff])
+    return channels.mean(axis=0), channels.max(axis=0) - channels.min(axis=0)
+
+
+def merge_lines(positions):
+    # Lines may be two pixels wide
+    res = []
+    for position in positions:
+        if not res or position - res[-1][-1] > 1:
+            res.append([position])
+        else:
+            res[-1].append(position)
+    return [line[0] for line in res]
+
+
+def label_hash(ink):
+    ys, xs = np.nonzero(ink.any(axis=1))[0], np.nonzero(ink.any(axis=0))[0]
+    if not len(ys):
+        return None
+    ink = ink[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1]
+    content = np.packbits(ink).tobytes() + bytes(ink.shape)
+    return hashlib.sha1(content).hexdigest()[:10]
+
+
+def calibrate(rgb, calibrations):
+    """Find axes of a chart and the mapping of rows to values
+
+    Charts of one template differ only by labels of axes, so the result
+    is cached by the pixels of the labels of the vertical axis, and a new
+    calibration is done only when the scale of a chart changes.
+    """
+    ink = rgb == BLACK
+    height, width = ink.shape
+    axis_row = int(np.argmax(ink[height // 2:].sum(axis=1))) + height // 2
+    axis_x = int(np.argmax(ink[:, :width // 4].sum(axis=0)))
+    # Lines of series starting at the vertical axis overlap the last
+    # column of labels, so it is not a part of the key
+    labels = ink[:axis_row, LABELS_X:axis_x]
+    key = (axis_row, axis_x,
+           hashlib.sha1(labels[:, :-1].tobytes()).hexdigest())
+    # Ticks depend on the period of a chart, and are found every time.
+    # The first tick of line charts continues the vertical axis
+    ticks = [x for x in range(axis_x, width) if ink[axis_row + 1, x]]
+    if key in calibrations:
+        return dict(calibrations[key], ticks=ticks)
+
+    points = []
+    for y0, y1, words in read_lines(labels):
+        text = words[-1][2] if words else ""
+        try:
+            points.append((float(text), y1 - 1 + LABEL_OFFSET))
+        except ValueError:
+            continue
+    if len(points) < 2:
+        raise DigitizeError("Cannot read labels of the vertical axis")
+    slope, intercept = np.polyfit([p[0] for p in points],
+                                  [p[1] for p in points], 1)
+
+    calibrations[key] = {
+        "axis_row": axis_row,
+        "axis_x": axis_x,
+        "top": min(p[1] for p in points),
+        "gridlines": [p[1] for p in points],
+        "value": lambda y: max((y - intercept) / slope, 0),
+    }
+    return dict(calibrations[key], ticks=ticks)
+
+
+def read_tick_labels(rgb, axes):
+    # Text of each line of labels of the horizontal axis under each tick
+    lines = read_lines(rgb[axes["axis_row"] + 3:] == BLACK)
+    if not lines:
+        raise DigitizeError("Cannot read labels of the horizontal axis")
+    return [[nearest_word(words, x) for x in axes["ticks"]]
+            for _, _, words in lines]
+
+
+def read_dates(rgb, axes):
+    # Days are labeled under ticks, and the month and year are labeled
+    # under the first day and the first day of each month
+    lines = read_tick_labels(rgb, axes)
+    days, months = lines[0], lines[1] if len(lines) > 1 else [None]
+    if not days[0] or not months[0]:
+        raise DigitizeError("Cannot read dates")
+    try:
+        month, year = map(int, months[0].split("."))
+        start = date(year, month, int(days[0]))
+    except ValueError:
+        raise DigitizeError(f"Cannot read date {days[0]}.{months[0]}")
+    dates = [start + timedelta(days=i) for i in range(len(days))]
+    for day, dt in zip(days, dates):
+        if day and day.isdigit() and int(day) != dt.day:
+            raise DigitizeError(f"Day {day} does not follow {start}")
+    return dates
+
+
+def read_lines(ink):
+    """Read lines of text in a region as (top, bottom, words)"""
+    res = []
+    for y0, y1 in runs(ink.any(axis=1)):
+        res.append((y0, y1, read_words(ink[y0:y1])))
+    return res
+
+
+def read_words(ink, gap=4):
+    """Read words in one line of text as (start, end, text)
+
+    Glyphs of a word are separated by at most gap empty columns.
+    Unknown glyphs are read as "?".
+    """
+    words = []
+    for x0, x1 in runs(ink.any(axis=0)):
+        char = GLYPHS.get(glyph_key(ink[:, x0:x1]), "?")
+        if words and x0 - words[-1][1] <= gap:
+            words[-1][1] = x1
+            words[-1][2] += char
+        else:
+            words.append([x0, x1, char])
+    return [tuple(word) for word in words]
+
+
+def glyph_key(ink):
+    ys = np.nonzero(ink.any(axis=1))[0]
+    return tuple("".join("#" if v else "." for v in row)
+                 for row in ink[ys[0]:ys[-1] + 1])
+
+
+def nearest_word(words, x, max_distance=10):
+    if not words:
+        return None
+    x0, x1, text = min(words, key=lambda w: abs((w[0] + w[1]) / 2 - x))
+    return text if abs((x0 + x1) / 2 - x) <= max_distance else None
+
+
+def runs(flags):
+    """Return (start, end) of runs of True values"""
+    flags = np.concatenate([[False], flags, [False]]).astype(np.int8)
+    edges = np.nonzero(np.diff(flags))[0]
+    return list(zip(edges[::2], edges[1::2]))
+
+
+def save_tables(stype, sid, tables):
+    # Returns the number of rows written
+    path = os.path.join(out_dir, stype, sid)
+    rows_count = 0
+    for table, values in tables.items():
+        if not values:
+            continue
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, f"{table}.csv"), "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADERS[table])
+            for key, value in sorted(values.items()):
+                writer.writerow(list(key) + [value])
+        rows_count += len(values)
+    return rows_count
+
+
+def load_cache():
+    try:
+        with open(cache_filename) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != VERSION:
+        return {}
+    return cache["images"]
+
+
+def save_cache(cache):
+    cache_dir = os.path.dirname(cache_filename)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(cache_filename, "w") as f:
+        json.dump({"version": VERSION, "images": cache}, f,
+                  ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
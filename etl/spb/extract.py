@@ -2,11 +2,18 @@ import gzip
 import logging
 import os
 import re
+import sys
 from datetime import datetime, timedelta, timezone
 from time import sleep
 from urllib.error import HTTPError, URLError
 from urllib.parse import urljoin, parse_qs, urlencode, urlparse
-from urllib.request import urlopen, Request
+
+import blobs
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+import http_client
+from metrics import Metrics
 
 
 base_url = "https://www.mineral.spb.ru/"
@@ -14,6 +21,13 @@ script_url = "http://www.infoeco.ru/assets/files/air/placemark.js"
 out_dir = os.path.join("data", "spb", "raw")
 timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
             .isoformat(timespec="seconds")
+client = http_client.Client(timeout=60)
+
+# Links to pages of stations in the map script and to images in the
+# pages
+IFRAME_REGEX = re.compile("<iframe[^>]+ src=([^ ]+)>")
+IMAGE_REGEX = re.compile("<img[^>]+src=([^ ]+)")
+
 logs_dir = os.path.join("logs", "spb", "extract")
 if not os.path.isdir(logs_dir):
     os.makedirs(logs_dir)
@@ -23,18 +37,29 @@ logging.basicConfig(
     format="[%(asctime)s] %(levelname)s: %(message)s",
     level=logging.DEBUG
 )
+metrics = Metrics("spb", "extract",
+                  os.path.join(logs_dir, f"extract_{timestamp}.json"))
 
 def main():
-    station_ids = get_station_ids(script_url)
+    with metrics.stage("stations"):
+        station_ids = get_station_ids(script_url)
+    validators = blobs.load_validators()
 
     stats = {"ok": 0, "error": 0}
-    for stype, sids in station_ids.items():
-        for sid in sorted(sids):
-            res = get_data_for_station(stype, sid)
-            if res == 0:
-                stats["ok"] += 1
-            else:
-                stats["error"] += 1
+    with metrics.stage("data"):
+        for stype, sids in station_ids.items():
+            for sid in sorted(sids):
+                res = get_data_for_station(stype, sid, validators)
+                if res == 0:
+                    stats["ok"] += 1
+                else:
+                    stats["error"] += 1
+    metrics.add("data", errors=stats["error"])
+
+    blobs.save_validators(validators)
+    client.log_stats()
+    metrics.add_http("http", client)
+    metrics.save()
 
     logging.info(f"Extracted data for {timestamp}")
     logging.info(f"{stats['ok']} stations were processed successfuly "
@@ -52,8 +77,7 @@ def get_station_ids(url):
         "gmsav": set()
     }
     try:
-        with urlopen(url) as con:
-            src = con.read()
+        src = client.get(url).content
     except HTTPError as e:
         logging.critical("Cannot get data about stations")
         logging.critical(f"Error code {e.code}: {e.reason}")
@@ -65,8 +89,7 @@ def get_station_ids(url):
 
     src = src.decode("windows-1251")
 
-    regex = re.compile("<iframe[^>]+ src=([^ ]+)>")
-    for match in regex.finditer(src):
+    for match in IFRAME_REGEX.finditer(src):
         link = match.group(1)
         stype = "asmav" if "asmav" in link else "gmsav"
         query = urlparse(link).query
@@ -93,12 +116,13 @@ def get_station_ids(url):
     return res
 
 
-def get_data_for_station(stype, sid):
+def get_data_for_station(stype, sid, validators):
     logging.info(f"Processing {stype} station with id {sid}")
     url = f"{base_url}{stype}30d/index.php?id={sid}"
     try:
-        with urlopen(url) as con:
-            html = con.read().decode("windows-1251")
+        html_digest, _ = blobs.fetch(client, url, validators,
+                                     transform=html_to_utf8)
+        html = blobs.read(html_digest).decode("utf8")
     except HTTPError as e:
         logging.critical(f"Cannot get data from {url}")
         logging.critical(f"Error code {e.code}: {e.reason}")
@@ -111,43 +135,55 @@ def get_data_for_station(stype, sid):
         logging.critical(f"Cannot decode data from {url}")
         return 1
 
-    regex = re.compile("<img[^>]+src=([^ ]+)")
-    images_src = []
-    for match in regex.finditer(html):
-        src = match.group(1)
-        src = src.strip("'\"")
-        images_src.append(src)
-
+    images_src = find_images(html)
     if len(images_src) != 2:
         logging.warning("Unexpected number of images")
 
-    images = []
-    for src in images_src:
+    # Files are kept in the blob store, and the snapshot is a manifest
+    # with their digests, so unchanged images take no space
+    files = {"index.html": html_digest}
+    downloaded = 0
+    for i, src in enumerate(images_src):
         image_url = urljoin(url, src)
         try:
-            with urlopen(image_url) as con:
-                data = con.read()
+            files[f"image_{i}.gif"], modified = blobs.fetch(
+                client, image_url, validators)
         except Exception:
             logging.error(f"Cannot get image {url}")
             continue
-        images.append(data)
+        downloaded += modified
 
-    out_path = os.path.join(out_dir, stype, str(sid), timestamp)
-    if not os.path.isdir(out_path):
-        os.makedirs(out_path)
+    station_path = os.path.join(out_dir, stype, str(sid))
+    if files == get_last_manifest(station_path):
+        logging.info("Data was not changed since the last snapshot")
+        metrics.add("data", files_skipped=1)
+    else:
+        blobs.save_manifest(os.path.join(station_path, timestamp), files)
+        metrics.add("data", files_written=1)
+    logging.info(f"{downloaded} of {len(images_src)} images were modified")
 
+    sleep(1)
+    return 0
+
+
+def find_images(html):
+    return [match.group(1).strip("'\"")
+            for match in IMAGE_REGEX.finditer(html)]
+
+
+def html_to_utf8(content):
+    html = content.decode("windows-1251")
     html = html.replace("charset=windows-1251", "charset=utf8")
-    html_filename = os.path.join(out_path, "index.html")
-    with open(html_filename, "w") as f:
-        f.write(html)
+    return html.encode("utf8")
 
-    for i, image in enumerate(images):
-        img_filename = os.path.join(out_path, f"image_{i}.gif")
-        with open(img_filename, "wb") as f:
-            f.write(image)
 
-    sleep(1)
-    return 0
+def get_last_manifest(station_path):
+    if not os.path.isdir(station_path):
+        return None
+    snapshots = sorted(os.listdir(station_path))
+    if not snapshots:
+        return None
+    return blobs.load_manifest(os.path.join(station_path, snapshots[-1]))
 
 
 if __name__ == "__main__":
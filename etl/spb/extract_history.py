@@ -1,14 +1,29 @@
 import os
-from datetime import date
+import sys
+from datetime import date, datetime, timedelta, timezone
 from time import sleep
-from urllib.request import urlopen, Request
 from urllib.parse import urlencode
 
 from bs4 import BeautifulSoup
 
+import blobs
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+import http_client
+from metrics import Metrics
+
 
 out_dir = os.path.join("data", "spb", "raw", "asmav", "history_before_2022-07-04")
 base_url = "http://www.infoeco.ru"
+client = http_client.Client(timeout=60)
+timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
+            .isoformat(timespec="seconds")
+# The script prints to the console and has no text log, so metrics are
+# saved where the log would be
+metrics = Metrics("spb", "extract_history",
+                  os.path.join("logs", "spb", "extract_history",
+                               f"extract_history_{timestamp}.json"))
 year_ids = {
     2017: 3122,
     2018: 4355,
@@ -21,6 +36,8 @@ year_ids = {
 def main():
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
+    validators = blobs.load_validators()
+    files = blobs.load_manifest(out_dir) or {}
 
     stats = {}
     for year, year_id in year_ids.items():
@@ -30,42 +47,51 @@ def main():
         url = f"{base_url}/index.php?{params}"
         links = []
 
-        soup = get_soup(url)
-        if not soup:
-            continue
-        pagination = soup.find(id="pagination")
-        pages = [a.attrs.get("href") for a in pagination("a")]
-        print(f"Pages count: {len(pages) + 1}")
-
-        print("Processing page #1")
-        links.extend(get_links_from_soup(soup))
-        for i, page in enumerate(pages):
-            print(f"Processing page {i+2}")
-            url = f"{base_url}{page}"
+        with metrics.stage("links"):
             soup = get_soup(url)
             if not soup:
                 continue
+            pagination = soup.find(id="pagination")
+            pages = [a.attrs.get("href") for a in pagination("a")]
+            print(f"Pages count: {len(pages) + 1}")
+
+            print("Processing page #1")
             links.extend(get_links_from_soup(soup))
+            for i, page in enumerate(pages):
+                print(f"Processing page {i+2}")
+                url = f"{base_url}{page}"
+                soup = get_soup(url)
+                if not soup:
+                    continue
+                links.extend(get_links_from_soup(soup))
 
         print(f"Found {len(links)} links for year {year}")
+        metrics.add("links", rows_parsed=len(links))
 
-        for link in links:
-            res = process_link(link)
-            if res == 0:
-                stats[year]["ok"] += 1
-            else:
-                stats[year]["error"] += 1
+        with metrics.stage("reports"):
+            for link in links:
+                res = process_link(link, validators, files)
+                if res == 0:
+                    stats[year]["ok"] += 1
+                else:
+                    stats[year]["error"] += 1
+                    metrics.add("reports", errors=1)
+
+        blobs.save_manifest(out_dir, files)
+        blobs.save_validators(validators)
 
     print("All years processed with the following results:")
     for year, results in stats.items():
         print(f"{year}: {results['ok']} OK, {results['error']} errors")
     print("Data files saved to {out_dir}")
+    client.log_stats(print)
+    metrics.add_http("http", client)
+    metrics.save()
 
 
 def get_soup(url):
     try:
-        with urlopen(url) as con:
-            html = con.read().decode()
+        html = client.get(url).content.decode()
         soup = BeautifulSoup(html, "html.parser")
     except Exception as e:
         print(f"Cannot get data from {url}")
@@ -89,19 +115,23 @@ def get_links_from_soup(soup):
     return res
 
 
-def process_link(link):
+def process_link(link, validators, files):
     print(f"Processing {link}")
     headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:102.0) Gecko/20100101 Firefox/102.0"}
     url = f"{base_url}/{link}"
-    req = Request(url=url, headers=headers)
     try:
-        with urlopen(req) as con:
-            data = con.read()
-            ctype = con.info().get_content_type()
+        digest, modified = blobs.fetch(client, url, validators,
+                                       headers=headers)
     except Exception as e:
         print("Cannot get data from requested url")
         print(e)
         return 1
+    if not modified:
+        print("Not modified")
+        metrics.add("reports", files_skipped=1)
+    else:
+        metrics.add("reports", files_written=1)
+    ctype = validators[url]["content_type"]
 
     if ctype == "text/html":
         out_format = "html"
@@ -113,10 +143,11 @@ def process_link(link):
         print("Unrecognized content type")
         return 1
 
+    # Reports are kept in the blob store, and the manifest of out_dir
+    # maps their file names to digests
     id_ = url.rsplit("=", maxsplit=1)[1]
     filename = f"asmav_all_{id_}.{out_format}"
-    with open(os.path.join(out_dir, filename), "wb") as f:
-        f.write(data)
+    files[filename] = digest
 
     sleep(1)
 
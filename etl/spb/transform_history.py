@@ -0,0 +1,481 @@
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import xml.etree.ElementTree as ET
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from html.parser import HTMLParser
+from time import perf_counter
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+import blobs
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+from metrics import Metrics
+
+
+history_dir = os.path.join("data", "spb", "raw", "asmav",
+                           "history_before_2022-07-04")
+out_dir = os.path.join("data", "spb", "product", "history")
+cache_filename = os.path.join("data", "spb", "cache", "history.json")
+timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
+            .isoformat(timespec="seconds")
+logs_dir = os.path.join("logs", "spb", "transform_history")
+if not os.path.isdir(logs_dir):
+    os.makedirs(logs_dir)
+
+logging.basicConfig(
+    filename=os.path.join(logs_dir, f"transform_history_{timestamp}.txt"),
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    level=logging.DEBUG
+)
+
+parser = argparse.ArgumentParser(
+    description="Parse daily reports of asmav stations before 2022-07-04")
+parser.add_argument("--workers",
+    type=int,
+    default=os.cpu_count(),
+    help="Number of processes parsing reports"
+    )
+
+# Cached results are dropped when this version changes, e.g. after
+# a fix of the parser
+VERSION = 2
+
+HEADER = ["date", "station", "pollutant", "qualifier", "value"]
+
+STATION_REGEX = re.compile(r"АСМ-АВ\s*№\s*(\d+)")
+# Reports are for a period "с 0:00 12 июня по 24:00 12 июня 2022 года"
+# or, before 2019, "с 04:00 8 января по 04:00 9 января 2017 года".
+# Some of them only have a date "от 07.05.2021" or the date of the
+# report '"09" января 2017 года'
+PERIOD_REGEX = re.compile(
+    r"по\s*(\d{1,2})[:.]00\s*«?(\d{1,2})»?\s*([а-я]+)\s*(\d{4})")
+DATE_REGEX = re.compile(r"\bот\s+(\d{2})\.(\d{2})\.(\d{4})")
+REPORT_DATE_REGEX = re.compile(
+    r'["«]?(\d{1,2})["»]?\s+([а-я]+)\s+(\d{4})\s+года')
+VALUE_REGEX = re.compile(r"^(менее|<)?\s*(\d+(?:[.,]\d+)?)$")
+SPACE_REGEX = re.compile(r"\s+")
+# Word fields: the code between \x13 and \x14 is not a text
+FIELD_REGEX = re.compile("\x13[^\x13\x14\x15]*\x14?|\x15")
+
+MONTHS = {
+    "января": 1, "февраля": 2, "марта": 3, "апреля": 4, "мая": 5,
+    "июня": 6, "июля": 7, "августа": 8, "сентября": 9, "октября": 10,
+    "ноября": 11, "декабря": 12
+}
+
+# Same codes as the ones of digitized charts
+POLLUTANTS = {
+    "оксид углерода": "CO",
+    "оксид азота": "NO",
+    "диоксид азота": "NO2",
+    "диоксид серы": "SO2",
+    "озон": "O3",
+    # Total suspended particles, reported besides PM10 and PM2.5
+    "взвешенные вещества": "TSP",
+    "взвешенные частицы": "TSP",
+}
+# Particulate matter is written in many ways, e.g. "Взвешенные вещества
+# РМ2,5" with Cyrillic letters
+PM_REGEX = re.compile(
+    r"^взвешенные (?:частицы|вещества) [pр][mм] ?(10|2[.,]5)$")
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# Last sector ids of OLE chains
+OLE_END = 0xfffffffa
+
+
+def main():
+    args = parser.parse_args()
+    started = perf_counter()
+    metrics = Metrics("spb", "transform_history", os.path.join(
+        logs_dir, f"transform_history_{timestamp}.json"))
+    cache = load_cache()
+    files = blobs.list_files(history_dir)
+    # Reports are numbered by publication, so a later one replaces
+    # values of an earlier one for the same day
+    names = sorted(files, key=lambda name: (report_id(name), name))
+    digests = {name: file_digest(files[name]) for name in names}
+
+    new = sorted({digests[name]: files[name] for name in names
+                  if digests[name] not in cache}.items())
+    metrics.add("parse", files_read=len(new),
+                files_skipped=len(names) - len(new))
+    if new:
+        with metrics.stage("parse"), \
+                ProcessPoolExecutor(max_workers=args.workers) as executor:
+            results = executor.map(parse_file, [path for _, path in new],
+                                   chunksize=16)
+            for (digest, path), (rows, error) in zip(new, results):
+                if error is not None:
+                    # Not cached, so the report is parsed again next run
+                    logging.error(f"Cannot parse {path}: {error}")
+                    metrics.add("parse", errors=1)
+                    continue
+                if rows is None:
+                    logging.warning(f"No date in {path}, its station "
+                                    + "tables are skipped")
+                    rows = []
+                metrics.add("parse", rows_parsed=len(rows))
+                cache[digest] = rows
+
+    values = {}
+    for name in names:
+        for row in cache.get(digests[name], []):
+            values[tuple(row[:3])] = row[3:]
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    with metrics.stage("write"):
+        count = write_table(values)
+        save_cache(cache)
+    metrics.add("write", rows_written=count)
+
+    failed = sum(1 for name in names if digests[name] not in cache)
+    empty = sum(1 for name in names if cache.get(digests[name]) == [])
+    logging.info(f"Parsed {len(new)} new of {len(names)} reports in "
+                 + f"{perf_counter() - started:.2f} s, {failed} failed, "
+                 + f"{empty} reports without station tables, {count} rows")
+    metrics.save()
+
+
+def report_id(name):
+    stem = os.path.splitext(name)[0]
+    suffix = stem.rsplit("_", maxsplit=1)[-1]
+    return int(suffix) if suffix.isdigit() else 0
+
+
+def file_digest(path):
+    # Blobs are named by their digests
+    if os.path.dirname(os.path.dirname(path)) == blobs.blobs_dir:
+        return os.path.basename(path)
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def parse_file(path):
+    """Return rows of a report and the error if it cannot be parsed
+
+    Rows are None if the report has station tables but no date.
+    """
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+        return parse_report(read_blocks(content)), None
+    except Exception as e:
+        return [], repr(e)
+
+
+def read_blocks(content):
+    """Read a report as paragraphs ("p", text) and rows ("row", cells)"""
+    if content.startswith(b"PK\x03\x04"):
+        return read_docx_blocks(content)
+    if content.startswith(b"\xd0\xcf\x11\xe0"):
+        return read_doc_blocks(content)
+    return read_html_blocks(content)
+
+
+def parse_report(blocks):
+    # Each table of a station follows the paragraph with its number
+    day = report_date(blocks)
+    if day is None:
+        if any(kind == "p" and STATION_REGEX.search(value)
+               for kind, value in blocks):
+            return None
+        return []
+    rows = []
+    station = None
+    for kind, value in blocks:
+        if kind == "p":
+            match = STATION_REGEX.search(value)
+            if match:
+                station = int(match.group(1))
+            continue
+        if station is None or len(value) != 2:
+            continue
+        pollutant = normalize_pollutant(value[0])
+        match = VALUE_REGEX.match(normalize_text(value[1]))
+        if not pollutant or not match:
+            continue
+        qualifier = "<" if match.group(1) else ""
+        rows.append([day, station, pollutant, qualifier,
+                     float(match.group(2).replace(",", "."))])
+    return rows
+
+
+def report_date(blocks):
+    # The period is looked for first: the date of the report goes
+    # before it and is sometimes a few days later
+    texts = [normalize_text(value) for kind, value in blocks if kind == "p"]
+    for text in texts:
+        match = PERIOD_REGEX.search(text)
+        if match and match.group(3) in MONTHS:
+            hour, day, month, year = match.groups()
+            end = date(int(year), MONTHS[month], int(day))
+            # A period from 04:00 to 04:00 is mostly on its first day
+            if hour != "24":
+                end -= timedelta(days=1)
+            return end.isoformat()
+    for text in texts:
+        match = DATE_REGEX.search(text)
+        if match:
+            day, month, year = map(int, match.groups())
+            return date(year, month, day).isoformat()
+        match = REPORT_DATE_REGEX.search(text)
+        if match and match.group(2) in MONTHS:
+            day, month, year = match.groups()
+            return date(int(year), MONTHS[month], int(day)).isoformat()
+    return None
+
+
+def normalize_text(text):
+    return SPACE_REGEX.sub(" ", text.replace("\xa0", " ")).strip()
+
+
+def normalize_pollutant(cell):
+    name = normalize_text(cell).lower()
+    if not name or name.startswith("загрязняющее"):
+        return None
+    match = PM_REGEX.match(name)
+    if match:
+        return "PM" + match.group(1).replace(",", ".")
+    return POLLUTANTS.get(name, name)
+
+
+def read_docx_blocks(content):
+    with zipfile.ZipFile(io.BytesIO(content)) as z:
+        root = ET.fromstring(z.read("word/document.xml"))
+    blocks = []
+    elements = list(root.find(W + "body"))
+    while elements:
+        element = elements.pop(0)
+        if element.tag == W + "p":
+            blocks.append(("p", docx_text(element)))
+        elif element.tag == W + "tbl":
+            for row in element.iter(W + "tr"):
+                blocks.append(("row", [
+                    "\n".join(docx_text(p) for p in cell.iter(W + "p"))
+                    for cell in row.iter(W + "tc")
+                ]))
+        elif element.tag in (W + "sdt", W + "sdtContent"):
+            elements[:0] = list(element)
+    return blocks
+
+
+def docx_text(element):
+    return "".join(t.text or "" for t in element.iter(W + "t"))
+
+
+def read_doc_blocks(content):
+    """Read a Word 97 document
+
+    Cells of a table end with \\x07, and so does each row, so an empty
+    cell closes a row. Paragraphs end with \\r.
+    """
+    text = FIELD_REGEX.sub("", read_doc_text(content))
+    blocks = []
+    cells = []
+    parts = text.split("\x07")
+    for part in parts[:-1]:
+        if not part and cells:
+            blocks.append(("row", cells))
+            cells = []
+            continue
+        if not cells:
+            paragraphs = part.split("\r")
+            blocks.extend(("p", p) for p in paragraphs[:-1])
+            part = paragraphs[-1]
+        cells.append(part.replace("\r", "\n"))
+    blocks.extend(("p", p) for p in parts[-1].split("\r"))
+    return blocks
+
+
+def read_doc_text(content):
+    # The text is a list of pieces in the WordDocument stream, described
+    # by the piece table in the table stream
+    streams = read_ole(content)
+    document = streams["WordDocument"]
+    flags = struct.unpack_from("<H", document, 0x0a)[0]
+    table = streams["1Table" if flags & 0x0200 else "0Table"]
+    fc_clx, lcb_clx = struct.unpack_from("<II", document, 0x01a2)
+    clx = table[fc_clx:fc_clx + lcb_clx]
+    i = 0
+    while clx[i] == 1:
+        i += 3 + struct.unpack_from("<H", clx, i + 1)[0]
+    size = struct.unpack_from("<I", clx, i + 1)[0]
+    plc = clx[i + 5:i + 5 + size]
+    count = (size - 4) // 12
+    cps = struct.unpack_from(f"<{count + 1}I", plc)
+    pieces = []
+    for k in range(count):
+        fc = struct.unpack_from("<I", plc, 4 * (count + 1) + 8 * k + 2)[0]
+        length = cps[k + 1] - cps[k]
+        if fc & 0x40000000:
+            fc = (fc & ~0x40000000) // 2
+            pieces.append(document[fc:fc + length].decode("cp1252",
+                                                          "replace"))
+        else:
+            pieces.append(document[fc:fc + 2 * length].decode("utf-16-le",
+                                                              "replace"))
+    return "".join(pieces)
+
+
+def read_ole(content):
+    """Return streams of an OLE compound file by their names"""
+    sector_size = 1 << struct.unpack_from("<H", content, 0x1e)[0]
+    mini_size = 1 << struct.unpack_from("<H", content, 0x20)[0]
+    (fat_count, dir_start, _, cutoff, minifat_start, _, difat_start,
+     difat_count) = struct.unpack_from("<8I", content, 0x2c)
+    ids_format = f"<{sector_size // 4}I"
+
+    def sector(i):
+        return content[(i + 1) * sector_size:(i + 2) * sector_size]
+
+    difat = list(struct.unpack_from("<109I", content, 0x4c))
+    while difat_start < OLE_END and difat_count:
+        ids = struct.unpack(ids_format, sector(difat_start))
+        difat.extend(ids[:-1])
+        difat_start = ids[-1]
+        difat_count -= 1
+    fat = []
+    for i in difat[:fat_count]:
+        fat.extend(struct.unpack(ids_format, sector(i)))
+
+    def chain(i, table):
+        while i < OLE_END:
+            yield i
+            i = table[i]
+
+    directory = b"".join(sector(i) for i in chain(dir_start, fat))
+    minifat = []
+    for i in chain(minifat_start, fat):
+        minifat.extend(struct.unpack(ids_format, sector(i)))
+
+    streams = {}
+    ministream = b""
+    for offset in range(0, len(directory), 128):
+        name_size, kind = struct.unpack_from("<HB", directory, offset + 64)
+        name = directory[offset:offset + name_size - 2].decode("utf-16-le")
+        start, size = struct.unpack_from("<II", directory, offset + 116)
+        if kind == 5:
+            ministream = b"".join(sector(i) for i in chain(start, fat))
+        elif kind == 2 and size < cutoff:
+            streams[name] = b"".join(
+                ministream[i * mini_size:(i + 1) * mini_size]
+                for i in chain(start, minifat))[:size]
+        elif kind == 2:
+            streams[name] = b"".join(sector(i)
+                                     for i in chain(start, fat))[:size]
+    return streams
+
+
+class BlocksParser(HTMLParser):
+    """Collect text of paragraphs and cells of table rows"""
+    BLOCK_TAGS = {"p", "div", "h1", "h2", "h3", "h4", "li", "br", "table"}
+
+    def __init__(self):
+        super().__init__()
+        self.blocks = []
+        self.text = []
+        self.cells = None
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self.skip += 1
+        elif tag == "tr":
+            self.flush()
+            self.cells = []
+        elif tag in ("td", "th") and self.cells is not None:
+            self.text = []
+        elif tag in self.BLOCK_TAGS and self.cells is None:
+            self.flush()
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style"):
+            self.skip = max(self.skip - 1, 0)
+        elif tag in ("td", "th") and self.cells is not None:
+            self.cells.append("".join(self.text))
+            self.text = []
+        elif tag == "tr" and self.cells is not None:
+            self.blocks.append(("row", self.cells))
+            self.cells = None
+        elif tag in self.BLOCK_TAGS and self.cells is None:
+            self.flush()
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.text.append(data)
+
+    def flush(self):
+        text = "".join(self.text)
+        if text.strip():
+            self.blocks.append(("p", text))
+        self.text = []
+
+
+def read_html_blocks(content):
+    parser = BlocksParser()
+    parser.feed(content.decode("utf8", "replace"))
+    parser.close()
+    parser.flush()
+    return parser.blocks
+
+
+def write_table(values):
+    rows = [list(key) + value for key, value in sorted(values.items())]
+    with open(os.path.join(out_dir, "daily.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+    if pa is not None:
+        columns = list(zip(*rows)) or [()] * len(HEADER)
+        table = pa.table([
+            pa.array(map(date.fromisoformat, columns[0]), type=pa.date32()),
+            pa.array(columns[1], type=pa.int16()),
+            pa.array(columns[2], type=pa.string()).dictionary_encode(),
+            pa.array(columns[3], type=pa.string()).dictionary_encode(),
+            pa.array(columns[4], type=pa.float64()),
+        ], names=HEADER)
+        pq.write_table(table, os.path.join(out_dir, "daily.parquet"),
+                       compression="zstd")
+    return len(rows)
+
+
+def load_cache():
+    try:
+        with open(cache_filename) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != VERSION:
+        return {}
+    return cache["files"]
+
+
+def save_cache(cache):
+    cache_dir = os.path.dirname(cache_filename)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(cache_filename, "w") as f:
+        json.dump({"version": VERSION, "files": cache}, f,
+                  ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,25 @@ import json
 import logging
 import os
 import re
+import sys
 from datetime import datetime, timedelta, timezone
 from urllib.error import HTTPError, URLError
-from urllib.request import urlopen
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+import http_client
+from metrics import Metrics
 
 
 url = "http://www.tatarmeteo.ru/ru/monitoring-okruzhayushhej-sredyi/monitoring-zagryazneniya-atmosfernogo-vozduxa-kazani.html"
 out_dir = os.path.join("data", "tat", "raw")
 timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
             .isoformat(timespec="seconds")
+client = http_client.Client(timeout=120)
+
+PLACEMARK_REGEX = re.compile(r"myPlacemark\d{1,2} = ")
+COORDS_REGEX = re.compile(r"Placemark\(\[(\d{2}\.\d+, ?\d{2}.\d+)\]")
+CONTENT_REGEX = re.compile("balloonContent: ?'([^']+)'")
 
 logs_dir = os.path.join("logs", "tat", "extract")
 if not os.path.isdir(logs_dir):
@@ -20,24 +30,34 @@ logging.basicConfig(
     format="[%(asctime)s] %(levelname)s: %(message)s",
     level=logging.DEBUG
 )
+metrics = Metrics("tat", "extract",
+                  os.path.join(logs_dir, f"extract_{timestamp}.json"))
 
 def main():
     logging.info(f"Trying to get data")
-    data = get_raw_data(url)
+    with metrics.stage("fetch"):
+        data = get_raw_data(url)
+    client.log_stats()
+    metrics.add_http("http", client)
     if not data:
         logging.warning(f"No data")
+        metrics.add("fetch", errors=1)
+        metrics.save()
         return
     try:
-        filename = save_raw_data(data)
+        with metrics.stage("save"):
+            filename = save_raw_data(data)
         logging.info(f"Data saved to {filename}")
+        metrics.add("save", files_written=1)
     except:
         logging.error("Cannot save data")
+        metrics.add("save", errors=1)
+    metrics.save()
 
 def get_raw_data(url):
     logging.info(f"Trying to get {url}")
     try:
-        with urlopen(url) as con:
-            html = con.read().decode()
+        html = client.get(url).content.decode()
     except HTTPError as e:
         logging.critical(f"Cannot get data from {url}")
         logging.critical(f"Error code {e.code}: {e.reason}")
@@ -48,15 +68,12 @@ def get_raw_data(url):
         return None
 
     logging.info("Data retrieved. Extracting placemarks")
-    regex = re.compile("myPlacemark\d{1,2} = ")
-    parts = re.split(regex, html)
+    parts = PLACEMARK_REGEX.split(html)
     placemarks = [part for part in parts if "balloonContent" in part]
     logging.info(f"Detected {len(placemarks)} placemarks")
     data = []
     for placemark in placemarks:
-        regex_coords = re.compile("Placemark\(\[(\d{2}\.\d+, ?\d{2}.\d+)\]")
-        regex_content = re.compile("balloonContent: ?'([^']+)'")
-        placemark_coords = re.search(regex_coords, placemark)
+        placemark_coords = COORDS_REGEX.search(placemark)
         if placemark_coords:
             coords_str = placemark_coords.group(1)
             coords_str = coords_str.replace(" ", "")
@@ -64,7 +81,7 @@ def get_raw_data(url):
         else:
             lat, lon = None, None
             logging.warning("No coords")
-        placemark_data = re.search(regex_content, placemark)
+        placemark_data = CONTENT_REGEX.search(placemark)
         if placemark_data:
             content = placemark_data.group(1)
         else:
@@ -78,6 +95,7 @@ def get_raw_data(url):
             }
             data.append(point_data)
 
+    metrics.add("fetch", rows_parsed=len(data))
     return data
 
 def save_raw_data(data):
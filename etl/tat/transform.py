@@ -0,0 +1,272 @@
+import csv
+import json
+import logging
+import math
+import os
+import re
+import sys
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+from metrics import Metrics
+
+
+raw_dir = os.path.join("data", "tat", "raw")
+out_dir = os.path.join("data", "tat", "product")
+timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
+            .isoformat(timespec="seconds")
+
+MSK_TZ = timezone(timedelta(hours=3))
+
+HEADER = ["city", "station", "pollutant", "kind", "period_start",
+          "period_end", "datetime", "value", "mpc"]
+
+# Balloons are small, so they are read with regexes compiled once for
+# all placemarks of all snapshots
+STATION_REGEX = re.compile("<b>(.*?)</b>")
+# The label is written both as "Период наблюдения:" and with two colons
+PERIOD_REGEX = re.compile(
+    r"Период наблюдения:+\s*(\d{1,2}:\d{2})\s+(\d{2}\.\d{2}\.\d{4})\s*-\s*"
+    + r"(\d{1,2}:\d{2})\s+(\d{2}\.\d{2}\.\d{4})")
+DAY_REGEX = re.compile(r"День наблюдения:+\s*(\d{2}\.\d{2}\.\d{4})")
+ROW_REGEX = re.compile("<tr>(.*?)</tr>")
+CELL_REGEX = re.compile("<td[^>]*>(.*?)</td>")
+TIME_REGEX = re.compile(r"^\d{1,2}:\d{2}$")
+TAG_REGEX = re.compile("<[^>]+>")
+SPACE_REGEX = re.compile(r"\s+")
+
+# Centers of cities with stations. A placemark belongs to the nearest
+# city within CITY_RADIUS km
+CITIES = {
+    "Kazan": (55.796, 49.106),
+    "Naberezhnye Chelny": (55.730, 52.400),
+    "Almetyevsk": (54.901, 52.297),
+    "Nizhnekamsk": (55.636, 51.820)
+}
+CITY_RADIUS = 20
+# Size of cells of the city lookup, degrees
+CELL_SIZE = 0.02
+
+logs_dir = os.path.join("logs", "tat", "transform")
+if not os.path.isdir(logs_dir):
+    os.makedirs(logs_dir)
+logging.basicConfig(
+    filename=os.path.join(logs_dir, f"transform_{timestamp}.txt"),
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    level=logging.DEBUG
+)
+
+def main():
+    started = perf_counter()
+    metrics = Metrics("tat", "transform",
+                      os.path.join(logs_dir, f"transform_{timestamp}.json"))
+    # Names are timestamps, so later snapshots go last
+    filenames = sorted(os.path.join(raw_dir, name)
+                       for name in os.listdir(raw_dir)
+                       if name.endswith(".json"))
+    periods, singles, stations = {}, {}, {}
+    with metrics.stage("read"):
+        for filename in filenames:
+            try:
+                with open(filename) as f:
+                    data = json.load(f)
+            except ValueError:
+                logging.error(f"Cannot read {filename}")
+                metrics.add("read", errors=1)
+                continue
+            metrics.add("read", files_read=1, rows_parsed=len(data))
+            for placemark in data:
+                read_placemark(placemark, periods, singles, stations)
+
+    rows = []
+    for items in periods.values():
+        for lines in items.values():
+            rows.extend(lines)
+    rows.extend(singles.values())
+    rows.sort(key=lambda row: (row[0] or "", row[1], row[6], row[2]))
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    with metrics.stage("write"):
+        write_table(rows)
+        write_stations(stations)
+    metrics.add("write", rows_written=len(rows))
+    if pa is None:
+        logging.warning("pyarrow is not installed, Parquet table "
+                        + "is not written")
+    logging.info(f"Transformed {len(filenames)} files in "
+                 + f"{perf_counter() - started:.2f} s: {len(rows)} rows, "
+                 + f"{len(stations)} stations")
+    metrics.save()
+
+def read_placemark(placemark, periods, singles, stations):
+    content = placemark.get("content") or ""
+    name = STATION_REGEX.search(content)
+    if not name:
+        return
+    station = clean(name.group(1))
+    coords = placemark.get("coords") or {}
+    lat, lon = coords.get("lat"), coords.get("lon")
+    city = find_city(lat, lon)
+    if city is None:
+        logging.warning(f"No city for {station} at {lat}, {lon}")
+    stations[(city, station)] = [lat, lon]
+
+    lines = [
+        [clean(TAG_REGEX.sub("", cell)) for cell in CELL_REGEX.findall(row)]
+        for row in ROW_REGEX.findall(content)
+    ]
+    period = PERIOD_REGEX.search(content)
+    day = DAY_REGEX.search(content)
+    if period:
+        # Maximums over a period are reported again by the next
+        # snapshots until the period is over, sometimes with other
+        # bounds. A period replaces all earlier periods of the station
+        # it overlaps with
+        start_time, start_date, end_time, end_date = period.groups()
+        start = to_dt(start_date, start_time)
+        end = to_dt(end_date, end_time)
+        items = periods.setdefault((city, station), {})
+        for other in [other for other in items
+                      if other[0] < end and start < other[1]]:
+            del items[other]
+        items[(start, end)] = read_maximums(
+            lines, city, station, start_time, start_date, end_date,
+            start, end)
+    elif day:
+        # Values of one day are filled in during the day, so the last
+        # snapshot has the most of them
+        for row in read_singles(lines, city, station, day.group(1)):
+            singles[(city, station, row[2], row[6])] = row
+    else:
+        logging.warning(f"No period for {station}")
+
+def read_maximums(lines, city, station, start_time, start_date, end_date,
+                  start, end):
+    # Rows are pollutant, maximum, its time and MPC. The time has no
+    # date, times before the start of the period are of its last day
+    rows = []
+    for line in lines:
+        if len(line) != 4 or not TIME_REGEX.match(line[2]):
+            continue
+        value = to_float(line[1])
+        if value is None:
+            continue
+        date = start_date if to_minutes(line[2]) >= to_minutes(start_time) \
+            else end_date
+        rows.append([city, station, pollutant_name(line[0]), "max",
+                     start, end, to_dt(date, line[2]), value,
+                     to_float(line[3])])
+    return rows
+
+def read_singles(lines, city, station, date):
+    # Rows are pollutant, values at the times of the header and MPC
+    times = next((line for line in lines
+                  if line and all(TIME_REGEX.match(cell) for cell in line)),
+                 [])
+    rows = []
+    for line in lines:
+        if len(line) != len(times) + 2 or line == times:
+            continue
+        for time, cell in zip(times, line[1:]):
+            value = to_float(cell)
+            if value is None:
+                continue
+            dt = to_dt(date, time)
+            rows.append([city, station, pollutant_name(line[0]), "single",
+                         dt, dt, dt, value, to_float(line[-1])])
+    return rows
+
+def make_city_cells():
+    # Every cell within CITY_RADIUS of a city center is mapped to the
+    # nearest city once, so finding the city of a placemark is a lookup
+    cells = {}
+    for city, (lat, lon) in CITIES.items():
+        lat_steps = math.ceil(CITY_RADIUS / 111 / CELL_SIZE)
+        lon_steps = math.ceil(
+            CITY_RADIUS / (111 * math.cos(math.radians(lat))) / CELL_SIZE)
+        row, col = to_cell(lat, lon)
+        for i in range(row - lat_steps, row + lat_steps + 1):
+            for j in range(col - lon_steps, col + lon_steps + 1):
+                distance = distance_km(i * CELL_SIZE, j * CELL_SIZE, lat, lon)
+                if distance > CITY_RADIUS:
+                    continue
+                if (i, j) not in cells or distance < cells[(i, j)][1]:
+                    cells[(i, j)] = (city, distance)
+    return {cell: city for cell, (city, _) in cells.items()}
+
+def find_city(lat, lon):
+    if lat is None or lon is None:
+        return None
+    return CITY_CELLS.get(to_cell(lat, lon))
+
+def to_cell(lat, lon):
+    return round(lat / CELL_SIZE), round(lon / CELL_SIZE)
+
+def distance_km(lat1, lon1, lat2, lon2):
+    # Equirectangular approximation is enough within a region
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371 * math.hypot(x, y)
+
+CITY_CELLS = make_city_cells()
+
+def write_table(rows):
+    with open(os.path.join(out_dir, "concentrations.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+    if pa is not None:
+        columns = list(zip(*rows)) or [()] * len(HEADER)
+        arrays = [pa.array(column, type=pa.string()).dictionary_encode()
+                  for column in columns[:4]]
+        arrays += [pa.array(column, type=pa.string())
+                   for column in columns[4:7]]
+        arrays += [pa.array(column, type=pa.float64())
+                   for column in columns[7:]]
+        pq.write_table(pa.table(arrays, names=HEADER),
+                       os.path.join(out_dir, "concentrations.parquet"),
+                       compression="zstd")
+
+    logging.info(f"Saved {len(rows)} rows to concentrations table")
+
+def write_stations(stations):
+    with open(os.path.join(out_dir, "stations.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(["city", "station", "lat", "lon"])
+        for (city, station), coords in sorted(
+                stations.items(), key=lambda item: (item[0][0] or "",
+                                                    item[0][1])):
+            writer.writerow([city, station] + coords)
+
+def clean(text):
+    return SPACE_REGEX.sub(" ", text).strip()
+
+def pollutant_name(cell):
+    return cell.split(",")[0].strip()
+
+def to_minutes(time):
+    hours, minutes = time.split(":")
+    return int(hours) * 60 + int(minutes)
+
+def to_dt(date, time):
+    dt = datetime.strptime(f"{date} {time}", "%d.%m.%Y %H:%M")
+    return dt.replace(tzinfo=MSK_TZ).isoformat()
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,21 @@
 import json
 import logging
 import os
+import sys
 from datetime import datetime, timedelta, timezone
-from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+import http_client
+from metrics import Metrics
 
 
 url = "http://www.pogoda-sv.ru/pollcenter/airdata/api/get_station_meas_last_list"
 out_dir = os.path.join("data", "volga", "raw")
 timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
             .isoformat(timespec="seconds")
+client = http_client.Client(timeout=120)
 
 logs_dir = os.path.join("logs", "volga", "extract")
 if not os.path.isdir(logs_dir):
@@ -18,21 +25,31 @@ logging.basicConfig(
     format="[%(asctime)s] %(levelname)s: %(message)s",
     level=logging.DEBUG
 )
+metrics = Metrics("volga", "extract",
+                  os.path.join(logs_dir, f"extract_{timestamp}.json"))
 
 def main():
-    data = get_raw_data()
+    with metrics.stage("fetch"):
+        data = get_raw_data()
+    client.log_stats()
+    metrics.add_http("http", client)
     if not data:
+        metrics.add("fetch", errors=1)
+        metrics.save()
         return
     try:
-        save_raw_data(data)
+        with metrics.stage("save"):
+            save_raw_data(data)
+        metrics.add("save", files_written=1)
     except BaseException as e:
         logging.critical("Cannot save data")
         logging.critical(str(e))
+        metrics.add("save", errors=1)
+    metrics.save()
 
 def get_raw_data():
     try:
-        with urlopen(url) as con:
-            content = con.read().decode()
+        content = client.get(url).content.decode()
     except HTTPError as e:
         logging.critical(f"Cannot get data from {url}")
         logging.critical(f"Error code {e.code}: {e.reason}")
@@ -45,6 +62,7 @@ def get_raw_data():
     try:
         data = json.loads(content)
         logging.info(f"Extracted data from {len(data)} points")
+        metrics.add("fetch", rows_parsed=len(data))
     except:
         logging.error("Data is missing or corrupted")
         return None
@@ -0,0 +1,176 @@
+import csv
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "common"))
+from metrics import Metrics
+
+
+raw_dir = os.path.join("data", "volga", "raw")
+out_dir = os.path.join("data", "volga", "product")
+state_filename = os.path.join("data", "volga", "state.json")
+timestamp = datetime.now(tz=timezone(timedelta(hours=3)))\
+            .isoformat(timespec="seconds")
+
+STATIONS_HEADER = ["station", "region", "district", "number", "address",
+                   "lat", "lon", "affiliation", "automatic"]
+MEAS_HEADER = ["meas", "type", "shortname", "fullname", "unit",
+               "concentration_limit", "danger_class"]
+MEASUREMENTS_HEADER = ["datetime", "station", "meas", "value"]
+
+logs_dir = os.path.join("logs", "volga", "transform")
+if not os.path.isdir(logs_dir):
+    os.makedirs(logs_dir)
+logging.basicConfig(
+    filename=os.path.join(logs_dir, f"transform_{timestamp}.txt"),
+    format="[%(asctime)s] %(levelname)s: %(message)s",
+    level=logging.DEBUG
+)
+
+def main():
+    started = perf_counter()
+    metrics = Metrics("volga", "transform",
+                      os.path.join(logs_dir, f"transform_{timestamp}.json"))
+    measurements_filename = os.path.join(out_dir, "measurements.csv")
+    state = load_state()
+    # The state keeps the size of the table written with it. A larger
+    # table has rows of a run stopped before its state was saved, they
+    # are cut off and written again. Otherwise the table is rebuilt
+    size = os.path.getsize(measurements_filename) \
+        if os.path.isfile(measurements_filename) else None
+    if state is None or size is None or state.get("size") is None \
+            or size < state["size"]:
+        logging.info("No state or it does not match the table, "
+                     + "all snapshots are transformed")
+        state = {"last_snapshot": None, "last": {}, "size": None}
+    elif size > state["size"]:
+        logging.warning(f"Cutting {size - state['size']} bytes written "
+                        + "after the last saved state")
+        with open(measurements_filename, "r+") as f:
+            f.truncate(state["size"])
+
+    # Names are timestamps, so they are sorted in time and only the
+    # ones after the last processed snapshot are new
+    filenames = sorted(name for name in os.listdir(raw_dir)
+                       if name.endswith(".json")
+                       and (state["last_snapshot"] is None
+                            or name > state["last_snapshot"]))
+    if not filenames:
+        logging.info("No new snapshots")
+        metrics.save()
+        return
+
+    stations = read_table("stations", "station")
+    meas = read_table("meas", "meas")
+    rows = []
+    with metrics.stage("read"):
+        for name in filenames:
+            try:
+                with open(os.path.join(raw_dir, name)) as f:
+                    data = json.load(f)
+            except ValueError:
+                logging.error(f"Cannot read {name}")
+                metrics.add("read", errors=1)
+                continue
+            metrics.add("read", files_read=1, rows_parsed=len(data))
+            rows.extend(read_snapshot(data, stations, meas, state["last"]))
+            state["last_snapshot"] = name
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    with metrics.stage("write"):
+        write_table("stations", STATIONS_HEADER, stations)
+        write_table("meas", MEAS_HEADER, meas)
+        state["size"] = write_measurements(measurements_filename, rows,
+                                           rebuild=state["size"] is None)
+        save_state(state)
+    metrics.add("write", rows_written=len(rows))
+    logging.info(f"Transformed {len(filenames)} snapshots in "
+                 + f"{perf_counter() - started:.2f} s: {len(rows)} new "
+                 + "measurements")
+    metrics.save()
+
+def read_snapshot(data, stations, meas, last):
+    # Each snapshot has only the last value of every station and meas,
+    # and it stays the same until the next measurement. A value is new
+    # if it is later than the last one written for the station and meas
+    rows = []
+    for station in data.values():
+        sid = str(station["id"])
+        stations[sid] = [
+            sid, station.get("region"), station.get("district"),
+            station.get("number"), station.get("address"),
+            station.get("latitude"), station.get("longitude"),
+            station.get("affiliation"), station.get("automatic")
+        ]
+        for mid, info in (station.get("meas_list") or {}).items():
+            meas[mid] = [
+                mid, info.get("type"), info.get("shortname"),
+                info.get("fullname"), info.get("unit"),
+                info.get("concentration_limit"), info.get("danger_class")
+            ]
+        for mid, item in (station.get("meas_last_list") or {}).items():
+            begin_at, value = item.get("begin_at"), item.get("value")
+            if not begin_at or value is None:
+                continue
+            dt = datetime.fromisoformat(begin_at.replace("Z", "+00:00"))\
+                .isoformat()
+            key = f"{sid}/{mid}"
+            if key in last and dt <= last[key]:
+                continue
+            last[key] = dt
+            rows.append((dt, sid, mid, value))
+    return rows
+
+def read_table(name, key):
+    filename = os.path.join(out_dir, f"{name}.csv")
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return {}
+        position = header.index(key)
+        return {row[position]: row for row in reader}
+
+def write_table(name, header, items):
+    with open(os.path.join(out_dir, f"{name}.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(row for _, row in sorted(
+            items.items(), key=lambda item: int(item[0])))
+
+def write_measurements(filename, rows, rebuild=False):
+    # The table is only appended unless it is rebuilt, rows of one run
+    # are sorted by datetime, station and meas. Returns the new size
+    rows.sort(key=lambda row: (row[0], int(row[1]), int(row[2])))
+    with open(filename, "w" if rebuild else "a") as f:
+        writer = csv.writer(f)
+        if rebuild:
+            writer.writerow(MEASUREMENTS_HEADER)
+        writer.writerows(rows)
+    return os.path.getsize(filename)
+
+def load_state():
+    if not os.path.isfile(state_filename):
+        return None
+    try:
+        with open(state_filename) as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning(f"Cannot read state from {state_filename}")
+        return None
+
+def save_state(state):
+    with open(state_filename + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_filename + ".tmp", state_filename)
+
+if __name__ == "__main__":
+    main()